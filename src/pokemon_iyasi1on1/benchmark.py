@@ -0,0 +1,460 @@
+"""
+シミュレーションの主要な処理の速度を測る
+各ベンチマークは1秒あたりの処理数(大きいほど速い)を求め、結果をJSONで保存する。
+基準の結果(baseline)を指定すると、処理数がしきい値以上に落ちたベンチマークを報告し、終了コード1を返す。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage import calc_damage, calc_status, optimize_hb
+from pokemon_iyasi1on1.damage_table import prepare_damage_table
+from pokemon_iyasi1on1.db import get_species_by_name
+from pokemon_iyasi1on1.generate_win_table import (
+    N_MATCHES,
+    SimulationMethod,
+    canonicalize_breedings,
+    compute_matches,
+    get_breedings,
+    keyed_monte_carlo,
+    worker_pool,
+)
+from pokemon_iyasi1on1.model import (
+    STRUGGLE_POWER,
+    NatureTarget,
+    Poke,
+    PokeBreeding,
+    PokeStrategy,
+)
+from pokemon_iyasi1on1.regulation import (
+    EV_MAX,
+    EV_MIN,
+    EV_TOTAL,
+    IV_MAX,
+    IV_MIN,
+    POKE_LEVEL,
+)
+from pokemon_iyasi1on1.rules import rule_versions
+from pokemon_iyasi1on1.simulate_battle import SIMULATOR_VERSION, simulate
+from pokemon_iyasi1on1.win_table_store import WinTableStore
+
+MIN_TIME = 0.5  # 1回の計測の最短時間(秒)
+REPEAT = 3  # 計測の回数。最も速い回を結果とする
+THRESHOLD = 0.15  # 基準からの低下率がこれを超えたら性能低下とみなす
+WIN_TABLE_POKES = 16  # 勝率表のベンチマークで対戦させる構築の数
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    unit: str  # 処理の単位(1秒あたりの数)
+    rate: float  # 1秒あたりの処理数
+    count: int  # 最も速い回の処理数
+    seconds: float  # 最も速い回の時間
+
+
+def measure(
+    name: str,
+    unit: str,
+    run: Callable[[int], int],
+    min_time: float = MIN_TIME,
+    repeat: int = REPEAT,
+) -> BenchmarkResult:
+    """
+    run(n)の速度を測る。run(n)はn回分の処理を行い、実際に処理した数を返す
+    1回の計測がmin_time秒以上になるまでnを増やし、repeat回測った中で最も速い回を結果とする
+    """
+    n = 1
+    while True:
+        start = time.perf_counter()
+        count = run(n)
+        seconds = time.perf_counter() - start
+        if seconds >= min_time:
+            break
+        # 目標時間に届くよう、処理数を見積もって増やす
+        n = max(n * 2, int(n * min_time * 1.2 / max(seconds, 1e-9)))
+    best = (count, seconds)
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        count = run(n)
+        seconds = time.perf_counter() - start
+        if count / seconds > best[0] / best[1]:
+            best = (count, seconds)
+    return BenchmarkResult(name, unit, best[0] / best[1], best[0], best[1])
+
+
+def make_poke(
+    name: str,
+    evs: tuple[int, int, int, int],
+    nature_up: NatureTarget,
+    nature_down: NatureTarget,
+    strategy: PokeStrategy,
+    iv_s: int = IV_MAX,
+) -> Poke:
+    ev_hp, ev_a, ev_b, ev_s = evs
+    return calc_status(
+        PokeBreeding(
+            no=get_species_by_name(name).no,
+            level=POKE_LEVEL,
+            ev_hp=ev_hp,
+            ev_a=ev_a,
+            ev_b=ev_b,
+            ev_s=ev_s,
+            iv_hp=IV_MAX,
+            iv_a=IV_MAX,
+            iv_b=IV_MAX,
+            iv_s=iv_s,
+            nature_up=nature_up,
+            nature_down=nature_down,
+            strategy=strategy,
+        )
+    )
+
+
+def matchups() -> dict[str, tuple[Poke, Poke]]:
+    """
+    simulate()のベンチマークに使う対戦組
+    fast: 火力の高い構築同士で、数ターンで決着する
+    slow: 耐久の高い構築同士で、決着までのターンが長い
+    heal_pulse: 耐久の高いたべのこし型同士で、いやしのはどうでPPが尽きるまで回復し合う
+    """
+    attacker = (EV_MIN, EV_MAX, EV_MIN, EV_MAX)
+    defender = (EV_MAX, EV_MIN, EV_MAX, EV_MIN)
+    return {
+        "fast": (
+            make_poke(
+                "ラティオス",
+                attacker,
+                NatureTarget.A,
+                NatureTarget.NONE,
+                PokeStrategy.VEST,
+            ),
+            make_poke(
+                "ルカリオ",
+                attacker,
+                NatureTarget.A,
+                NatureTarget.NONE,
+                PokeStrategy.VEST,
+            ),
+        ),
+        "slow": (
+            make_poke(
+                "ヤドラン",
+                defender,
+                NatureTarget.B,
+                NatureTarget.S,
+                PokeStrategy.VEST,
+                iv_s=IV_MIN,
+            ),
+            make_poke(
+                "ヤドキング",
+                defender,
+                NatureTarget.B,
+                NatureTarget.S,
+                PokeStrategy.VEST,
+                iv_s=IV_MIN,
+            ),
+        ),
+        "heal_pulse": (
+            make_poke(
+                "ヤドラン",
+                defender,
+                NatureTarget.B,
+                NatureTarget.S,
+                PokeStrategy.LEFTOVER,
+                iv_s=IV_MIN,
+            ),
+            make_poke(
+                "ヤドキング",
+                defender,
+                NatureTarget.B,
+                NatureTarget.S,
+                PokeStrategy.LEFTOVER,
+                iv_s=IV_MIN,
+            ),
+        ),
+    }
+
+
+def bench_calc_damage(min_time: float, repeat: int) -> BenchmarkResult:
+    rng = random.Random(151)
+    args = [
+        (
+            POKE_LEVEL,
+            STRUGGLE_POWER,
+            rng.randrange(50, 250),
+            rng.randrange(50, 250),
+            rng.randrange(0, 2) == 0,
+            rng.randrange(0, 16),
+        )
+        for _ in range(1000)
+    ]
+
+    def run(n: int) -> int:
+        for _ in range(n):
+            for level, power, attack, defend, critical, random_ in args:
+                calc_damage(level, power, attack, defend, critical, random_)
+        return n * len(args)
+
+    return measure("calc_damage", "calls/s", run, min_time, repeat)
+
+
+def bench_calc_status(min_time: float, repeat: int) -> BenchmarkResult:
+    breedings = list(get_breedings()[:1000])
+
+    def run(n: int) -> int:
+        for _ in range(n):
+            for breeding in breedings:
+                calc_status(breeding)
+        return n * len(breedings)
+
+    return measure("calc_status", "calls/s", run, min_time, repeat)
+
+
+def bench_optimize_hb(min_time: float, repeat: int) -> BenchmarkResult:
+    rng = random.Random(151)
+    args = [
+        (
+            rng.randrange(20, 256),
+            IV_MAX,
+            rng.randrange(20, 256),
+            IV_MAX,
+            rng.randrange(0, EV_TOTAL + 1),
+        )
+        for _ in range(1000)
+    ]
+
+    def run(n: int) -> int:
+        for _ in range(n):
+            for bv_h, iv_h, bv_b, iv_b, ev_total in args:
+                optimize_hb(bv_h, iv_h, bv_b, iv_b, ev_total)
+        return n * len(args)
+
+    return measure("optimize_hb", "calls/s", run, min_time, repeat)
+
+
+def bench_simulate(
+    name: str, pokes: tuple[Poke, Poke], min_time: float, repeat: int
+) -> BenchmarkResult:
+    rng = random.Random(151)
+
+    def run(n: int) -> int:
+        for _ in range(n):
+            [poke.reset() for poke in pokes]
+            simulate(pokes, rng)
+        return n
+
+    return measure(f"simulate_{name}", "battles/s", run, min_time, repeat)
+
+
+def bench_monte_carlo(
+    pokes_list: list[tuple[Poke, Poke]], min_time: float, repeat: int
+) -> BenchmarkResult:
+    """
+    N_MATCHES回のモンテカルロ(勝率表の作成と同じ対戦組ごとの乱数列)で1組の勝率を求める処理を、
+    対戦組を順に替えて繰り返す
+    """
+
+    def run(n: int) -> int:
+        for idx in range(n):
+            keyed_monte_carlo(pokes_list[idx % len(pokes_list)], N_MATCHES)
+        return n
+
+    return measure("monte_carlo", "pairs/s", run, min_time, repeat)
+
+
+def bench_win_table(
+    method: SimulationMethod, n_pokes: int, repeat: int
+) -> BenchmarkResult:
+    """
+    勝率表の作成(compute_matches)を、標準の育成から等間隔に選んだn_pokes体の総当たりで行う
+    ワーカープロセスの起動を含めた時間を測る。毎回空のストアに保存するため、計算の省略は起きない
+    ダメージ表・ストアは一時ディレクトリに作り、data/の既存のファイルは変更しない
+    """
+    unique_pokes, _ = canonicalize_breedings(get_breedings())
+    indices = np.linspace(0, len(unique_pokes) - 1, n_pokes).astype(int)
+    pokes = [unique_pokes[idx] for idx in dict.fromkeys(indices.tolist())]
+    matches = [(i, j) for i in range(len(pokes)) for j in range(i + 1, len(pokes))]
+    best = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        damage_table_path = Path(tmp_dir) / "damage_table.npz"
+        prepare_damage_table(pokes, damage_table_path)
+        for trial in range(repeat):
+            start = time.perf_counter()
+            with (
+                WinTableStore(Path(tmp_dir) / f"store_{trial}.tsv") as store,
+                worker_pool(pokes, damage_table_path=damage_table_path) as pool,
+            ):
+                count = compute_matches(
+                    pokes, matches, method, store, verbose=False, pool=pool
+                )
+            seconds = time.perf_counter() - start
+            if best is None or count / seconds > best[0] / best[1]:
+                best = (count, seconds)
+    return BenchmarkResult(
+        f"win_table_{method.value}", "pairs/s", best[0] / best[1], best[0], best[1]
+    )
+
+
+def run_benchmarks(
+    names: list[str] | None = None,
+    min_time: float = MIN_TIME,
+    repeat: int = REPEAT,
+    win_table_method: SimulationMethod = SimulationMethod.MONTE_CARLO,
+    win_table_pokes: int = WIN_TABLE_POKES,
+) -> list[BenchmarkResult]:
+    """
+    ベンチマークを実行する
+    names: 実行するベンチマークの名前(前方一致)。Noneならすべて
+    """
+    pokes_by_name = matchups()
+    benchmarks: dict[str, Callable[[], BenchmarkResult]] = {
+        "calc_damage": lambda: bench_calc_damage(min_time, repeat),
+        "calc_status": lambda: bench_calc_status(min_time, repeat),
+        "optimize_hb": lambda: bench_optimize_hb(min_time, repeat),
+        **{
+            f"simulate_{name}": (
+                lambda name=name, pokes=pokes: bench_simulate(
+                    name, pokes, min_time, repeat
+                )
+            )
+            for name, pokes in pokes_by_name.items()
+        },
+        "monte_carlo": lambda: bench_monte_carlo(
+            list(pokes_by_name.values()), min_time, repeat
+        ),
+        f"win_table_{win_table_method.value}": lambda: bench_win_table(
+            win_table_method, win_table_pokes, repeat
+        ),
+    }
+    results = []
+    for name, bench in benchmarks.items():
+        if names is not None and not any(name.startswith(prefix) for prefix in names):
+            continue
+        results.append(bench())
+    return results
+
+
+def environment() -> dict:
+    """
+    結果を比較する際の参考にする実行環境の情報
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "simulator_version": SIMULATOR_VERSION,
+        "rules": rule_versions(),
+    }
+
+
+def compare(
+    results: list[BenchmarkResult], baseline: dict, threshold: float
+) -> list[str]:
+    """
+    基準の結果と比較して表示し、性能が低下したベンチマークの名前を返す
+    threshold: 基準からの低下率(0.1なら10%)がこれを超えたら性能低下とみなす
+    """
+    baseline_rates = {
+        name: result["rate"] for name, result in baseline["results"].items()
+    }
+    regressions = []
+    for result in results:
+        if result.name not in baseline_rates:
+            print(f"{result.name}: no baseline")
+            continue
+        ratio = result.rate / baseline_rates[result.name]
+        status = "ok"
+        if ratio < 1 - threshold:
+            status = "REGRESSION"
+            regressions.append(result.name)
+        print(f"{result.name}: {ratio:.3f}x baseline ({status})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output", default="data/benchmark.json", help="結果の保存先(JSON)"
+    )
+    parser.add_argument(
+        "--baseline",
+        help="比較する基準の結果(JSON)。同じマシンで--update-baselineを付けて作成する",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="比較せずに、今回の結果を--baselineに保存する",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="基準からの低下率がこれを超えたら性能低下とみなす",
+    )
+    parser.add_argument(
+        "--only", nargs="+", help="実行するベンチマークの名前(前方一致)"
+    )
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument(
+        "--win-table-method",
+        choices=[method.value for method in SimulationMethod],
+        default=SimulationMethod.MONTE_CARLO.value,
+    )
+    parser.add_argument("--win-table-pokes", type=int, default=WIN_TABLE_POKES)
+    args = parser.parse_args()
+    if (
+        args.baseline is not None
+        and not args.update_baseline
+        and not Path(args.baseline).exists()
+    ):
+        parser.error(
+            f"baseline {args.baseline} does not exist;"
+            " create it first with --update-baseline"
+        )
+
+    results = run_benchmarks(
+        args.only,
+        args.min_time,
+        args.repeat,
+        SimulationMethod(args.win_table_method),
+        args.win_table_pokes,
+    )
+    for result in results:
+        print(f"{result.name}: {result.rate:,.1f} {result.unit}")
+    report = {
+        "environment": environment(),
+        "results": {result.name: asdict(result) for result in results},
+    }
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline is None:
+        return
+    if args.update_baseline:
+        Path(args.baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
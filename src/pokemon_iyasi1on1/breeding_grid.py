@@ -0,0 +1,164 @@
+"""
+努力値の全範囲から育成の候補を作る
+実数値が変化する努力値の刻みで列挙し、バトル上区別できない育成をまとめたうえで、
+同じ戦略型・HP・素早さの中で攻撃・防御の両方が他の候補以下になる育成を取り除く。
+(与えるダメージは多いほど、受けるダメージは少ないほど有利なので、そうした育成が均衡に入ることはない)
+HPと素早さは大小が有利不利に直結しない(反動・いやしのはどうの回復量、行動順)ため、比較しない。
+"""
+
+import argparse
+import itertools
+
+import numpy as np
+
+from pokemon_iyasi1on1.db import get_species_by_name
+from pokemon_iyasi1on1.model import NatureTarget, PokeSpecies, PokeStrategy
+from pokemon_iyasi1on1.regulation import (
+    AVAILABLE_POKEMONS,
+    EV_MAX,
+    EV_TOTAL,
+    IV_MAX,
+    IV_MIN,
+    POKE_LEVEL,
+)
+from pokemon_iyasi1on1.tables import BreedingTable, PokeTable
+
+# 性格補正(上昇, 下降)の組。HP・攻撃・防御・素早さ以外への補正はNONEとして扱う
+NATURES = [(NatureTarget.NONE, NatureTarget.NONE)] + [
+    (up, down)
+    for up, down in itertools.product(
+        [NatureTarget.A, NatureTarget.B, NatureTarget.S], NatureTarget
+    )
+    if up != down
+]
+# 素早さの個体値の候補(最遅を含める)
+IV_S_CANDIDATES = [IV_MAX, IV_MIN]
+
+
+def effective_evs(base: int, iv: int, level: int) -> np.ndarray:
+    """
+    実数値(性格補正前)が変化する努力値を昇順に返す(0を含む)
+    同じ実数値になる努力値のうち最小のものだけを残す
+    """
+    evs = np.arange(0, EV_MAX + 1, 4)
+    stats = (base * 2 + iv + evs // 4) * level // 100
+    _, first = np.unique(stats, return_index=True)
+    return evs[np.sort(first)]
+
+
+def grid_breedings(species: PokeSpecies, level: int = POKE_LEVEL) -> BreedingTable:
+    """
+    1種族について、努力値の全範囲の育成を列挙する
+    HP・攻撃・素早さの努力値の組ごとに、防御には残りの努力値で振れる最大の値を振る
+    (防御が低いだけの育成は必ず取り除かれるため、列挙しない)
+    """
+    tables = []
+    for iv_s in IV_S_CANDIDATES:
+        ev_hp, ev_a, ev_s = (
+            grid.ravel()
+            for grid in np.meshgrid(
+                effective_evs(species.base_hp, IV_MAX, level),
+                effective_evs(species.base_a, IV_MAX, level),
+                effective_evs(species.base_s, iv_s, level),
+                indexing="ij",
+            )
+        )
+        remain = EV_TOTAL - ev_hp - ev_a - ev_s
+        ev_hp, ev_a, ev_s, remain = (
+            v[remain >= 0] for v in (ev_hp, ev_a, ev_s, remain)
+        )
+        evs_b = effective_evs(species.base_b, IV_MAX, level)
+        ev_b = evs_b[
+            np.searchsorted(evs_b, np.minimum(remain, EV_MAX), side="right") - 1
+        ]
+        n = len(ev_hp)
+        for (nature_up, nature_down), strategy in itertools.product(
+            NATURES, PokeStrategy
+        ):
+            tables.append(
+                {
+                    "no": np.full(n, species.no),
+                    "level": np.full(n, level),
+                    "ev_hp": ev_hp,
+                    "ev_a": ev_a,
+                    "ev_b": ev_b,
+                    "ev_s": ev_s,
+                    "iv_hp": np.full(n, IV_MAX),
+                    "iv_a": np.full(n, IV_MAX),
+                    "iv_b": np.full(n, IV_MAX),
+                    "iv_s": np.full(n, iv_s),
+                    "nature_up": np.full(n, nature_up.value),
+                    "nature_down": np.full(n, nature_down.value),
+                    "strategy": np.full(n, strategy.value),
+                }
+            )
+    return BreedingTable.from_columns(
+        {name: np.concatenate([t[name] for t in tables]) for name in tables[0]}
+    )
+
+
+def prune_breedings(breedings: BreedingTable) -> BreedingTable:
+    """
+    バトル上区別できない育成を1つにまとめ、支配される育成を取り除く
+    支配: 戦略型・レベル・HP・素早さが同じで、攻撃・防御がともに以上の別の育成がある
+    """
+    keys = PokeTable.from_breedings(breedings).battle_keys()
+    # 各列は0~1023に収まるので、1つの整数にまとめてから重複を除く(2次元のnp.unique()より速い)
+    if keys.max(initial=0) >= 1 << 10:
+        raise ValueError("Stat values must be less than 1024.")
+    packed = np.zeros(len(keys), dtype=np.int64)
+    for column in keys.T:
+        packed = (packed << 10) | column
+    _, first = np.unique(packed, return_index=True)
+    first = np.sort(first)
+    keys = keys[first]
+    level, max_hp, a, b, s, strategy = keys.T
+    # グループ(戦略型・レベル・HP・素早さ)ごとに、攻撃の降順・防御の降順に並べる
+    order = np.lexsort((-b, -a, s, max_hp, level, strategy))
+    group_keys = np.stack([strategy, level, max_hp, s], axis=1)[order]
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = np.any(group_keys[1:] != group_keys[:-1], axis=1)
+    group_id = np.cumsum(new_group) - 1
+    # グループ内で、それまでの(攻撃が以上の)育成の防御の最大値を超えるものだけが支配されない
+    scale = int(b.max()) + 1
+    value = group_id * scale + b[order]
+    previous_max = np.concatenate([[-1], np.maximum.accumulate(value)[:-1]])
+    kept = order[value > previous_max]
+    return breedings[first[np.sort(kept)]]
+
+
+def build_candidates(
+    species_names: list[str] = AVAILABLE_POKEMONS, level: int = POKE_LEVEL
+) -> tuple[BreedingTable, dict[str, int]]:
+    """
+    全種族の育成の候補を作る
+    戻り値: (候補の表, 各段階の件数)
+    """
+    counts = {"enumerated": 0}
+    tables = []
+    for name in species_names:
+        table = grid_breedings(get_species_by_name(name), level)
+        counts["enumerated"] += len(table)
+        # 種族ごとに刈り込んでから結合する(支配関係は推移的なので、結果は一括の場合と同じ)
+        tables.append(prune_breedings(table))
+    merged = BreedingTable(np.concatenate([table.records for table in tables]))
+    counts["pruned_per_species"] = len(merged)
+    candidates = prune_breedings(merged)
+    counts["candidates"] = len(candidates)
+    return candidates, counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output", default="data/candidates.npy", help="候補の育成の表の保存先"
+    )
+    args = parser.parse_args()
+    candidates, counts = build_candidates()
+    for stage, count in counts.items():
+        print(f"{stage}: {count}")
+    candidates.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import math
 
-from pokemon_iyasi1on1.db import get_species
+import numpy as np
+
+from pokemon_iyasi1on1.db import get_species, get_species_table
 from pokemon_iyasi1on1.model import NatureTarget, Poke, PokeBreeding
 from pokemon_iyasi1on1.regulation import EV_MAX
 
@@ -30,6 +32,34 @@ def status_non_hp(bv: int, iv: int, ev: int, level: int, nature: float) -> int:
     return math.floor(((bv * 2 + iv + ev // 4) * level // 100 + 5) * nature)
 
 
+def status_non_hp_array(
+    bv: np.ndarray,
+    iv: np.ndarray,
+    ev: np.ndarray,
+    level: np.ndarray,
+    nature: np.ndarray,
+) -> np.ndarray:
+    """
+    status_non_hp()の配列版
+    """
+    return np.floor(((bv * 2 + iv + ev // 4) * level // 100 + 5) * nature).astype(
+        np.int64
+    )
+
+
+def nature_multiplier_array(
+    nature_up: np.ndarray, nature_down: np.ndarray, target: NatureTarget
+) -> np.ndarray:
+    """
+    性格補正(上昇を優先)の配列。nature_up, nature_downはNatureTargetの値の配列
+    """
+    return np.where(
+        nature_up == target.value,
+        1.1,
+        np.where(nature_down == target.value, 0.9, 1.0),
+    )
+
+
 def _optimal_xy(A: float, B: float, C: float) -> tuple[float, float, float]:
     """
     Maximise  (A + X + 60)*(B + Y + 5)
@@ -126,6 +156,65 @@ def optimize_hb(
     return (ev_h, ev_b)
 
 
+def _optimal_x_array(A: np.ndarray, B: np.ndarray, C: np.ndarray) -> np.ndarray:
+    """
+    _optimal_xy()の配列版(最適Xのみ)
+    候補点は1/16の倍数で互いに異なり、最大値をとる点は一意なので、評価順によらず同じ点を選ぶ
+    """
+    CAP = 31.5
+    if not (np.all(A > 0) and np.all(B > 0) and np.all(C >= 0)):
+        raise ValueError("A, B は正、C は非負で与えてください。")
+    a = A + 60
+    b = B + 5
+    T = np.minimum(C, 2 * CAP)
+    x0 = np.minimum(np.clip((b + T - a) / 2, 0.0, T), CAP)
+    y0 = T - x0
+    over = y0 > CAP
+    y0 = np.where(over, CAP, y0)
+    x0 = np.where(over, np.minimum(T - y0, CAP), x0)
+    candidates = [
+        (x0, y0),
+        (np.zeros_like(T), T),
+        (np.full_like(T, CAP), np.maximum(0.0, T - CAP)),
+        (np.maximum(0.0, T - CAP), np.full_like(T, CAP)),
+    ]
+    xs = np.stack([x for x, _ in candidates])
+    ys = np.stack([y for _, y in candidates])
+    feasible = (xs >= 0) & (xs <= CAP) & (ys >= 0) & (ys <= CAP) & (xs + ys <= T)
+    values = np.where(feasible, (a + xs) * (b + ys), -np.inf)
+    return np.take_along_axis(xs, np.argmax(values, axis=0)[np.newaxis], axis=0)[0]
+
+
+def optimize_hb_array(
+    bv_h: np.ndarray,
+    iv_h: np.ndarray,
+    bv_b: np.ndarray,
+    iv_b: np.ndarray,
+    ev_total: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    optimize_hb()の配列版
+    戻り値: H努力値の配列、B努力値の配列
+    """
+    bv_h, iv_h, bv_b, iv_b, ev_total = np.broadcast_arrays(
+        *(np.asarray(v, dtype=np.int64) for v in (bv_h, iv_h, bv_b, iv_b, ev_total))
+    )
+    valid = ev_total >= 4
+    X = np.zeros(ev_total.shape)
+    X[valid] = _optimal_x_array(
+        (bv_h[valid] * 2 + iv_h[valid]) / 2,
+        (bv_b[valid] * 2 + iv_b[valid]) / 2,
+        ev_total[valid] / 8,
+    )
+    # ev_h: X*8以上の最小の8n+4
+    ev_h = np.ceil((X * 8 + 4) / 8).astype(np.int64) * 8 - 4
+    ev_h = np.minimum(ev_h, np.minimum(ev_total, EV_MAX))
+    ev_h = np.where(valid & (X > 0), ev_h, 0)
+    ev_b = np.where(valid, np.minimum(ev_total - ev_h, EV_MAX), 0)
+    assert np.all(ev_b >= 0)
+    return ev_h, ev_b
+
+
 def calc_status(breeding: PokeBreeding) -> Poke:
     species = get_species(breeding.no)
     hp = status_hp(species.base_hp, breeding.iv_hp, breeding.ev_hp, breeding.level)
@@ -171,3 +260,62 @@ def calc_status(breeding: PokeBreeding) -> Poke:
     )
     poke.reset()
     return poke
+
+
+def calc_status_array(
+    no: np.ndarray,
+    level: np.ndarray,
+    ev_hp: np.ndarray,
+    ev_a: np.ndarray,
+    ev_b: np.ndarray,
+    ev_s: np.ndarray,
+    iv_hp: np.ndarray,
+    iv_a: np.ndarray,
+    iv_b: np.ndarray,
+    iv_s: np.ndarray,
+    nature_up: np.ndarray,
+    nature_down: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """
+    calc_status()の配列版
+    nature_up, nature_downはNatureTargetの値の配列
+    戻り値: "max_hp", "a", "b", "s"の配列
+    """
+    no, level, ev_hp, ev_a, ev_b, ev_s, iv_hp, iv_a, iv_b, iv_s = (
+        np.asarray(v, dtype=np.int64)
+        for v in (no, level, ev_hp, ev_a, ev_b, ev_s, iv_hp, iv_a, iv_b, iv_s)
+    )
+    table = get_species_table()
+    index_by_no = table.index_by_no
+    in_range = (no >= 0) & (no < len(index_by_no))
+    rows = np.where(in_range, index_by_no[np.where(in_range, no, 0)], -1)
+    if np.any(rows < 0):
+        raise ValueError(f"Species with no {no[rows < 0].flat[0]} not found.")
+    base_hp = table.base_hp[rows].astype(np.int64)
+    base_a = table.base_a[rows].astype(np.int64)
+    base_b = table.base_b[rows].astype(np.int64)
+    base_s = table.base_s[rows].astype(np.int64)
+    return {
+        "max_hp": status_hp(base_hp, iv_hp, ev_hp, level),
+        "a": status_non_hp_array(
+            base_a,
+            iv_a,
+            ev_a,
+            level,
+            nature_multiplier_array(nature_up, nature_down, NatureTarget.A),
+        ),
+        "b": status_non_hp_array(
+            base_b,
+            iv_b,
+            ev_b,
+            level,
+            nature_multiplier_array(nature_up, nature_down, NatureTarget.B),
+        ),
+        "s": status_non_hp_array(
+            base_s,
+            iv_s,
+            ev_s,
+            level,
+            nature_multiplier_array(nature_up, nature_down, NatureTarget.S),
+        ),
+    }
@@ -0,0 +1,244 @@
+"""
+全構築の総当たりのダメージ表
+育成の表の攻撃側×防御側のすべての組について、わるあがきの最小・最大ダメージ、最大HPに対する割合、
+n発以内にひんしにする確率(確定数)を求め、1ファイルに保存する。
+
+ダメージの分布は攻撃実数値×防御実数値だけで決まり、その種類は構築の組の数よりずっと少ないため、
+組ごとの値は持たず、構築→実数値のインデックス、実数値の組→分布のインデックス、
+分布ごとのダメージ・確定数の表に分けて保存する。ある構築の行(全構築に対するダメージ)は
+これらの表を引くだけで求まり、ステータスやダメージの再計算は不要。
+ファイルの形式はwin_table_file.write_arrays()と同じで、メモリマップで読み込む。
+"""
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import (
+    N_DAMAGE_OUTCOMES,
+    N_DAMAGE_RANDOM,
+    DamageTable,
+    outcome_index,
+)
+from pokemon_iyasi1on1.db import get_species
+from pokemon_iyasi1on1.generate_win_table import get_breedings
+from pokemon_iyasi1on1.simulate_battle import outcome_probabilities
+from pokemon_iyasi1on1.tables import (
+    BREEDING_COLUMNS,
+    POKE_COLUMNS,
+    BreedingTable,
+    PokeTable,
+)
+from pokemon_iyasi1on1.win_table_file import read_arrays, write_arrays
+
+MAGIC = b"IYDMTX01"
+FORMAT_VERSION = 1
+N_HITS = 4  # 確定数を求める最大の攻撃回数
+DAMAGE_MATRIX_PATH = Path("data/damage_matrix.idm")
+
+
+def ko_probabilities(
+    group_damages: np.ndarray, max_hp: int, n_hits: int = N_HITS
+) -> np.ndarray:
+    """
+    ダメージの分布ごとの、k発の合計ダメージがHP以上になる確率
+    group_damages: 分布ごとのダメージ[分布, outcome_index]
+    戻り値: [分布, k - 1, HP] (HPは0以上max_hp以下)
+    """
+    probs = outcome_probabilities()
+    result = np.zeros((len(group_damages), n_hits, max_hp + 1), dtype=np.float32)
+    for group, damages in enumerate(group_damages):
+        pmf = np.zeros(int(damages.max()) + 1)
+        np.add.at(pmf, damages, probs)
+        total = np.ones(1)
+        for k in range(n_hits):
+            # k + 1発の合計ダメージの分布
+            total = np.convolve(total, pmf)
+            # 合計ダメージがhp以上になる確率(後ろからの累積和)
+            tail = np.cumsum(total[::-1])[::-1]
+            n = min(len(tail), max_hp + 1)
+            result[group, k, :n] = np.minimum(tail[:n], 1.0)
+    return result
+
+
+def build_damage_matrix(
+    path: Path | str,
+    breedings: BreedingTable,
+    n_hits: int = N_HITS,
+    metadata: dict | None = None,
+):
+    """
+    breedings同士の総当たりのダメージ表を作成し、pathに書き出す
+    """
+    pokes = PokeTable.from_breedings(breedings)
+    levels = np.unique(pokes.column("level"))
+    if len(levels) != 1:
+        raise ValueError("All breedings must have the same level.")
+    attacks, attack_index = np.unique(
+        pokes.column("a").astype(np.int64), return_inverse=True
+    )
+    defends, defend_index = np.unique(
+        pokes.column("b").astype(np.int64), return_inverse=True
+    )
+    table = DamageTable.build(int(levels[0]), attacks, defends)
+    # 32通りのダメージが同じ実数値の組を1つの分布にまとめる
+    group_damages, groups = np.unique(
+        table.damages.reshape(-1, N_DAMAGE_OUTCOMES), axis=0, return_inverse=True
+    )
+    groups = groups.reshape(len(attacks), len(defends))
+    max_hp = int(pokes.column("max_hp").max())
+    arrays = {
+        **{
+            f"breeding.{name}": breedings.column(name).astype(dtype)
+            for name, dtype in BREEDING_COLUMNS.items()
+        },
+        **{
+            f"poke.{name}": pokes.column(name).astype(dtype)
+            for name, dtype in POKE_COLUMNS.items()
+        },
+        "attack_index": attack_index.astype(np.uint32),
+        "defend_index": defend_index.astype(np.uint32),
+        "groups": groups.astype(np.uint32),
+        "group_damages": group_damages.astype(np.uint16),
+        "ko_probabilities": ko_probabilities(group_damages, max_hp, n_hits),
+    }
+    header = {
+        "format_version": FORMAT_VERSION,
+        "n_breedings": len(breedings),
+        "n_hits": n_hits,
+        "metadata": dict(metadata or {}),
+    }
+    write_arrays(path, MAGIC, header, arrays)
+
+
+class DamageMatrix:
+    """
+    build_damage_matrix()で書き出したダメージ表
+    lookup()に攻撃側・防御側の構築のインデックス(配列可、ブロードキャストする)を渡して引く
+    """
+
+    def __init__(self, path: Path | str = DAMAGE_MATRIX_PATH):
+        self.path = Path(path)
+        self.header, self.arrays = read_arrays(self.path, MAGIC)
+        self.n_breedings: int = self.header["n_breedings"]
+        self.n_hits: int = self.header["n_hits"]
+        self.metadata: dict = self.header["metadata"]
+
+    def breedings(self) -> BreedingTable:
+        return BreedingTable.from_columns(
+            {name: self.arrays[f"breeding.{name}"] for name in BREEDING_COLUMNS}
+        )
+
+    def pokes(self) -> PokeTable:
+        return PokeTable.from_columns(
+            {name: self.arrays[f"poke.{name}"] for name in POKE_COLUMNS}
+        )
+
+    def lookup(self, attackers, defenders) -> dict[str, np.ndarray]:
+        """
+        攻撃側attackersから防御側defendersへのわるあがきのダメージ
+        戻り値: 列名→配列。形状はattackersとdefendersをブロードキャストしたもの
+            damage_min, damage_max: 急所なしの最小・最大ダメージ
+            critical_max: 急所の最大ダメージ
+            percent_min, percent_max: damage_min, damage_maxの防御側の最大HPに対する割合(%)
+            ko_probability_k (k = 1..n_hits): k発以内にひんしにする確率(回復・反動は考えない)
+        """
+        attackers = np.asarray(attackers)
+        defenders = np.asarray(defenders)
+        groups = self.arrays["groups"][
+            self.arrays["attack_index"][attackers],
+            self.arrays["defend_index"][defenders],
+        ]
+        damages = self.arrays["group_damages"][groups]
+        max_hp = self.arrays["poke.max_hp"][defenders].astype(np.int64)
+        damage_min = damages[..., outcome_index(False, 0)]
+        damage_max = damages[..., outcome_index(False, N_DAMAGE_RANDOM - 1)]
+        columns = {
+            "damage_min": damage_min,
+            "damage_max": damage_max,
+            "critical_max": damages[..., outcome_index(True, N_DAMAGE_RANDOM - 1)],
+            "percent_min": damage_min / max_hp * 100,
+            "percent_max": damage_max / max_hp * 100,
+        }
+        ko_probabilities = self.arrays["ko_probabilities"]
+        for k in range(self.n_hits):
+            columns[f"ko_probability_{k + 1}"] = ko_probabilities[groups, k, max_hp]
+        return columns
+
+    def attacking_row(self, attacker: int) -> dict[str, np.ndarray]:
+        """
+        attackerから全構築へのダメージ
+        """
+        return self.lookup(attacker, np.arange(self.n_breedings))
+
+    def defending_row(self, defender: int) -> dict[str, np.ndarray]:
+        """
+        全構築からdefenderへのダメージ
+        """
+        return self.lookup(np.arange(self.n_breedings), defender)
+
+
+def _write_scouting_table(matrix: DamageMatrix, index: int):
+    """
+    index番目の構築の、全構築に対する攻撃・被弾のダメージをCSVで出力する
+    """
+    attacking = matrix.attacking_row(index)
+    defending = matrix.defending_row(index)
+    fieldnames = ["index", "enemy"]
+    for direction in ["attack", "defend"]:
+        fieldnames.append(f"{direction}_range")
+        fieldnames += [f"{direction}_ko_{k + 1}" for k in range(matrix.n_hits)]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+    writer.writeheader()
+    for idx, breeding in enumerate(matrix.breedings()):
+        row = {"index": idx, "enemy": get_species(breeding.no).name}
+        for direction, columns in [("attack", attacking), ("defend", defending)]:
+            row[f"{direction}_range"] = (
+                f"{columns['damage_min'][idx]}-{columns['damage_max'][idx]}"
+                f"({columns['percent_min'][idx]:.1f}-{columns['percent_max'][idx]:.1f})"
+            )
+            for k in range(matrix.n_hits):
+                row[f"{direction}_ko_{k + 1}"] = (
+                    f"{columns[f'ko_probability_{k + 1}'][idx]:.4f}"
+                )
+        writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="ダメージ表を作成する")
+    build_parser.add_argument("--output", default=str(DAMAGE_MATRIX_PATH))
+    build_parser.add_argument(
+        "--breedings",
+        help="育成の表(.npy)。省略時は標準の育成の一覧",
+    )
+    build_parser.add_argument("--n-hits", type=int, default=N_HITS)
+    scout_parser = subparsers.add_parser(
+        "scout", help="1つの構築の全構築に対するダメージをCSVで出力する"
+    )
+    scout_parser.add_argument("index", type=int, help="構築のインデックス")
+    scout_parser.add_argument("--matrix", default=str(DAMAGE_MATRIX_PATH))
+    args = parser.parse_args()
+    match args.command:
+        case "build":
+            breedings = (
+                BreedingTable.load(args.breedings)
+                if args.breedings
+                else get_breedings()
+            )
+            build_damage_matrix(
+                args.output,
+                breedings,
+                args.n_hits,
+                metadata={"breedings": args.breedings},
+            )
+        case "scout":
+            _write_scouting_table(DamageMatrix(args.matrix), args.index)
+
+
+if __name__ == "__main__":
+    main()
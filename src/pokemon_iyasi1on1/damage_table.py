@@ -0,0 +1,209 @@
+"""
+わるあがきのダメージ表
+攻撃側の攻撃実数値×防御側の防御実数値ごとに、急所の有無×ダメージ乱数16段階の
+全32通りのダメージを保持する
+"""
+
+import functools
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage import calc_damage
+from pokemon_iyasi1on1.model import STRUGGLE_POWER, Poke
+
+N_DAMAGE_RANDOM = 16  # ダメージ乱数の段階数
+N_DAMAGE_OUTCOMES = 2 * N_DAMAGE_RANDOM  # 急所の有無×ダメージ乱数
+DAMAGE_TABLE_PATH = Path("data/damage_table.npz")
+
+
+def outcome_index(critical: bool, random_: int) -> int:
+    """
+    急所の有無とダメージ乱数から、ダメージ表の最後の軸のインデックスを求める
+    """
+    return int(critical) * N_DAMAGE_RANDOM + random_
+
+
+@dataclass
+class DamageTable:
+    level: int  # 攻撃側のレベル
+    attacks: np.ndarray  # 攻撃実数値(昇順)
+    defends: np.ndarray  # 防御実数値(昇順)
+    damages: np.ndarray  # ダメージ[攻撃, 防御, outcome_index]
+
+    @classmethod
+    def build(
+        cls, level: int, attacks: Iterable[int], defends: Iterable[int]
+    ) -> "DamageTable":
+        attacks = np.unique(np.fromiter(attacks, dtype=np.int64))
+        defends = np.unique(np.fromiter(defends, dtype=np.int64))
+        damages = np.zeros(
+            (len(attacks), len(defends), N_DAMAGE_OUTCOMES), dtype=np.uint16
+        )
+        for critical in [False, True]:
+            for random_ in range(N_DAMAGE_RANDOM):
+                damages[:, :, outcome_index(critical, random_)] = calc_damage(
+                    level,
+                    STRUGGLE_POWER,
+                    attacks[:, np.newaxis],
+                    defends[np.newaxis, :],
+                    critical,
+                    random_,
+                )
+        return cls(level=level, attacks=attacks, defends=defends, damages=damages)
+
+    @classmethod
+    def load(cls, path: Path | str) -> "DamageTable":
+        with np.load(path) as f:
+            return cls(
+                level=int(f["level"]),
+                attacks=f["attacks"],
+                defends=f["defends"],
+                damages=f["damages"],
+            )
+
+    def save(self, path: Path | str):
+        """
+        pathに保存する。同時に読み込む他のプロセスが書き込み途中のファイルを見ないよう、
+        同じディレクトリの一時ファイルに書いてから置き換える
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as f:
+            np.savez(
+                f,
+                level=self.level,
+                attacks=self.attacks,
+                defends=self.defends,
+                damages=self.damages,
+            )
+        os.replace(f.name, path)
+
+    def covers(
+        self, level: int, attacks: Iterable[int], defends: Iterable[int]
+    ) -> bool:
+        """
+        指定した実数値の組み合わせがすべて表に含まれるか
+        """
+        return (
+            level == self.level
+            and bool(np.all(np.isin(np.fromiter(attacks, np.int64), self.attacks)))
+            and bool(np.all(np.isin(np.fromiter(defends, np.int64), self.defends)))
+        )
+
+    def lookup(self, attacks: np.ndarray, defends: np.ndarray) -> np.ndarray:
+        """
+        攻撃実数値・防御実数値の配列に対応するダメージ[..., outcome_index]を返す
+        表に含まれない値があればKeyError
+        """
+        attack_idx = np.searchsorted(self.attacks, attacks)
+        defend_idx = np.searchsorted(self.defends, defends)
+        attack_idx = np.minimum(attack_idx, len(self.attacks) - 1)
+        defend_idx = np.minimum(defend_idx, len(self.defends) - 1)
+        if np.any(self.attacks[attack_idx] != attacks) or np.any(
+            self.defends[defend_idx] != defends
+        ):
+            raise KeyError("attack or defend value not in damage table")
+        return self.damages[attack_idx, defend_idx]
+
+
+_damage_table: DamageTable | None = None
+
+
+def set_damage_table(table: DamageTable | None):
+    """
+    プロセス内で共有するダメージ表を設定する
+    """
+    global _damage_table
+    _damage_table = table
+    damage_outcomes.cache_clear()
+
+
+def load_damage_table(path: Path | str = DAMAGE_TABLE_PATH) -> DamageTable | None:
+    """
+    保存済みのダメージ表があれば読み込んで共有する
+    """
+    if not Path(path).exists():
+        return None
+    table = DamageTable.load(path)
+    set_damage_table(table)
+    return table
+
+
+def prepare_damage_table(
+    pokes: Iterable[Poke], path: Path | str = DAMAGE_TABLE_PATH
+) -> DamageTable:
+    """
+    pokes同士の対戦に必要なダメージ表を用意して共有する
+    保存済みの表が必要な値をすべて含んでいればそれを使い、なければ作成して保存する
+    """
+    pokes = list(pokes)
+    levels = {poke.level for poke in pokes}
+    if len(levels) != 1:
+        raise ValueError("All pokes must have the same level.")
+    level = levels.pop()
+    attacks = {poke.a for poke in pokes}
+    defends = {poke.b for poke in pokes}
+    table = DamageTable.load(path) if Path(path).exists() else None
+    if table is None or not table.covers(level, attacks, defends):
+        if table is not None and table.level == level:
+            # 既存の表の値も残す
+            attacks |= set(table.attacks.tolist())
+            defends |= set(table.defends.tolist())
+        table = DamageTable.build(level, attacks, defends)
+        table.save(path)
+    set_damage_table(table)
+    return table
+
+
+@functools.cache
+def damage_outcomes(level: int, attack: int, defend: int) -> tuple[int, ...]:
+    """
+    わるあがきの全32通りのダメージを返す(インデックスはoutcome_index())
+    共有のダメージ表にあれば表から引き、なければ計算する
+    """
+    table = _damage_table
+    if table is not None and table.covers(level, [attack], [defend]):
+        return tuple(table.lookup(np.array(attack), np.array(defend)).tolist())
+    damages = [0] * N_DAMAGE_OUTCOMES
+    for critical in [False, True]:
+        for random_ in range(N_DAMAGE_RANDOM):
+            damages[outcome_index(critical, random_)] = calc_damage(
+                level, STRUGGLE_POWER, attack, defend, critical, random_
+            )
+    return tuple(damages)
+
+
+def damage_outcomes_array(
+    levels: np.ndarray, attacks: np.ndarray, defends: np.ndarray
+) -> np.ndarray:
+    """
+    damage_outcomes()の配列版
+    戻り値: ダメージ[..., outcome_index]
+    """
+    levels = np.asarray(levels)
+    if levels.size == 0:
+        return np.zeros(attacks.shape + (N_DAMAGE_OUTCOMES,), dtype=np.uint16)
+    if np.any(levels != levels.flat[0]):
+        # レベルが混在する場合は1組ずつ引く
+        return np.array(
+            [
+                damage_outcomes(int(level), int(attack), int(defend))
+                for level, attack, defend in zip(
+                    levels.flat, attacks.flat, defends.flat
+                )
+            ],
+            dtype=np.uint16,
+        ).reshape(attacks.shape + (N_DAMAGE_OUTCOMES,))
+    level = int(levels.flat[0])
+    table = _damage_table
+    if table is None or not table.covers(level, attacks.flat, defends.flat):
+        # 共有の表にない値を含む場合は、必要な値だけの表をその場で作る
+        table = DamageTable.build(level, attacks.flat, defends.flat)
+    return table.lookup(attacks, defends)
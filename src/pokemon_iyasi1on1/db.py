@@ -1,11 +1,32 @@
 import csv
+import functools
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
+
 from pokemon_iyasi1on1.model import PokeSpecies
 
+CSV_PATH = Path(__file__).parent / "base_stats.csv"
+# CSVを変換したキャッシュの置き場所(ユーザーのキャッシュディレクトリ)
+# ファイル名にCSVのハッシュを含め、CSVが変わったら作り直す
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "pokemon_iyasi1on1"
+)
+BASE_STAT_COLUMNS = ("base_hp", "base_a", "base_b", "base_s")
+# キャッシュの構造化配列の型
+SPECIES_DTYPE = np.dtype(
+    [("no", "<i4"), ("name", "<U32")]
+    + [(column, "<i2") for column in BASE_STAT_COLUMNS]
+)
+
 
 def load_species_from_csv() -> list[PokeSpecies]:
-    csv_path = Path(__file__).parent / "base_stats.csv"
+    csv_path = CSV_PATH
     species_list = []
     seen_numbers = set()
 
@@ -34,23 +55,134 @@ def load_species_from_csv() -> list[PokeSpecies]:
     return species_list
 
 
-_all_species = load_species_from_csv()
-_species_by_name = {species.name: species for species in _all_species}
-_species_by_no = {species.no: species for species in _all_species}
+@dataclass
+class SpeciesTable:
+    """
+    種族値の表(CSVの行順の列)
+    """
+
+    no: np.ndarray
+    name: np.ndarray
+    base_hp: np.ndarray
+    base_a: np.ndarray
+    base_b: np.ndarray
+    base_s: np.ndarray
+
+    @classmethod
+    def from_records(cls, records: np.ndarray) -> "SpeciesTable":
+        """
+        SPECIES_DTYPEの構造化配列から作る(各列はrecordsのビュー)
+        """
+        return cls(**{name: records[name] for name in SPECIES_DTYPE.names})
+
+    @classmethod
+    def from_species(cls, species_list: list[PokeSpecies]) -> "SpeciesTable":
+        max_name_length = SPECIES_DTYPE["name"].itemsize // 4
+        if any(len(species.name) > max_name_length for species in species_list):
+            raise ValueError(f"Species name longer than {max_name_length} characters.")
+        records = np.array(
+            [
+                (species.no, species.name)
+                + tuple(getattr(species, column) for column in BASE_STAT_COLUMNS)
+                for species in species_list
+            ],
+            dtype=SPECIES_DTYPE,
+        )
+        return cls.from_records(records)
+
+    def to_records(self) -> np.ndarray:
+        records = np.zeros(len(self.no), dtype=SPECIES_DTYPE)
+        for name in SPECIES_DTYPE.names:
+            records[name] = getattr(self, name)
+        return records
+
+    def species(self, idx: int) -> PokeSpecies:
+        return PokeSpecies(
+            no=int(self.no[idx]),
+            name=str(self.name[idx]),
+            base_hp=int(self.base_hp[idx]),
+            base_a=int(self.base_a[idx]),
+            base_b=int(self.base_b[idx]),
+            base_s=int(self.base_s[idx]),
+        )
+
+    @functools.cached_property
+    def index_by_no(self) -> np.ndarray:
+        """
+        図鑑Noから行番号を引く配列。存在しない図鑑Noは-1
+        """
+        index = np.full(int(self.no.max()) + 1, -1, dtype=np.int32)
+        index[self.no] = np.arange(len(self.no), dtype=np.int32)
+        return index
+
+    def column_by_no(self, column: str) -> np.ndarray:
+        """
+        図鑑Noをインデックスとする種族値の列。存在しない図鑑Noは0
+        """
+        values = np.zeros(len(self.index_by_no), dtype=np.int16)
+        values[self.no] = getattr(self, column)
+        return values
+
+
+def cache_path() -> Path:
+    """
+    現在のCSVに対応するキャッシュのパス
+    """
+    csv_hash = hashlib.sha256(CSV_PATH.read_bytes()).hexdigest()
+    return CACHE_DIR / f"base_stats.{csv_hash[:16]}.npy"
+
+
+def load_species_table() -> SpeciesTable:
+    """
+    種族値の表を読み込む
+    CSVに対応するキャッシュがあればメモリマップで読み込み、なければCSVから作ってキャッシュを保存する
+    複数のプロセスが同時に起動しても読み込み途中のファイルを見ないよう、一時ファイルに書いてから置き換える。
+    古いCSVのキャッシュは、他のプロセスが読んでいる可能性があるため消さない
+    """
+    path = cache_path()
+    if path.exists():
+        return SpeciesTable.from_records(np.load(path, mmap_mode="r"))
+    table = SpeciesTable.from_species(load_species_from_csv())
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=CACHE_DIR, prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as f:
+            np.save(f, table.to_records())
+        os.replace(f.name, path)
+    except OSError:
+        # キャッシュディレクトリに書き込めない場合はキャッシュしない
+        pass
+    return table
+
+
+@functools.cache
+def get_species_table() -> SpeciesTable:
+    """
+    種族値の表(初回の呼び出し時に読み込む)
+    """
+    return load_species_table()
+
+
+@functools.cache
+def _species_by_name() -> dict[str, int]:
+    return {name: idx for idx, name in enumerate(get_species_table().name.tolist())}
 
 
 def get_species(no: int) -> PokeSpecies:
-    if no in _species_by_no:
-        return _species_by_no[no]
+    table = get_species_table()
+    if 0 <= no < len(table.index_by_no) and table.index_by_no[no] >= 0:
+        return table.species(int(table.index_by_no[no]))
     raise ValueError(f"Species with no {no} not found.")
 
 
 def get_species_by_name(name: str) -> PokeSpecies:
-    if name in _species_by_name:
-        return _species_by_name[name]
+    if name in _species_by_name():
+        return get_species_table().species(_species_by_name()[name])
     raise ValueError(f"Species with name {name} not found.")
 
 
 if __name__ == "__main__":
-    for species in _all_species:
-        print(species)
+    table = get_species_table()
+    for idx in range(len(table.no)):
+        print(table.species(idx))
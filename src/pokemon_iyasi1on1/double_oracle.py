@@ -0,0 +1,275 @@
+"""
+ダブルオラクル法で、勝率表全体を計算せずに混合戦略ナッシュ均衡を求める
+少数の構築からなる部分ゲームの均衡を求め、その均衡戦略に対する最適応答を全構築から探して
+部分ゲームに加えることを繰り返す。最適応答の探索に必要なのは均衡戦略のサポートとの対戦だけなので、
+計算する勝率は表全体の一部で済む。
+計算した勝率はWinTableStoreに保存するため、再実行時や勝率表の作成と結果を共有できる
+"""
+
+import argparse
+import warnings
+from dataclasses import dataclass
+from multiprocessing import pool as mp_pool
+from typing import Sequence
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import prepare_damage_table
+from pokemon_iyasi1on1.generate_win_table import (
+    TILE_SIZE,
+    SimulationMethod,
+    canonicalize_breedings,
+    compute_matches,
+    decided_matches,
+    get_breedings,
+    match_rules,
+    method_signature,
+    worker_pool,
+)
+from pokemon_iyasi1on1.model import Poke
+from pokemon_iyasi1on1.nash import NashMethod, solve_symmetric_zero_sum
+from pokemon_iyasi1on1.tables import BreedingTable
+from pokemon_iyasi1on1.win_table_store import WinTableStore
+
+SUPPORT_THRESHOLD = 1e-4  # これ未満の選出確率は最適応答の探索で無視する
+
+
+class PayoffCache:
+    """
+    重複のないPoke同士の利得(-1~1)を、必要になった組だけ計算して保持する
+    pool: unique_pokesに対するworker_pool()。探索の間、同じプールで計算する(省略時は計算のたびに作る)
+    """
+
+    def __init__(
+        self,
+        unique_pokes: list[Poke],
+        method: SimulationMethod,
+        store: WinTableStore,
+        tile_size: int = TILE_SIZE,
+        pool: mp_pool.Pool | None = None,
+    ):
+        self.unique_pokes = unique_pokes
+        self.method = method
+        self.store = store
+        self.tile_size = tile_size
+        self.pool = pool
+        # 相手(列)ごとの利得。必要になった列だけを持つ。未計算のマスはNaN
+        # 構築が多い場合も、メモリは(構築数)×(参照した列の数)で済む
+        self.columns: dict[int, np.ndarray] = {}
+        self.n_known = 0  # 利得が分かっている組の数(対角を除く)
+
+    def _column(self, j: int) -> np.ndarray:
+        if j not in self.columns:
+            column = np.full(len(self.unique_pokes), np.nan)
+            column[j] = 0.0
+            # 利得行列は交代行列なので、既存の列から分かるマスを埋める
+            for k, other in self.columns.items():
+                column[k] = -other[j]
+            self.columns[j] = column
+        return self.columns[j]
+
+    def _gather(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        matrix = np.empty((len(rows), len(cols)))
+        for idx, j in enumerate(cols.tolist()):
+            matrix[:, idx] = self._column(j)[rows]
+        return matrix
+
+    def block(self, rows: Sequence[int], cols: Sequence[int]) -> np.ndarray:
+        """
+        利得の部分行列[rows, cols]を返す。未計算の組は計算してから返す
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        matrix = self._gather(rows, cols)
+        unknown_rows, unknown_cols = np.nonzero(np.isnan(matrix))
+        if len(unknown_rows) == 0:
+            return matrix
+        matches = sorted(
+            {
+                (min(i, j), max(i, j))
+                for i, j in zip(
+                    rows[unknown_rows].tolist(), cols[unknown_cols].tolist()
+                )
+            }
+        )
+        rules = match_rules(self.unique_pokes, matches)
+        compute_matches(
+            self.unique_pokes,
+            matches,
+            self.method,
+            self.store,
+            self.tile_size,
+            verbose=False,
+            rules=rules,
+            pool=self.pool,
+            # 乱数によらず勝敗が決まる組はシミュレーションしない
+            decided=decided_matches(self.unique_pokes, matches),
+        )
+        signature = method_signature(self.method)
+        for i, j in matches:
+            winrate, _, _ = self.store.get(
+                (self.unique_pokes[i], self.unique_pokes[j]), signature, rules[(i, j)]
+            )
+            payoff = (winrate - 0.5) * 2
+            if j in self.columns:
+                self.columns[j][i] = payoff
+            if i in self.columns:
+                self.columns[i][j] = -payoff
+        self.n_known += len(matches)
+        return self._gather(rows, cols)
+
+
+@dataclass
+class DoubleOracleResult:
+    strategy: np.ndarray  # 重複のないPokeごとの選出確率
+    subset: list[int]  # 最終的な部分ゲームの構築
+    exploitability: float  # 全構築に対する搾取可能性
+    n_iterations: int
+    n_known: int  # 計算した勝率の組の数
+    n_total: int  # 勝率表全体の組の数
+    converged: bool  # 搾取可能性が許容値以下になったか
+
+
+def double_oracle(
+    cache: PayoffCache,
+    initial: Sequence[int],
+    tolerance: float = 1e-3,
+    max_iterations: int = 100,
+    n_add: int = 4,
+    nash_method: NashMethod = NashMethod.LINEAR_PROGRAM,
+    verbose: bool = True,
+) -> DoubleOracleResult:
+    """
+    ダブルオラクル法で均衡戦略を求める
+    initial: 最初の部分ゲームの構築(重複のないPokeのインデックス)
+    tolerance: 全構築に対する搾取可能性がこれ以下になったら終了する
+    n_add: 1回の反復で部分ゲームに加える最適応答の数(利得の高い順)
+    """
+    n = len(cache.unique_pokes)
+    all_pokes = np.arange(n)
+    subset = list(dict.fromkeys(initial))
+    warm_start = None
+    for iteration in range(1, max_iterations + 1):
+        # 部分ゲームの均衡
+        result = solve_symmetric_zero_sum(
+            cache.block(subset, subset),
+            method=nash_method,
+            tolerance=tolerance / 2,
+            warm_start=warm_start,
+        )
+        in_support = result.strategy >= SUPPORT_THRESHOLD
+        support = np.array(subset)[in_support]
+        weights = result.strategy[in_support] / result.strategy[in_support].sum()
+        # 全構築の、均衡戦略に対する期待利得(サポートとの対戦だけ計算する)
+        values = cache.block(all_pokes, support) @ weights
+        # 利得行列は交代行列なので、相手の最適応答による損失も同じ値になる
+        gap = float(values.max() - (-values).min())
+        strategy = np.zeros(n)
+        strategy[support] = weights
+        if verbose:
+            print(
+                f"iteration {iteration}: subset {len(subset)}, support {len(support)},"
+                f" exploitability {gap:.3g}, known cells {cache.n_known}"
+            )
+        if gap <= tolerance:
+            break
+        in_subset = np.zeros(n, dtype=bool)
+        in_subset[subset] = True
+        candidates = [
+            idx
+            for idx in np.argsort(-values).tolist()
+            if not in_subset[idx] and values[idx] > 0
+        ][:n_add]
+        if len(candidates) == 0:
+            # 部分ゲームの均衡の誤差で、最適応答がすでに部分ゲームに含まれている
+            # (部分ゲームを広げても搾取可能性は下がらないので、収束していなくても打ち切る)
+            warnings.warn(
+                f"Stopped with exploitability {gap:.3g} above the tolerance"
+                f" {tolerance:.3g}: no best response outside the subgame has"
+                " a positive payoff. The subgame equilibrium may be inaccurate."
+            )
+            break
+        warm_start = np.concatenate([result.strategy, np.zeros(len(candidates))])
+        subset.extend(candidates)
+    return DoubleOracleResult(
+        strategy=strategy,
+        subset=subset,
+        exploitability=gap,
+        n_iterations=iteration,
+        n_known=cache.n_known,
+        n_total=n * (n - 1) // 2,
+        converged=gap <= tolerance,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--method",
+        choices=[method.value for method in SimulationMethod],
+        default=SimulationMethod.MARKOV_CHAIN.value,
+        help="勝率の計算方法",
+    )
+    parser.add_argument(
+        "--store",
+        default="data/win_table_store.tsv",
+        help="計算済みの勝率を逐次保存するファイル。勝率表の作成と共有できる",
+    )
+    parser.add_argument(
+        "--nash-method",
+        choices=[method.value for method in NashMethod],
+        default=NashMethod.LINEAR_PROGRAM.value,
+        help="部分ゲームの均衡の計算方法",
+    )
+    parser.add_argument("--tolerance", type=float, default=1e-3)
+    parser.add_argument("--max-iterations", type=int, default=100)
+    parser.add_argument("--n-initial", type=int, default=4, help="最初の構築の数")
+    parser.add_argument("--n-add", type=int, default=4)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--output", help="均衡戦略(育成ごとの選出確率)の保存先(.npy)")
+    parser.add_argument(
+        "--breedings",
+        help="育成の表(.npy、breeding_gridの出力など)。省略時は標準の育成",
+    )
+    args = parser.parse_args()
+
+    breedings = (
+        BreedingTable.load(args.breedings) if args.breedings else get_breedings()
+    )
+    unique_pokes, breeding_to_unique = canonicalize_breedings(breedings)
+    prepare_damage_table(unique_pokes)
+    # 最初の部分ゲームは、重複のないPokeから等間隔に選ぶ
+    initial = np.linspace(0, len(unique_pokes) - 1, args.n_initial).astype(int)
+    with WinTableStore(args.store) as store, worker_pool(unique_pokes) as pool:
+        cache = PayoffCache(
+            unique_pokes, SimulationMethod(args.method), store, args.tile_size, pool
+        )
+        result = double_oracle(
+            cache,
+            initial.tolist(),
+            tolerance=args.tolerance,
+            max_iterations=args.max_iterations,
+            n_add=args.n_add,
+            nash_method=NashMethod(args.nash_method),
+        )
+    print(
+        f"exploitability: {result.exploitability:.3g},"
+        f" computed {result.n_known} / {result.n_total} cells"
+        f" ({result.n_known / result.n_total * 100:.2f}%)"
+    )
+    if not result.converged:
+        print(f"not converged: exploitability is above {args.tolerance:.3g}")
+    # 育成ごとの選出確率。バトル上区別できない育成のうち、最初のものに割り当てる
+    _, first_breeding = np.unique(breeding_to_unique, return_index=True)
+    breeding_strategy = np.zeros(len(breedings))
+    breeding_strategy[first_breeding] = result.strategy
+    if args.output:
+        np.save(args.output, breeding_strategy)
+    for idx in np.argsort(-breeding_strategy):
+        if breeding_strategy[idx] < SUPPORT_THRESHOLD:
+            break
+        print(f"{breeding_strategy[idx] * 100:.2f}%, {breedings[idx]}")
+
+
+if __name__ == "__main__":
+    main()
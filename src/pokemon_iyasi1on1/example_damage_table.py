@@ -5,7 +5,12 @@
 import csv
 import sys
 
-from pokemon_iyasi1on1.damage import calc_damage, calc_status, optimize_hb
+from pokemon_iyasi1on1.damage import calc_status, optimize_hb
+from pokemon_iyasi1on1.damage_table import (
+    damage_outcomes,
+    load_damage_table,
+    outcome_index,
+)
 from pokemon_iyasi1on1.db import get_species_by_name
 from pokemon_iyasi1on1.model import NatureTarget, PokeBreeding, PokeStrategy
 from pokemon_iyasi1on1.regulation import (
@@ -16,6 +21,7 @@ from pokemon_iyasi1on1.regulation import (
 
 
 def main():
+    load_damage_table()
     my_poke = calc_status(
         PokeBreeding(
             no=get_species_by_name("ヤドラン(ガラルのすがた)").no,
@@ -85,8 +91,9 @@ def main():
                     strategy=PokeStrategy.VEST,
                 )
             )
-            damage_min = calc_damage(my_poke.level, 50, my_poke.a, enemy.b, False, 0)
-            damage_max = calc_damage(my_poke.level, 50, my_poke.a, enemy.b, False, 15)
+            damages = damage_outcomes(my_poke.level, my_poke.a, enemy.b)
+            damage_min = damages[outcome_index(False, 0)]
+            damage_max = damages[outcome_index(False, 15)]
             row[column] = (
                 f"{damage_min}-{damage_max}({round(damage_min / enemy.max_hp * 100, 1):.1f}-{round(damage_max / enemy.max_hp * 100, 1):.1f})"
             )
@@ -113,8 +120,9 @@ def main():
                     strategy=PokeStrategy.VEST,
                 )
             )
-            damage_min = calc_damage(enemy.level, 50, enemy.a, my_poke.b, False, 0)
-            damage_max = calc_damage(enemy.level, 50, enemy.a, my_poke.b, False, 15)
+            damages = damage_outcomes(enemy.level, enemy.a, my_poke.b)
+            damage_min = damages[outcome_index(False, 0)]
+            damage_max = damages[outcome_index(False, 15)]
             row[column] = (
                 f"{damage_min}-{damage_max}({round(damage_min / my_poke.max_hp * 100, 1):.1f}-{round(damage_max / my_poke.max_hp * 100, 1):.1f})"
             )
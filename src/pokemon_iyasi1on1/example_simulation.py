@@ -9,7 +9,7 @@ from pokemon_iyasi1on1.damage import calc_status
 from pokemon_iyasi1on1.db import get_species_by_name
 from pokemon_iyasi1on1.model import NatureTarget, Poke, PokeBreeding, PokeStrategy
 from pokemon_iyasi1on1.regulation import EV_MAX, EV_MIN, IV_MAX, IV_MIN, POKE_LEVEL
-from pokemon_iyasi1on1.simulate_battle import simulate
+from pokemon_iyasi1on1.simulate_battle import simulate, win_probability
 
 
 def monte_carlo(pokes: tuple[Poke, Poke], rng: random.Random, count: int):
@@ -63,6 +63,8 @@ def main():
     )
     print(poke0, poke1)
     print(monte_carlo((poke0, poke1), rng, 100000))
+    [poke.reset() for poke in (poke0, poke1)]
+    print(win_probability((poke0, poke1)))
     poke0 = calc_status(
         PokeBreeding(
             no=get_species_by_name("ラティオス").no,
@@ -99,6 +101,8 @@ def main():
     )
     print(poke0, poke1)
     print(monte_carlo((poke0, poke1), rng, 100000))
+    [poke.reset() for poke in (poke0, poke1)]
+    print(win_probability((poke0, poke1)))
 
 
 if __name__ == "__main__":
@@ -1,17 +1,46 @@
 """
-様々なパラメータでモンテカルロシミュレーションを行い、勝率の表を作成する
+様々なパラメータでモンテカルロシミュレーション(または有限マルコフ連鎖による厳密計算)を行い、
+勝率の表を作成する
 """
 
+import argparse
+import contextlib
+import functools
 import itertools
+import math
 import multiprocessing
-import pickle
+import os
 import random
+import time
+from enum import Enum
+from multiprocessing import pool as mp_pool
+from multiprocessing import shared_memory
+from pathlib import Path
 from typing import Generator
 
+import numpy as np
 from tqdm import tqdm
 
 from pokemon_iyasi1on1.damage import calc_status, optimize_hb
+from pokemon_iyasi1on1.damage_table import (
+    DAMAGE_TABLE_PATH,
+    load_damage_table,
+    prepare_damage_table,
+)
 from pokemon_iyasi1on1.db import get_species_by_name
+from pokemon_iyasi1on1.instrumentation import (
+    BattleStats,
+    MatchupStats,
+    MetricsRecorder,
+    current_worker,
+)
+from pokemon_iyasi1on1.keyed_random import (
+    BLOCK_SIZE,
+    RNG_SEED,
+    KeyedDraws,
+    battle_draws,
+    stream_key,
+)
 from pokemon_iyasi1on1.model import NatureTarget, Poke, PokeBreeding, PokeStrategy
 from pokemon_iyasi1on1.regulation import (
     AVAILABLE_POKEMONS,
@@ -22,22 +51,194 @@ from pokemon_iyasi1on1.regulation import (
     IV_MIN,
     POKE_LEVEL,
 )
-from pokemon_iyasi1on1.simulate_battle import simulate
+from pokemon_iyasi1on1.rules import (
+    RULES,
+    Rule,
+    dependent_rules,
+    parse_rule_version,
+    rule_versions,
+    rules_id,
+    with_versions,
+)
+from pokemon_iyasi1on1.schedule import Schedule, predict_costs, schedule_tiles
+from pokemon_iyasi1on1.simulate_battle import (
+    decided_winner,
+    decided_winners,
+    simulate,
+    win_probability,
+)
+from pokemon_iyasi1on1.simulate_battle_batch import keyed_monte_carlo_batch
+from pokemon_iyasi1on1.tables import BreedingTable, PokeTable
+from pokemon_iyasi1on1.win_table_file import write_win_table
+from pokemon_iyasi1on1.win_table_shard import (
+    ShardResult,
+    merge_shards,
+    parse_shard,
+    pokes_fingerprint,
+    shard_matches,
+)
+from pokemon_iyasi1on1.win_table_store import WinTableStore
+
+
+class SimulationMethod(Enum):
+    """
+    勝率の計算方法
+    """
 
+    MONTE_CARLO = "monte_carlo"  # モンテカルロシミュレーション
+    MONTE_CARLO_BATCH = "monte_carlo_batch"  # NumPyで一括実行するモンテカルロ
+    ADAPTIVE_MONTE_CARLO = "adaptive_monte_carlo"  # 試行回数を適応的に決める
+    STRATIFIED_MONTE_CARLO = "stratified_monte_carlo"  # 分散を減らしたモンテカルロ
+    MARKOV_CHAIN = "markov_chain"  # 有限マルコフ連鎖による厳密計算
 
-def monte_carlo(pokes: tuple[Poke, Poke], rng: random.Random, count: int):
+
+def monte_carlo(
+    pokes: tuple[Poke, Poke],
+    rng: random.Random,
+    count: int,
+    stats: BattleStats | None = None,
+):
     """
     モンテカルロシミュレーションを行い、pokes[0]の勝率を返す
+    stats: 指定すると、各バトルの統計を加算する
     """
     lhs_wins = 0
     for _ in range(count):
         [poke.reset() for poke in pokes]
-        winner = simulate(pokes, rng)
+        winner = simulate(pokes, rng, stats)
         if winner == 0:
             lhs_wins += 1
     return lhs_wins / count
 
 
+def keyed_monte_carlo(
+    pokes: tuple[Poke, Poke],
+    count: int,
+    start: int = 0,
+    seed: int = RNG_SEED,
+    stats: BattleStats | None = None,
+) -> float:
+    """
+    対戦組ごとの乱数列(keyed_random)を使ってモンテカルロシミュレーションを行い、pokes[0]の勝率を返す
+    対戦組のstart番目からcount回のバトルを行う。同じ対戦組・同じバトルは、
+    どのプロセスで計算しても、keyed_monte_carlo_batch()で計算しても同じ結果になる
+    """
+    key, flipped = stream_key(pokes)
+    # 乱数列はキーの順序の対戦組に対応するので、その順序でシミュレートする
+    if flipped:
+        pokes = (pokes[1], pokes[0])
+    draws = KeyedDraws(battle_draws(key, start, count, seed))
+    wins = 0
+    for battle in range(count):
+        [poke.reset() for poke in pokes]
+        draws.start_battle(battle)
+        if simulate(pokes, draws, stats) == 0:
+            wins += 1
+    winrate = wins / count
+    return 1 - winrate if flipped else winrate
+
+
+def stratified_monte_carlo(
+    pokes: tuple[Poke, Poke],
+    count: int,
+    seed: int = RNG_SEED,
+    stats: BattleStats | None = None,
+) -> tuple[float, float]:
+    """
+    分散を減らしたモンテカルロシミュレーションを行い、pokes[0]の勝率を返す
+    乱数は層別化・対称変数法によるもの(keyed_random.stratified_block_draws())で、
+    独立な乱数と比べて同じ精度に必要なバトル数が数分の1になる。
+    乱数列はkeyed_monte_carlo()と同じく対戦組ごと(stream_key())で、キーの順序でシミュレートするため、
+    pokes[1]から見た勝率は1 - 勝率と一致し、勝率表の構築の並びにもよらない
+    stats: 指定すると、各バトルの統計と勝率の分散を加算する
+    戻り値: (pokes[0]の勝率, 有効サンプルサイズ(同じ分散を与える独立なバトルの数))
+    """
+    key, flipped = stream_key(pokes)
+    if flipped:
+        pokes = (pokes[1], pokes[0])
+    draws = KeyedDraws(battle_draws(key, 0, count, seed, stratified=True))
+    wins = np.zeros(count)
+    for battle in range(count):
+        [poke.reset() for poke in pokes]
+        draws.start_battle(battle)
+        wins[battle] = simulate(pokes, draws, stats) == 0
+    winrate = float(wins.mean())
+    iid_variance = winrate * (1 - winrate) / count
+    variance = antithetic_variance(wins)
+    if variance is None or variance == 0.0:
+        # 推定できない場合は独立なバトルと同じとみなす
+        variance = iid_variance
+    if stats is not None:
+        stats.iid_variance += iid_variance
+        stats.variance += variance
+    effective_samples = count * iid_variance / variance if variance > 0 else count
+    return (1 - winrate if flipped else winrate), float(effective_samples)
+
+
+def antithetic_variance(wins: np.ndarray, block_size: int = BLOCK_SIZE) -> float | None:
+    """
+    stratified_block_draws()の乱数による勝敗の列wins(1が勝ち)の平均の分散の推定値
+    各ブロックのk番目とk + block_size / 2番目のバトルは対称な乱数の組なので、組の平均を1つの標本とし、
+    組同士を独立とみなして推定する。ブロックの平均のばらつきから求めるより自由度がずっと大きく
+    (600バトルで299)、対戦組ごとの値が安定する。ラテン超方格法による組同士の負の相関は含めないため、
+    実際の分散よりやや大きめ(有効サンプルサイズは控えめ)になる。
+    組が1つ以下なら推定できないのでNone
+    """
+    half = block_size // 2
+    n_blocks = len(wins) // block_size
+    if n_blocks * half < 2:
+        return None
+    pair_means = (
+        wins[: n_blocks * block_size].reshape(n_blocks, 2, half).mean(axis=1).ravel()
+    )
+    return float(np.var(pair_means, ddof=1)) / len(pair_means)
+
+
+def wilson_interval(wins: int, count: int, z: float) -> tuple[float, float]:
+    """
+    勝率のWilsonスコア信頼区間を返す
+    """
+    p = wins / count
+    denominator = 1 + z * z / count
+    center = (p + z * z / (2 * count)) / denominator
+    half_width = (
+        z * math.sqrt(p * (1 - p) / count + z * z / (4 * count * count)) / denominator
+    )
+    return center - half_width, center + half_width
+
+
+def adaptive_monte_carlo(
+    pokes: tuple[Poke, Poke],
+    max_count: int,
+    batch_size: int,
+    ci_width: float,
+    z: float = 1.96,
+    seed: int = RNG_SEED,
+    stats: BattleStats | None = None,
+) -> tuple[float, int]:
+    """
+    batch_size回ずつモンテカルロシミュレーションを行い、勝率の信頼区間の幅がci_width以下になるか、
+    試行回数がmax_countに達したら打ち切る
+    乱数によらず勝敗が決まる場合はシミュレーションを行わない
+    乱数は対戦組ごとの乱数列で、最初のN回のバトルはkeyed_monte_carlo()のN回と同じになる
+    戻り値: (pokes[0]の勝率, 試行回数)。試行回数0は厳密値であることを表す
+    """
+    [poke.reset() for poke in pokes]
+    winner = decided_winner(pokes)
+    if winner is not None:
+        return (1.0 if winner == 0 else 0.0, 0)
+    wins = 0
+    count = 0
+    while count < max_count:
+        batch = min(batch_size, max_count - count)
+        wins += round(keyed_monte_carlo(pokes, batch, count, seed, stats) * batch)
+        count += batch
+        lower, upper = wilson_interval(wins, count, z)
+        if upper - lower <= ci_width:
+            break
+    return (wins / count, count)
+
+
 def enumerate_breeding() -> Generator[PokeBreeding, None, None]:
     for poke_name in AVAILABLE_POKEMONS:
         poke = get_species_by_name(poke_name)
@@ -130,29 +331,674 @@ def enumerate_breeding() -> Generator[PokeBreeding, None, None]:
                 )
 
 
-breedings = list(enumerate_breeding())
+def canonicalize_breedings(
+    breedings: BreedingTable,
+) -> tuple[list[Poke], np.ndarray]:
+    """
+    バトルに関わるパラメータ(実数値・戦略型)が同一になる育成をまとめる
+    戻り値: (重複のないPokeのリスト(初出順), 各育成に対応するPokeのインデックス)
+    """
+    pokes = PokeTable.from_breedings(breedings)
+    _, first, inverse = np.unique(
+        pokes.battle_keys(), axis=0, return_index=True, return_inverse=True
+    )
+    # np.unique()はキーの昇順に並べるので、初出順に並べ直す
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    unique_pokes = list(pokes[first[order]])
+    return unique_pokes, rank[inverse.reshape(-1)].astype(np.int64)
+
+
+def expand_results(
+    unique_results: list[tuple[tuple[int, int], float, int, float]],
+    breeding_to_unique: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    重複のないPoke同士の勝率・試行回数・有効サンプルサイズを、育成のすべての組に展開する
+    同一のPoke同士の対戦は対称なので勝率0.5(厳密値、試行回数0)とする
+    戻り値: 上三角(対角を除く、np.triu_indices()の順)を詰めた(勝率, 試行回数, 有効サンプルサイズ)
+    """
+    n_unique = int(breeding_to_unique.max()) + 1
+    winrates = np.full((n_unique, n_unique), 0.5)
+    n_samples = np.zeros((n_unique, n_unique), dtype=np.int64)
+    effective_samples = np.zeros((n_unique, n_unique))
+    for (i, j), winrate, count, effective in unique_results:
+        winrates[i, j] = winrate
+        winrates[j, i] = 1.0 - winrate
+        n_samples[i, j] = n_samples[j, i] = count
+        effective_samples[i, j] = effective_samples[j, i] = effective
+    rows, cols = np.triu_indices(len(breeding_to_unique), k=1)
+    rows, cols = breeding_to_unique[rows], breeding_to_unique[cols]
+    return (
+        winrates[rows, cols],
+        n_samples[rows, cols],
+        effective_samples[rows, cols],
+    )
+
+
+def decided_matches(
+    unique_pokes: list[Poke], matches: list[tuple[int, int]]
+) -> dict[tuple[int, int], float]:
+    """
+    乱数によらず勝敗が決まる組(先攻の最小ダメージで確定1発、反動で先に倒れるなど)を
+    ダメージの分布・素早さ・反動から一括で調べ、その勝率(1.0 or 0.0)を返す
+    """
+    if len(matches) == 0:
+        return {}
+    matches_array = np.array(matches, dtype=np.int64).reshape(-1, 2)
+    table = PokeTable.from_pokes(unique_pokes)
+    winners = decided_winners(table[matches_array[:, 0]], table[matches_array[:, 1]])
+    return {
+        (i, j): 1.0 if winner == 0 else 0.0
+        for (i, j), winner in zip(matches_array.tolist(), winners.tolist())
+        if winner >= 0
+    }
+
+
+def shortcut_summary(
+    breeding_to_unique: np.ndarray,
+    matches: list[tuple[int, int]],
+    decided: dict[tuple[int, int], float],
+    identical: bool,
+) -> str:
+    """
+    シミュレーションせずに勝率が求まった割合を、育成の組の数で数えて表す
+    identical: 同一のPoke同士の組(勝率0.5)も数える(matchesが全組の場合)
+    """
+    counts = np.bincount(breeding_to_unique).tolist()
+    total = sum(counts[i] * counts[j] for i, j in matches)
+    n_identical = sum(count * (count - 1) // 2 for count in counts) if identical else 0
+    total += n_identical
+    n_decided = sum(counts[i] * counts[j] for i, j in decided)
+    resolved = n_identical + n_decided
+    return (
+        f"resolved without simulation: {resolved} of {total} breeding pairs"
+        f" ({resolved / max(total, 1):.1%}; identical {n_identical},"
+        f" decided {n_decided})"
+    )
+
+
+def match_rules(
+    unique_pokes: list[Poke],
+    matches: list[tuple[int, int]],
+    rules: tuple[Rule, ...] = RULES,
+) -> dict[tuple[int, int], str]:
+    """
+    対戦組ごとの、勝率に影響しうるルールとそのバージョン(保存用のキーに含める)
+    """
+    if len(matches) == 0:
+        return {}
+    matches_array = np.array(matches, dtype=np.int64).reshape(-1, 2)
+    table = PokeTable.from_pokes(unique_pokes)
+    tags = dependent_rules(
+        table[matches_array[:, 0]], table[matches_array[:, 1]], rules
+    )
+    return dict(zip(matches, tags))
+
+
+def rules_summary(
+    breeding_to_unique: np.ndarray,
+    tags: dict[tuple[int, int], str],
+    rules: tuple[Rule, ...] = RULES,
+) -> str:
+    """
+    ルールごとに、そのルールを変更したときに再計算が必要な組の割合を、育成の組の数で数えて表す
+    """
+    counts = np.bincount(breeding_to_unique).tolist()
+    weights: dict[str, int] = {}
+    for (i, j), tag in tags.items():
+        weights[tag] = weights.get(tag, 0) + counts[i] * counts[j]
+    total = max(sum(weights.values()), 1)
+    shares = []
+    for rule in rules:
+        affected = sum(
+            weight for tag, weight in weights.items() if rule.tag() in tag.split(",")
+        )
+        shares.append(f"{rule.tag()} {affected / total:.1%}")
+    return "pairs affected by each rule: " + ", ".join(shares)
+
+
+def make_tiles(matches: list[tuple[int, int]], tile_size: int) -> list[np.ndarray]:
+    """
+    対戦組をtile_size個ずつのタイル(組の配列[組, 2])に分ける
+    組を行優先に並べてから分けるため、1タイルは勝率表の連続した行の一部になる
+    """
+    matches_array = np.array(sorted(matches), dtype=np.int32).reshape(-1, 2)
+    return [
+        matches_array[start : start + tile_size]
+        for start in range(0, len(matches_array), tile_size)
+    ]
+
+
+def plan_tiles(
+    unique_pokes: list[Poke],
+    matches: list[tuple[int, int]],
+    method: SimulationMethod,
+    tile_size: int,
+    schedule: Schedule,
+    n_workers: int,
+) -> list[np.ndarray]:
+    """
+    対戦組をワーカーに渡すタイルに分ける(ワーカーには戻り値の順に渡す)
+    """
+    match schedule:
+        case Schedule.ROW:
+            return make_tiles(matches, tile_size)
+        case Schedule.COST:
+            matches_array = np.array(sorted(matches), dtype=np.int32).reshape(-1, 2)
+            table = PokeTable.from_pokes(unique_pokes)
+            costs = predict_costs(
+                table[matches_array[:, 0]],
+                table[matches_array[:, 1]],
+                markov_chain=method == SimulationMethod.MARKOV_CHAIN,
+            )
+            return schedule_tiles(matches_array, costs, n_workers, tile_size)
+
+
+@functools.cache
+def get_breedings() -> BreedingTable:
+    """
+    勝率表の対象とする育成の表
+    """
+    return BreedingTable.from_breedings(enumerate_breeding())
+
+
 N_MATCHES = 1000
+TILE_SIZE = 256  # ワーカーに1回で渡す対戦組の数
+# ADAPTIVE_MONTE_CARLOのパラメータ
+ADAPTIVE_BATCH_SIZE = 100  # 打ち切りを判定する間隔
+ADAPTIVE_MAX_MATCHES = 10000  # 試行回数の上限
+ADAPTIVE_CI_WIDTH = 0.06  # 95%信頼区間の幅がこれ以下になったら打ち切る
+# STRATIFIED_MONTE_CARLOの試行回数
+# 勝敗の分かれる組での分散は独立なバトルの約1/1.7〜1/4なので、N_MATCHES回の独立なバトルと同程度以上の
+# 精度になる(分散の比が最も小さい組でも600 * 1.7 > 1000)。BLOCK_SIZEの倍数にする
+STRATIFIED_N_MATCHES = 600
+
+
+def method_signature(method: SimulationMethod) -> str:
+    """
+    計算結果の保存用に、計算方法とそのパラメータを文字列で表す
+    """
+    match method:
+        case SimulationMethod.MONTE_CARLO | SimulationMethod.MONTE_CARLO_BATCH:
+            return f"{method.value}:{N_MATCHES}:keyed{RNG_SEED}"
+        case SimulationMethod.ADAPTIVE_MONTE_CARLO:
+            return (
+                f"{method.value}:{ADAPTIVE_BATCH_SIZE}:{ADAPTIVE_MAX_MATCHES}"
+                f":{ADAPTIVE_CI_WIDTH}:keyed{RNG_SEED}"
+            )
+        case SimulationMethod.STRATIFIED_MONTE_CARLO:
+            return f"{method.value}:{STRATIFIED_N_MATCHES}:keyed{RNG_SEED}"
+        case SimulationMethod.MARKOV_CHAIN:
+            return method.value
+
+
+def match_pokes(
+    pokes: tuple[Poke, Poke],
+    method: SimulationMethod,
+    stats: BattleStats | None = None,
+) -> tuple[float, int, float]:
+    """
+    pokes[0]の勝率を計算する
+    モンテカルロの乱数は対戦組ごとの乱数列(keyed_random)なので、結果は計算の分割の仕方によらない
+    stats: 指定すると、シミュレーションしたバトルの統計を加算する
+        (MONTE_CARLO, ADAPTIVE_MONTE_CARLO, STRATIFIED_MONTE_CARLOのみ)
+    戻り値: (勝率, 試行回数, 有効サンプルサイズ)。試行回数0は厳密値であることを表す。
+        有効サンプルサイズは同じ分散を与える独立なバトルの数で、
+        STRATIFIED_MONTE_CARLO以外では試行回数と同じ
+    """
+    [poke.reset() for poke in pokes]
+    match method:
+        case SimulationMethod.MONTE_CARLO:
+            winrate = keyed_monte_carlo(pokes, N_MATCHES, stats=stats)
+            return (winrate, N_MATCHES, float(N_MATCHES))
+        case SimulationMethod.MONTE_CARLO_BATCH:
+            winrate = float(keyed_monte_carlo_batch([pokes], N_MATCHES)[0])
+            return (winrate, N_MATCHES, float(N_MATCHES))
+        case SimulationMethod.ADAPTIVE_MONTE_CARLO:
+            winrate, count = adaptive_monte_carlo(
+                pokes,
+                ADAPTIVE_MAX_MATCHES,
+                ADAPTIVE_BATCH_SIZE,
+                ADAPTIVE_CI_WIDTH,
+                stats=stats,
+            )
+            return (winrate, count, float(count))
+        case SimulationMethod.STRATIFIED_MONTE_CARLO:
+            winrate, effective_samples = stratified_monte_carlo(
+                pokes, STRATIFIED_N_MATCHES, stats=stats
+            )
+            return (winrate, STRATIFIED_N_MATCHES, effective_samples)
+        case SimulationMethod.MARKOV_CHAIN:
+            return (win_probability(pokes), 0, 0.0)
+
+
+def match_breedings(
+    match: tuple[int, int], method: SimulationMethod = SimulationMethod.MONTE_CARLO
+) -> tuple[tuple[int, int], float, int, float]:
+    pokes = tuple(calc_status(get_breedings()[idx]) for idx in match)
+    return (match, *match_pokes(pokes, method))
+
+
+# ワーカープロセスの状態
+# 共有メモリ上のパラメータ表を、プロセスの開始時にコピーせずに参照する
+_worker_shm: shared_memory.SharedMemory | None = None
+_worker_table: PokeTable | None = None
+
+
+def init_worker(
+    shm_name: str, n_pokes: int, damage_table_path: Path | str = DAMAGE_TABLE_PATH
+):
+    """
+    ワーカープロセスの初期化
+    共有メモリ上のステータスの表(PokeTable)を参照し、保存済みのダメージ表を読み込む
+    Pokeは対戦組ごとに表の行から作るため、ワーカーごとに表全体のPokeを持たない
+    """
+    global _worker_shm, _worker_table
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    records = np.ndarray((n_pokes,), dtype=PokeTable.dtype(), buffer=_worker_shm.buf)
+    _worker_table = PokeTable(records)
+    load_damage_table(damage_table_path)
 
 
-def match_breedings(match: tuple[int, int]) -> tuple[tuple[int, int], float]:
-    rng = random.Random(151)
-    pokes = tuple(calc_status(breedings[idx]) for idx in match)
-    return (match, monte_carlo(pokes, rng, N_MATCHES))
+def match_tile(
+    tile: np.ndarray,
+    method: SimulationMethod = SimulationMethod.MONTE_CARLO,
+    instrument: bool = False,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, list[MatchupStats] | None]:
+    """
+    タイル内の対戦組の勝率を計算する(ワーカープロセスで実行)
+    tile: 共有メモリ上のパラメータ表のインデックスの組の配列[組, 2]
+    instrument: 対戦組ごとの計算時間・バトルの統計を記録する
+    戻り値: (tile, 勝率の配列, 試行回数の配列, 有効サンプルサイズの配列,
+        対戦組ごとの記録(instrumentがFalseならNone))
+    """
+    winrates = np.zeros(len(tile))
+    n_samples = np.zeros(len(tile), dtype=np.int64)
+    effective_samples = np.zeros(len(tile))
+    if not instrument:
+        for k, (i, j) in enumerate(tile.tolist()):
+            winrates[k], n_samples[k], effective_samples[k] = match_pokes(
+                (_worker_table[i], _worker_table[j]), method
+            )
+        return tile, winrates, n_samples, effective_samples, None
+    matchup_stats = []
+    worker = current_worker()
+    for k, (i, j) in enumerate(tile.tolist()):
+        stats = BattleStats()
+        start = time.perf_counter()
+        winrates[k], n_samples[k], effective_samples[k] = match_pokes(
+            (_worker_table[i], _worker_table[j]), method, stats
+        )
+        seconds = time.perf_counter() - start
+        matchup_stats.append(
+            MatchupStats((i, j), int(n_samples[k]), seconds, worker, stats)
+        )
+    return tile, winrates, n_samples, effective_samples, matchup_stats
+
+
+@contextlib.contextmanager
+def worker_pool(
+    unique_pokes: list[Poke],
+    n_workers: int | None = None,
+    damage_table_path: Path | str = DAMAGE_TABLE_PATH,
+) -> Generator[mp_pool.Pool, None, None]:
+    """
+    unique_pokesのステータスの表を共有メモリで渡したワーカープロセスのプール
+    compute_matches()を何度も呼ぶ場合(ダブルオラクル法など)は、1つのプールを使い回すと
+    プロセスの起動・ダメージ表の読み込みが1回で済む
+    damage_table_path: ワーカーが読み込むダメージ表(prepare_damage_table()で用意したもの)
+    """
+    records = PokeTable.from_pokes(unique_pokes).records
+    shm = shared_memory.SharedMemory(create=True, size=max(records.nbytes, 1))
+    try:
+        np.ndarray(records.shape, dtype=records.dtype, buffer=shm.buf)[:] = records
+        with multiprocessing.Pool(
+            n_workers or os.cpu_count() or 1,
+            initializer=init_worker,
+            initargs=(shm.name, len(unique_pokes), damage_table_path),
+        ) as pool:
+            yield pool
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def compute_matches(
+    unique_pokes: list[Poke],
+    matches: list[tuple[int, int]],
+    method: SimulationMethod,
+    store: WinTableStore,
+    tile_size: int = TILE_SIZE,
+    verbose: bool = True,
+    metrics: MetricsRecorder | None = None,
+    schedule: Schedule = Schedule.COST,
+    decided: dict[tuple[int, int], float] | None = None,
+    rules: dict[tuple[int, int], str] | None = None,
+    pool: mp_pool.Pool | None = None,
+) -> int:
+    """
+    unique_pokesのインデックスの組matchesのうち、storeに未保存のものの勝率を計算して保存する
+    tile_size: 1つのタイルの組の数(Schedule.COSTでは上限)
+    metrics: 指定すると、対戦組ごとの計算時間・バトルの統計を記録する
+    schedule: 対戦組のタイルへの分け方
+    decided: 乱数によらず勝敗が決まる組の勝率(decided_matches())。
+        これらの組はシミュレーションせずに、この値を厳密値(試行回数0)として保存する
+    rules: 対戦組ごとの勝率に影響しうるルール(match_rules())。省略時はmatchesから求める
+    pool: 同じunique_pokesに対するworker_pool()。省略時はこの呼び出しの間だけプールを作る
+    戻り値: シミュレーションした組の数
+    """
+    signature = method_signature(method)
+    if rules is None:
+        rules = match_rules(unique_pokes, matches)
+    remaining = [
+        (i, j)
+        for i, j in matches
+        if store.get((unique_pokes[i], unique_pokes[j]), signature, rules[(i, j)])
+        is None
+    ]
+    if decided:
+        store.put_many(
+            (
+                (unique_pokes[i], unique_pokes[j]),
+                signature,
+                rules[(i, j)],
+                decided[(i, j)],
+                0,
+                0.0,
+            )
+            for i, j in remaining
+            if (i, j) in decided
+        )
+        remaining = [match for match in remaining if match not in decided]
+    if len(remaining) == 0:
+        return 0
+    # ワーカーにはステータスの表を共有メモリで渡し、
+    # 対戦組はタイル単位で送って結果を配列で受け取る
+    n_workers = os.cpu_count() or 1
+    tiles = plan_tiles(unique_pokes, remaining, method, tile_size, schedule, n_workers)
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(worker_pool(unique_pokes, n_workers))
+        with tqdm(total=len(remaining), disable=not verbose) as t:
+            for (
+                tile,
+                winrates,
+                n_samples,
+                effective_samples,
+                matchup_stats,
+            ) in pool.imap_unordered(
+                functools.partial(
+                    match_tile, method=method, instrument=metrics is not None
+                ),
+                tiles,
+            ):
+                # タイルごとに追記するため、中断しても計算済みの結果は失われない
+                store.put_many(
+                    (
+                        (unique_pokes[i], unique_pokes[j]),
+                        signature,
+                        rules[(i, j)],
+                        winrate,
+                        count,
+                        effective,
+                    )
+                    for (i, j), winrate, count, effective in zip(
+                        tile.tolist(),
+                        winrates.tolist(),
+                        n_samples.tolist(),
+                        effective_samples.tolist(),
+                    )
+                )
+                if metrics is not None:
+                    for stats in matchup_stats:
+                        i, j = stats.pair
+                        metrics.add(
+                            stats,
+                            (
+                                unique_pokes[i].battle_key(),
+                                unique_pokes[j].battle_key(),
+                            ),
+                        )
+                t.update(len(tile))
+    return len(remaining)
+
+
+def write_results(
+    output: str,
+    breedings: BreedingTable,
+    breeding_to_unique: np.ndarray,
+    unique_results: list[tuple[tuple[int, int], float, int, float]],
+    method: SimulationMethod,
+    signature: str,
+    versions: dict[str, int],
+):
+    """
+    重複のないPoke同士の結果を育成の全組に展開し、勝率表を保存する
+    versions: 計算に用いたルールのバージョン(rule_versions())
+    """
+    winrates, n_samples, effective_samples = expand_results(
+        unique_results, breeding_to_unique
+    )
+    print(f"total simulated battles: {sum(result[2] for result in unique_results)}")
+    write_win_table(
+        output,
+        breedings,
+        winrates,
+        {"method": method.value, "signature": signature, "rules": versions},
+        n_samples=n_samples,
+        effective_samples=effective_samples,
+    )
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--method",
+        choices=[method.value for method in SimulationMethod],
+        default=SimulationMethod.MONTE_CARLO.value,
+        help="勝率の計算方法",
+    )
+    parser.add_argument("--output", help="出力ファイル")
+    parser.add_argument(
+        "--store",
+        help="計算済みの勝率を逐次保存するファイル。再実行時は計算済みの組を読み飛ばす"
+        "(既定: data/win_table_store.tsv、シャードごとに別のファイル)",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=TILE_SIZE,
+        help="ワーカーに1回で渡す対戦組の数(--schedule costでは上限)",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=[schedule.value for schedule in Schedule],
+        default=Schedule.COST.value,
+        help="cost: 予測した計算量の大きい順に、残りの計算量に応じた大きさのタイルで配る"
+        " / row: 行優先の順に同じ組数のタイルで配る",
+    )
+    parser.add_argument(
+        "--breedings",
+        help="育成の表(.npy、breeding_gridの出力など)。省略時は標準の育成",
+    )
+    parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="対戦組ごとの計算時間・ターン数などを記録し、終了時に集計を表示する",
+    )
+    parser.add_argument(
+        "--metrics-output",
+        help="対戦組ごとの記録を書き出すファイル(JSONL)。指定すると--instrumentも有効になる",
+    )
+    parser.add_argument(
+        "--shard",
+        help="k/N: 対戦組をN個に分けたうちk番目(0始まり)だけを計算し、シャードファイルに保存する",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="SHARD",
+        help="シャードファイルを検証して結合し、勝率表を保存する(計算は行わない)",
+    )
+    parser.add_argument(
+        "--no-shortcut",
+        action="store_true",
+        help="乱数によらず勝敗が決まる組もシミュレーションする",
+    )
+    parser.add_argument(
+        "--rule",
+        action="append",
+        metavar="NAME=VERSION",
+        help="ルールのバージョンを指定し、保存済みの勝率だけから勝率表を作る(計算は行わない)。"
+        "古いルールの勝率表の参照用。複数指定可",
+    )
+    args = parser.parse_args()
+    method = SimulationMethod(args.method)
+    breedings = (
+        BreedingTable.load(args.breedings) if args.breedings else get_breedings()
+    )
+    unique_pokes, breeding_to_unique = canonicalize_breedings(breedings)
+
+    if args.merge:
+        shards = [ShardResult.load(path) for path in args.merge]
+        unique_results = merge_shards(
+            shards, len(unique_pokes), pokes_fingerprint(unique_pokes)
+        )
+        # 計算方法はシャードに記録されたものを使う
+        method = SimulationMethod(shards[0].method)
+        print(
+            f"merged {len(shards)} shards, {len(unique_results)} matches,"
+            f" method {method.value}"
+        )
+        write_results(
+            args.output or f"data/{method.value}_win_table.iwt",
+            breedings,
+            breeding_to_unique,
+            unique_results,
+            method,
+            shards[0].signature,
+            shards[0].rules,
+        )
+        return
+
+    # ダメージ表を用意(保存済みのものがあれば再利用)
+    # ワーカープロセスは初期化時に保存済みの表を読み込む
+    prepare_damage_table(unique_pokes)
+
     # 対戦ペア
-    matches = list(itertools.combinations(range(len(breedings)), 2))
-    results = []
-    with multiprocessing.Pool() as pool:
-        with tqdm(total=len(matches)) as t:
-            for result in pool.imap_unordered(match_breedings, matches):
-                results.append(result)
-                t.update(1)
-    with open("data/monte_carlo_win_table.pkl", "wb") as f:
-        pickle.dump(
-            {"breedings": breedings, "results": results, "n_matches": N_MATCHES}, f
+    # バトル上区別できない育成はまとめて計算し、同一のもの同士の対戦は計算しない
+    matches = list(itertools.combinations(range(len(unique_pokes)), 2))
+    shard = None
+    store_path = args.store or "data/win_table_store.tsv"
+    if args.shard:
+        shard, n_shards = parse_shard(args.shard)
+        matches = shard_matches(matches, shard, n_shards)
+        store_path = (
+            args.store or f"data/win_table_store.shard-{shard}-of-{n_shards}.tsv"
+        )
+    signature = method_signature(method)
+
+    if args.rule:
+        rules = with_versions(dict(parse_rule_version(spec) for spec in args.rule))
+        tags = match_rules(unique_pokes, matches, rules)
+        with WinTableStore(store_path) as store:
+            stored = [
+                store.get(
+                    (unique_pokes[match[0]], unique_pokes[match[1]]),
+                    signature,
+                    tags[match],
+                )
+                for match in matches
+            ]
+        n_missing = sum(result is None for result in stored)
+        if n_missing > 0:
+            raise ValueError(
+                f"{n_missing} of {len(matches)} matches are not stored"
+                f" for rules {rule_versions(rules)}."
+            )
+        write_results(
+            args.output or f"data/{method.value}_win_table.rules-{rules_id(rules)}.iwt",
+            breedings,
+            breeding_to_unique,
+            [(match, *result) for match, result in zip(matches, stored)],
+            method,
+            signature,
+            rule_versions(rules),
+        )
+        return
+
+    tags = match_rules(unique_pokes, matches)
+    decided = {} if args.no_shortcut else decided_matches(unique_pokes, matches)
+    metrics = None
+    if args.instrument or args.metrics_output:
+        metrics = MetricsRecorder(args.metrics_output)
+    with WinTableStore(store_path) as store:
+        try:
+            n_remaining = compute_matches(
+                unique_pokes,
+                matches,
+                method,
+                store,
+                args.tile_size,
+                metrics=metrics,
+                schedule=Schedule(args.schedule),
+                decided=decided,
+                rules=tags,
+            )
+        finally:
+            if metrics is not None:
+                metrics.close()
+                print(metrics.summary())
+        print(
+            f"{len(breedings)} breedings, {len(unique_pokes)} unique,"
+            f" {len(matches)} matches, {n_remaining} simulated"
+        )
+        print(shortcut_summary(breeding_to_unique, matches, decided, shard is None))
+        print(rules_summary(breeding_to_unique, tags))
+        unique_results = [
+            (
+                match,
+                *store.get(
+                    (unique_pokes[match[0]], unique_pokes[match[1]]),
+                    signature,
+                    tags[match],
+                ),
+            )
+            for match in matches
+        ]
+    if shard is not None:
+        output = (
+            args.output
+            or f"data/{method.value}_win_table.shard-{shard}-of-{n_shards}.npz"
         )
+        ShardResult(
+            shard=shard,
+            n_shards=n_shards,
+            n_unique=len(unique_pokes),
+            fingerprint=pokes_fingerprint(unique_pokes),
+            method=method.value,
+            signature=signature,
+            rules=rule_versions(),
+            pairs=np.array(matches, dtype=np.int32).reshape(-1, 2),
+            winrates=np.array([result[1] for result in unique_results]),
+            n_samples=np.array(
+                [result[2] for result in unique_results], dtype=np.int64
+            ),
+            effective_samples=np.array([result[3] for result in unique_results]),
+        ).save(output)
+        print(f"saved shard {shard}/{n_shards} to {output}")
+        return
+    write_results(
+        args.output or f"data/{method.value}_win_table.iwt",
+        breedings,
+        breeding_to_unique,
+        unique_results,
+        method,
+        signature,
+        rule_versions(),
+    )
 
 
 if __name__ == "__main__":
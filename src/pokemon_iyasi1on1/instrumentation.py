@@ -0,0 +1,206 @@
+"""
+勝率表の作成の計測
+バトルのターン数・いやしのはどう・たべのこしの発動回数と、対戦組ごとの計算時間を記録し、
+どの対戦組に時間がかかっているか、ワーカーごとの処理速度はどうかを調べる。
+計測は有効にしたときだけ行う(simulate()などにstatsを渡さなければ、ほぼ負荷はない)
+"""
+
+import json
+import os
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TextIO
+
+N_SLOWEST = 10  # 集計に表示する、時間のかかった対戦組の数
+
+
+@dataclass(slots=True)
+class BattleStats:
+    """
+    バトルの統計(複数のバトルにわたって加算する)
+    """
+
+    battles: int = 0
+    turns: int = 0
+    heal_pulses: int = 0  # いやしのはどうの発動回数
+    leftovers: int = 0  # たべのこしの発動回数
+    # 勝率の推定値の分散の和(STRATIFIED_MONTE_CARLOのみ)
+    # 独立なバトルとした場合の分散と、実際の乱数での分散の推定値。比が有効サンプルサイズの倍率になる
+    iid_variance: float = 0.0
+    variance: float = 0.0
+    turn_histogram: Counter = field(default_factory=Counter)  # ターン数→バトル数
+
+    def add_battle(self, turns: int):
+        self.battles += 1
+        self.turns += turns
+        self.turn_histogram[turns] += 1
+
+    def merge(self, other: "BattleStats"):
+        self.battles += other.battles
+        self.turns += other.turns
+        self.heal_pulses += other.heal_pulses
+        self.leftovers += other.leftovers
+        self.iid_variance += other.iid_variance
+        self.variance += other.variance
+        self.turn_histogram.update(other.turn_histogram)
+
+    def effective_samples(self) -> float:
+        """
+        有効サンプルサイズ(勝率の推定値と同じ分散を与える独立なバトルの数)
+        """
+        if self.variance <= 0:
+            return float(self.battles)
+        return self.battles * self.iid_variance / self.variance
+
+
+@dataclass(slots=True)
+class MatchupStats:
+    """
+    1つの対戦組の計算の記録
+    """
+
+    pair: tuple[int, int]  # 重複のないPokeのインデックスの組
+    n_samples: int  # 試行回数(0は厳密計算)
+    seconds: float  # 計算時間
+    worker: int  # 計算したワーカーのプロセスID
+    battle: BattleStats  # シミュレーションしたバトルの統計(厳密計算では空)
+
+    def to_json(self, battle_keys: tuple[tuple, tuple] | None = None) -> dict:
+        record = {
+            "pair": list(self.pair),
+            "n_samples": self.n_samples,
+            "seconds": self.seconds,
+            "worker": self.worker,
+            "battles": self.battle.battles,
+            "turns": self.battle.turns,
+            "max_turns": max(self.battle.turn_histogram, default=0),
+            "heal_pulses": self.battle.heal_pulses,
+            "leftovers": self.battle.leftovers,
+            "effective_samples": self.battle.effective_samples(),
+        }
+        if battle_keys is not None:
+            record["battle_keys"] = [list(key) for key in battle_keys]
+        return record
+
+
+def current_worker() -> int:
+    return os.getpid()
+
+
+def log2_bucket(value: float) -> str:
+    """
+    ヒストグラムの区間(2のべき乗の区切り)の名前
+    """
+    upper = 1
+    while upper < value:
+        upper *= 2
+    return f"<={upper}" if upper > 1 else "<=1"
+
+
+def format_histogram(histogram: dict[str, int], width: int = 40) -> list[str]:
+    total = max(sum(histogram.values()), 1)
+    peak = max(histogram.values(), default=1)
+    return [
+        f"  {name:>10} {count:>10} {count / total * 100:5.1f}% "
+        + "#" * round(count / peak * width)
+        for name, count in histogram.items()
+    ]
+
+
+class MetricsRecorder:
+    """
+    ワーカーから返された対戦組の記録を集計し、必要ならJSONLに1行ずつ書き出す
+    """
+
+    def __init__(self, path: Path | str | None = None):
+        self.path = None if path is None else Path(path)
+        self._file: TextIO | None = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self.battle = BattleStats()
+        self.n_pairs = 0
+        self.seconds = 0.0
+        # ワーカーごとの(対戦組の数, バトル数, 計算時間)
+        self.workers: dict[int, list] = defaultdict(lambda: [0, 0, 0.0])
+        self.seconds_histogram: Counter = Counter()  # 計算時間(ミリ秒)の区間→対戦組の数
+        self.slowest: list[MatchupStats] = []
+
+    def __enter__(self) -> "MetricsRecorder":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add(self, stats: MatchupStats, battle_keys: tuple[tuple, tuple] | None = None):
+        self.n_pairs += 1
+        self.seconds += stats.seconds
+        self.battle.merge(stats.battle)
+        worker = self.workers[stats.worker]
+        worker[0] += 1
+        worker[1] += stats.battle.battles
+        worker[2] += stats.seconds
+        self.seconds_histogram[log2_bucket(stats.seconds * 1000)] += 1
+        self.slowest.append(stats)
+        if len(self.slowest) > N_SLOWEST * 2:
+            self.slowest.sort(key=lambda s: -s.seconds)
+            del self.slowest[N_SLOWEST:]
+        if self._file is not None:
+            self._file.write(json.dumps(stats.to_json(battle_keys)) + "\n")
+
+    def summary(self) -> str:
+        """
+        集計結果(ターン数・計算時間のヒストグラム、ワーカーごとの速度、時間のかかった対戦組)
+        """
+        lines = [
+            f"pairs: {self.n_pairs}, battles: {self.battle.battles},"
+            f" compute time: {self.seconds:.1f}s"
+        ]
+        if self.battle.battles > 0:
+            lines.append(
+                f"turns/battle: {self.battle.turns / self.battle.battles:.2f},"
+                f" heal pulses/battle: {self.battle.heal_pulses / self.battle.battles:.2f},"
+                f" leftovers/battle: {self.battle.leftovers / self.battle.battles:.2f}"
+            )
+            if self.battle.variance > 0:
+                # 分散を減らした場合の、バトル1回あたりの独立なバトルの数
+                lines.append(
+                    "effective samples/battle:"
+                    f" {self.battle.iid_variance / self.battle.variance:.2f}"
+                )
+            turn_histogram: Counter = Counter()
+            for turns, count in sorted(self.battle.turn_histogram.items()):
+                turn_histogram[log2_bucket(turns)] += count
+            lines.append("turns per battle:")
+            lines += format_histogram(turn_histogram)
+        lines.append("milliseconds per pair:")
+        lines += format_histogram(
+            dict(
+                sorted(
+                    self.seconds_histogram.items(),
+                    key=lambda item: int(item[0][2:]),
+                )
+            )
+        )
+        lines.append("workers:")
+        for pid, (n_pairs, battles, seconds) in sorted(self.workers.items()):
+            rate = n_pairs / seconds if seconds > 0 else 0.0
+            battle_rate = battles / seconds if seconds > 0 else 0.0
+            lines.append(
+                f"  pid {pid}: {n_pairs} pairs, {rate:.1f} pairs/s,"
+                f" {battle_rate:.0f} battles/s"
+            )
+        lines.append("slowest pairs:")
+        for stats in sorted(self.slowest, key=lambda s: -s.seconds)[:N_SLOWEST]:
+            turns = stats.battle.turns / max(stats.battle.battles, 1)
+            lines.append(
+                f"  {stats.pair}: {stats.seconds * 1000:.1f}ms,"
+                f" {stats.battle.battles} battles, {turns:.1f} turns/battle"
+            )
+        return "\n".join(lines)
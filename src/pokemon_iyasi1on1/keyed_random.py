@@ -0,0 +1,143 @@
+"""
+対戦組ごとに独立で再現可能な乱数列
+乱数列は(シード, 対戦組の内容, ブロック番号)から作るPhiloxの列で、バトルごとに1行(MAX_DRAWS個)を使う。
+同じ対戦組の同じバトルは、ワーカー数・タイルの大きさ・分割の仕方や、
+スカラー版(simulate)・一括版(simulate_batch)のどちらで計算しても同じ乱数を使うため、結果が一致する。
+対戦組ごとに乱数列が異なるので、組の間で誤差が相関することもない。
+
+分散を減らすため、層別化した乱数列(stratified_block_draws())も作れる。
+"""
+
+from array import array
+
+import numpy as np
+
+from pokemon_iyasi1on1.model import Poke
+
+RNG_SEED = 151  # 全体のシード
+# 1回の乱数の値の範囲。急所(1/24)とダメージ乱数(16段階)を1回で取り出し、先攻の決定(1/2)にも使う
+N_DRAW_VALUES = 24 * 16
+# 1バトルのターン数の上限
+# いやしのはどうのPPが尽きると毎ターンわるあがきの反動(最大HPの1/4)を受け、
+# 回復はたべのこし(1/16)と相手のいやしのはどう(1/2を10回)だけなので、45ターン以内に必ず決着する
+MAX_TURNS = 48
+# 1バトルで使う乱数の数の上限(1ターンに先攻の決定1回とわるあがき2回)
+MAX_DRAWS = 3 * MAX_TURNS
+BLOCK_SIZE = 100  # 1つの乱数列(ブロック)から作るバトルの数
+STRATIFIED_STREAM = 1  # 層別化した乱数列を通常の乱数列と区別するための値
+
+
+def _damage_order() -> np.ndarray:
+    """
+    乱数の値をダメージの小さい順に並べたもの
+    急所なしの乱数0〜15段階(各23通り)、急所ありの0〜15段階(各1通り)の順。
+    同じ段階では急所ありのダメージが急所なしの最大ダメージ以上なので、この順でダメージは単調増加
+    """
+    non_critical = [random_ * 24 + k for random_ in range(16) for k in range(1, 24)]
+    critical = [random_ * 24 for random_ in range(16)]
+    return np.array(non_critical + critical, dtype=np.uint16)
+
+
+DAMAGE_ORDER = _damage_order()
+
+
+def stream_key(pokes: tuple[Poke, Poke]) -> tuple[tuple[int, ...], bool]:
+    """
+    対戦組の乱数列のキー(2体のbattle_key()を順序によらないよう並べたもの)
+    戻り値: (キー, 反転したか)。反転した場合、キーの順序はpokes[1], pokes[0]
+    """
+    keys = [poke.battle_key() for poke in pokes]
+    flipped = keys[1] < keys[0]
+    if flipped:
+        keys.reverse()
+    return keys[0] + keys[1], flipped
+
+
+def block_draws(key: tuple[int, ...], block: int, seed: int = RNG_SEED) -> np.ndarray:
+    """
+    ブロックの乱数[バトル, MAX_DRAWS]。各値は0以上N_DRAW_VALUES未満
+    """
+    rng = np.random.Generator(
+        np.random.Philox(np.random.SeedSequence([seed, *key, block]))
+    )
+    return rng.integers(0, N_DRAW_VALUES, (BLOCK_SIZE, MAX_DRAWS), dtype=np.uint16)
+
+
+def stratified_block_draws(
+    key: tuple[int, ...], block: int, seed: int = RNG_SEED
+) -> np.ndarray:
+    """
+    層別化したブロックの乱数[バトル, MAX_DRAWS]
+    前半のバトルは、乱数の位置ごとにダメージの順(DAMAGE_ORDER)の一様乱数をバトル数で等分した
+    各区間から1つずつ取る(ラテン超方格法)。急所の有無とダメージ乱数の段階は、ほぼ確率どおりの割合で現れる。
+    後半のバトルは前半の対称(ダメージの大小を反転した値)で、前半と負の相関を持つ(対称変数法)。
+    各バトルの乱数の分布はblock_draws()と同じ(位置ごとに独立で、0以上N_DRAW_VALUES未満の一様)
+    """
+    rng = np.random.Generator(
+        np.random.Philox(np.random.SeedSequence([seed, *key, block, STRATIFIED_STREAM]))
+    )
+    half = BLOCK_SIZE // 2
+    # 位置ごとに区間の並びをランダムに入れ替える
+    strata = rng.permuted(np.tile(np.arange(half), (MAX_DRAWS, 1)), axis=1).T
+    ranks = ((strata + rng.random((half, MAX_DRAWS))) * (N_DRAW_VALUES / half)).astype(
+        np.int64
+    )
+    ranks = np.concatenate([ranks, N_DRAW_VALUES - 1 - ranks])
+    return DAMAGE_ORDER[ranks]
+
+
+def battle_draws(
+    key: tuple[int, ...],
+    start: int,
+    count: int,
+    seed: int = RNG_SEED,
+    stratified: bool = False,
+) -> np.ndarray:
+    """
+    対戦組のstart番目からcount回のバトルの乱数[バトル, MAX_DRAWS]
+    stratified: stratified_block_draws()の乱数を使う
+    """
+    if count == 0:
+        return np.zeros((0, MAX_DRAWS), dtype=np.uint16)
+    make_block = stratified_block_draws if stratified else block_draws
+    first = start // BLOCK_SIZE
+    last = (start + count - 1) // BLOCK_SIZE
+    draws = np.concatenate(
+        [make_block(key, block, seed) for block in range(first, last + 1)]
+    )
+    offset = start - first * BLOCK_SIZE
+    return draws[offset : offset + count]
+
+
+class KeyedDraws:
+    """
+    battle_draws()の乱数をバトルごとに順に取り出す
+    simulate()にrandom.Randomの代わりに渡す(randrange()だけを持つ)
+    """
+
+    __slots__ = ("_values", "_cursor", "_end")
+
+    def __init__(self, draws: np.ndarray):
+        # 1要素ずつ取り出すため、NumPy配列よりインデックスアクセスの速いarrayにする
+        self._values = array(
+            "H", np.ascontiguousarray(draws, dtype=np.uint16).tobytes()
+        )
+        self._cursor = 0
+        self._end = 0
+
+    def start_battle(self, battle: int):
+        """
+        battle番目(draws内の行番号)のバトルの乱数を使い始める
+        """
+        self._cursor = battle * MAX_DRAWS
+        self._end = self._cursor + MAX_DRAWS
+
+    def randrange(self, start: int, stop: int) -> int:
+        """
+        [start, stop)の一様乱数。stop - startはN_DRAW_VALUESの約数であること
+        """
+        if self._cursor >= self._end:
+            raise RuntimeError("A battle used more than MAX_DRAWS random values.")
+        value = self._values[self._cursor]
+        self._cursor += 1
+        return start + value % (stop - start)
@@ -0,0 +1,269 @@
+"""
+確定数(何発目のわるあがきでひんしにするか)の確率分布
+攻撃側が防御側をわるあがきで攻撃し続けるときの、防御側のHPの確率分布をターンごとに更新し、
+各ターン・各攻撃回数でひんしにする確率を求める。ダメージは32通りの分布の畳み込みで、
+攻撃の合間の回復(たべのこし、いやしのはどう)と攻撃側の反動も反映する。
+多数の組を配列でまとめて計算するため、数千組でも対話的に使える速さで求まる。
+
+バトルのルールはsimulate()と同じだが、防御側のわるあがき(攻撃側へのダメージと防御側の反動)は考えない。
+防御側の行動は、PPがある間の攻撃側へのいやしのはどうだけとする。
+このため攻撃側のHPは乱数によらず決まり、防御側のHPの分布だけを持てばよい。
+同速の場合は攻撃側が先に動く(相手のいやしのはどうより前に反動を受ける)とする。
+"""
+
+import argparse
+import csv
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import damage_outcomes_array
+from pokemon_iyasi1on1.db import get_species
+from pokemon_iyasi1on1.generate_win_table import get_breedings
+from pokemon_iyasi1on1.keyed_random import MAX_TURNS
+from pokemon_iyasi1on1.model import HEAL_PULSE_MAX_PP, Poke, PokeStrategy
+from pokemon_iyasi1on1.simulate_battle import outcome_probabilities
+from pokemon_iyasi1on1.tables import PokeTable
+
+N_HITS = 4  # 表示する確定数の最大
+
+
+@dataclass
+class KnockoutDistribution:
+    """
+    組ごとの、防御側をひんしにするまでの分布
+    """
+
+    turns: np.ndarray  # [組, ターン - 1] そのターンにひんしにする確率
+    hits: np.ndarray  # [組, k - 1] k発目のわるあがきでひんしにする確率
+    attacker_faint: np.ndarray  # [組] ひんしにする前に攻撃側が反動でひんしになる確率
+
+    def within_hits(self, n_hits: int) -> np.ndarray:
+        """
+        n_hits発以内にひんしにする確率[組]
+        """
+        return self.hits[:, :n_hits].sum(axis=1)
+
+    def within_turns(self, n_turns: int) -> np.ndarray:
+        """
+        n_turnsターン以内にひんしにする確率[組]
+        """
+        return self.turns[:, :n_turns].sum(axis=1)
+
+
+def _heal(dist: np.ndarray, heal: np.ndarray, max_hp: np.ndarray) -> np.ndarray:
+    """
+    HPの分布dist[組, HP]の各HP(0を除く)をheal回復させる(最大HPで打ち切る)
+    """
+    n_pairs, n_hp = dist.shape
+    hps = np.arange(n_hp)
+    targets = np.minimum(hps + heal[:, np.newaxis], max_hp[:, np.newaxis])
+    # HP 0(ひんし)の確率は常に0なので、そのまま0に置く
+    targets[:, 0] = 0
+    flat = targets + np.arange(n_pairs)[:, np.newaxis] * n_hp
+    return np.bincount(
+        flat.ravel(), weights=dist.ravel(), minlength=n_pairs * n_hp
+    ).reshape(n_pairs, n_hp)
+
+
+def _damage_pmfs(damages: np.ndarray) -> tuple[np.ndarray, list[tuple]]:
+    """
+    組ごとのダメージ[組, outcome_index]を、同じ分布の組にまとめる
+    戻り値: (組ごとの分布のインデックス, 分布ごとの(ダメージの値, 確率))
+    """
+    group_damages, groups = np.unique(damages, axis=0, return_inverse=True)
+    probs = outcome_probabilities()
+    pmfs = []
+    for outcomes in group_damages:
+        values, inverse = np.unique(outcomes, return_inverse=True)
+        pmfs.append((values.tolist(), np.bincount(inverse, weights=probs).tolist()))
+    return groups.reshape(-1), pmfs
+
+
+def _struggle(
+    dist: np.ndarray, groups: np.ndarray, pmfs: list[tuple]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    HPの分布dist[組, HP]にわるあがきのダメージを与える
+    groups, pmfs: _damage_pmfs()の戻り値(groupsはdistの行に対応)
+    戻り値: (ひんしにならなかった場合のHPの分布, ひんしになる確率[組])
+    """
+    n_pairs, n_hp = dist.shape
+    # 被弾後のHPがhpになるのは、被弾前のHPがhp + ダメージの場合
+    # 同じ分布の組をまとめ、ダメージの値ごとにずらした分布を足し合わせる
+    max_damage = max(pmfs[group][0][-1] for group in np.unique(groups))
+    padded = np.zeros((n_pairs, n_hp + max_damage))
+    padded[:, :n_hp] = dist
+    after = np.empty_like(dist)
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    bounds = np.flatnonzero(np.diff(sorted_groups)) + 1
+    for rows in np.split(order, bounds):
+        sub = padded[rows]
+        values, weights = pmfs[groups[rows[0]]]
+        acc = np.zeros((len(rows), n_hp))
+        for value, weight in zip(values, weights):
+            acc += weight * sub[:, value : value + n_hp]
+        after[rows] = acc
+    after[:, 0] = 0.0
+    # 差で求めるため、誤差で負にならないよう0で切る
+    return after, np.maximum(dist.sum(axis=1) - after.sum(axis=1), 0.0)
+
+
+def knockout_distribution(
+    attackers: PokeTable,
+    defenders: PokeTable,
+    attacker_hp: np.ndarray | None = None,
+    defender_hp: np.ndarray | None = None,
+    attacker_pp: np.ndarray | None = None,
+    defender_pp: np.ndarray | None = None,
+    max_turns: int = MAX_TURNS,
+) -> KnockoutDistribution:
+    """
+    attackers[i]がdefenders[i]をわるあがきでひんしにするまでの分布
+    attacker_hp, defender_hp, attacker_pp, defender_pp: 開始時のHP・いやしのはどうのPP
+        省略時はreset()後と同じ(HPは最大、PPは戦略型で決まる)
+    """
+    n_pairs = len(attackers)
+    if len(defenders) != n_pairs:
+        raise ValueError("attackers and defenders must have the same length.")
+
+    def initial_pp(pokes: PokeTable) -> np.ndarray:
+        return np.where(
+            pokes.column("strategy") == PokeStrategy.VEST.value, 0, HEAL_PULSE_MAX_PP
+        )
+
+    x_max_hp = attackers.column("max_hp").astype(np.int64)
+    y_max_hp = defenders.column("max_hp").astype(np.int64)
+    x_hp = x_max_hp.copy() if attacker_hp is None else np.array(attacker_hp, np.int64)
+    y_hp = y_max_hp.copy() if defender_hp is None else np.array(defender_hp, np.int64)
+    x_pp = initial_pp(attackers) if attacker_pp is None else np.array(attacker_pp)
+    y_pp = initial_pp(defenders) if defender_pp is None else np.array(defender_pp)
+
+    damages = damage_outcomes_array(
+        attackers.column("level"), attackers.column("a"), defenders.column("b")
+    )
+    groups, pmfs = _damage_pmfs(damages)
+    # 反動(四捨五入)、いやしのはどうの回復量(切り上げ)、たべのこしの回復量(切り捨て)
+    x_recoil = (x_max_hp + 2) // 4
+    x_heal = -(-x_max_hp // 2)
+    y_heal = -(-y_max_hp // 2)
+    x_leftover = np.where(
+        attackers.column("strategy") == PokeStrategy.LEFTOVER.value, x_max_hp // 16, 0
+    )
+    y_leftover = np.where(
+        defenders.column("strategy") == PokeStrategy.LEFTOVER.value, y_max_hp // 16, 0
+    )
+    attacker_first = attackers.column("s") >= defenders.column("s")
+
+    turns = np.zeros((n_pairs, max_turns))
+    hits = np.zeros((n_pairs, max_turns))
+    attacker_faint = np.zeros(n_pairs)
+    n_hits = np.zeros(n_pairs, dtype=np.int64)
+    # 処理中の組だけの、防御側のHPの分布[組, HP]
+    active = np.flatnonzero(y_hp > 0)
+    dist = np.zeros((len(active), int(y_max_hp.max(initial=0)) + 1))
+    dist[np.arange(len(active)), y_hp[active]] = 1.0
+
+    for turn in range(max_turns):
+        if len(active) == 0:
+            break
+        # 攻撃側が先攻の組はstep 0、後攻の組はstep 2に動き、防御側はstep 1に動く
+        for step in range(3):
+            if step == 1:
+                # 防御側のいやしのはどう(攻撃側を回復する)
+                pairs = active[y_pp[active] > 0]
+                x_hp[pairs] = np.minimum(x_max_hp[pairs], x_hp[pairs] + x_heal[pairs])
+                y_pp[pairs] -= 1
+                continue
+            # 攻撃側は、先攻ならstep 0、後攻ならstep 2に動く
+            moving = attacker_first[active] == (step == 0)
+            healing = moving & (x_pp[active] > 0)
+            if np.any(healing):
+                # 攻撃側のいやしのはどう(防御側を回復する)
+                dist[healing] = _heal(
+                    dist[healing],
+                    y_heal[active[healing]],
+                    y_max_hp[active[healing]],
+                )
+                x_pp[active[healing]] -= 1
+            struggling = moving & (x_pp[active] == 0) & ~healing
+            if np.any(struggling):
+                pairs = active[struggling]
+                dist[struggling], knocked_out = _struggle(
+                    dist[struggling], groups[pairs], pmfs
+                )
+                turns[pairs, turn] += knocked_out
+                hits[pairs, n_hits[pairs]] += knocked_out
+                n_hits[pairs] += 1
+                x_hp[pairs] = np.maximum(0, x_hp[pairs] - x_recoil[pairs])
+                fainted = struggling.copy()
+                fainted[struggling] = x_hp[pairs] == 0
+                attacker_faint[active[fainted]] += dist[fainted].sum(axis=1)
+                dist[fainted] = 0.0
+        # ターン終了処理(たべのこし)
+        x_hp[active] = np.minimum(x_max_hp[active], x_hp[active] + x_leftover[active])
+        dist = _heal(dist, y_leftover[active], y_max_hp[active])
+        # ひんしにするか、攻撃側がひんしになって決着した組を除く
+        remaining = dist.sum(axis=1) > 0
+        active = active[remaining]
+        dist = dist[remaining]
+    return KnockoutDistribution(
+        turns=turns,
+        hits=hits[:, : max(int(n_hits.max(initial=0)), 1)],
+        attacker_faint=attacker_faint,
+    )
+
+
+def knockout_distribution_of_pokes(
+    pairs: list[tuple[Poke, Poke]], max_turns: int = MAX_TURNS
+) -> KnockoutDistribution:
+    """
+    (攻撃側, 防御側)のPokeの組について、現在のHP・PPから始めたknockout_distribution()
+    """
+    attackers = [attacker for attacker, _ in pairs]
+    defenders = [defender for _, defender in pairs]
+    return knockout_distribution(
+        PokeTable.from_pokes(attackers),
+        PokeTable.from_pokes(defenders),
+        attacker_hp=np.array([poke.current_hp for poke in attackers]),
+        defender_hp=np.array([poke.current_hp for poke in defenders]),
+        attacker_pp=np.array([poke.heal_pulse_pp for poke in attackers]),
+        defender_pp=np.array([poke.heal_pulse_pp for poke in defenders]),
+        max_turns=max_turns,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="構築が全構築をわるあがきでひんしにするまでの分布をCSVで出力する"
+    )
+    parser.add_argument("attacker", type=int, help="攻撃側の構築のインデックス")
+    parser.add_argument(
+        "--defend", action="store_true", help="全構築から攻撃される側として出力する"
+    )
+    parser.add_argument("--n-hits", type=int, default=N_HITS)
+    args = parser.parse_args()
+    breedings = get_breedings()
+    pokes = PokeTable.from_breedings(breedings)
+    others = np.arange(len(pokes))
+    this = np.full(len(pokes), args.attacker)
+    attackers, defenders = (others, this) if args.defend else (this, others)
+    result = knockout_distribution(pokes[attackers], pokes[defenders])
+    fieldnames = ["index", "enemy"]
+    fieldnames += [f"ko_{k + 1}" for k in range(args.n_hits)]
+    fieldnames += ["ko_total", "attacker_faint"]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+    writer.writeheader()
+    for idx, breeding in enumerate(breedings):
+        row = {"index": idx, "enemy": get_species(breeding.no).name}
+        for k in range(args.n_hits):
+            row[f"ko_{k + 1}"] = f"{result.within_hits(k + 1)[idx]:.4f}"
+        row["ko_total"] = f"{result.hits[idx].sum():.4f}"
+        row["attacker_faint"] = f"{result.attacker_faint[idx]:.4f}"
+        writer.writerow(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from dataclasses import dataclass
 from enum import Enum
 
 HEAL_PULSE_MAX_PP = 10  # いやしのはどうの最大PP
+STRUGGLE_POWER = 50  # わるあがきの威力
 
 
 class PokeStrategy(Enum):
@@ -13,7 +14,7 @@ class PokeStrategy(Enum):
     LEFTOVER = 1  # たべのこし
 
 
-@dataclass
+@dataclass(slots=True)
 class Poke:
     level: int
     max_hp: int
@@ -35,8 +36,15 @@ class Poke:
             case _:
                 self.heal_pulse_pp = HEAL_PULSE_MAX_PP
 
+    def battle_key(self) -> tuple[int, int, int, int, int, int]:
+        """
+        バトルの結果に関わるパラメータの組を返す
+        この組が等しいPoke同士は、バトル上区別できない
+        """
+        return (self.level, self.max_hp, self.a, self.b, self.s, self.strategy.value)
+
 
-@dataclass
+@dataclass(slots=True)
 class PokeSpecies:
     no: int  # 図鑑No
     name: str  # 名前
@@ -53,7 +61,7 @@ class NatureTarget(Enum):
     S = 3
 
 
-@dataclass
+@dataclass(slots=True)
 class PokeBreeding:
     """
     育成に関わる値
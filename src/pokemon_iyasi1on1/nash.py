@@ -0,0 +1,236 @@
+"""
+対称ゼロ和ゲームの混合戦略ナッシュ均衡を求める
+利得行列payoffs[自分, 相手]は交代行列(payoffs.T == -payoffs)を想定する。
+反復法(乗算型重み更新・後悔マッチング・仮想プレイ)は行列×ベクトルの積だけで更新するため、
+大きな行列でも高速に解ける。収束の指標として搾取可能性(exploitability)を求め、
+許容値以下になったら打ち切る。必要ならscipyによる線形計画法で厳密に解く。
+"""
+
+import argparse
+import warnings
+from dataclasses import dataclass
+from enum import Enum
+
+import numpy as np
+
+from pokemon_iyasi1on1.win_table_file import load_win_table
+
+# ウォームスタート時、初期戦略をこの回数だけ反復した結果とみなす
+WARM_START_WEIGHT = 100
+
+
+class NashMethod(Enum):
+    """
+    均衡の計算方法
+    """
+
+    MULTIPLICATIVE_WEIGHTS = "multiplicative_weights"  # 乗算型重み更新(楽観的)
+    REGRET_MATCHING = "regret_matching"  # 後悔マッチング(Regret Matching+)
+    FICTITIOUS_PLAY = "fictitious_play"  # 仮想プレイ
+    LINEAR_PROGRAM = "linear_program"  # 線形計画法(scipyが必要)
+
+
+@dataclass
+class NashResult:
+    strategy: np.ndarray  # 混合戦略(各構築の選出確率)
+    exploitability: float  # 搾取可能性。0なら厳密な均衡
+    n_iterations: int  # 反復回数(線形計画法では0)
+    method: NashMethod
+    converged: bool  # 搾取可能性が許容値以下になったか(線形計画法では常にTrue)
+
+
+def exploitability(payoffs: np.ndarray, strategy: np.ndarray) -> float:
+    """
+    両者がstrategyを使うときの搾取可能性
+    相手の最適応答に対する自分の損失と、自分の最適応答による相手の損失の和で、
+    strategyが均衡なら0、そうでなければ正の値になる
+    """
+    return float(np.max(payoffs @ strategy) - np.min(strategy @ payoffs))
+
+
+def _iterate(
+    payoffs: np.ndarray,
+    method: NashMethod,
+    warm_start: np.ndarray | None,
+    max_iterations: int,
+    tolerance: float,
+    check_interval: int,
+    learning_rate: float,
+) -> tuple[np.ndarray, int]:
+    """
+    自己対戦で反復し、平均戦略を返す
+    戻り値: (平均戦略, 反復回数)
+    """
+    n = payoffs.shape[0]
+    uniform = np.full(n, 1.0 / n)
+    # warm_startはWARM_START_WEIGHT回反復した結果とみなす
+    offset = 0 if warm_start is None else WARM_START_WEIGHT
+    strategy = uniform if warm_start is None else warm_start
+    average = strategy.copy()
+    match method:
+        case NashMethod.MULTIPLICATIVE_WEIGHTS:
+            # サポート外の構築も選ばれうるように一様分布を少し混ぜる
+            log_weights = np.log(0.99 * strategy + 0.01 * uniform)
+            previous_values = np.zeros(n)
+            total_weight = float(offset + 1)
+        case NashMethod.REGRET_MATCHING:
+            regrets = strategy * offset
+            total_weight = offset * (offset + 1) / 2 + 1.0
+        case NashMethod.FICTITIOUS_PLAY:
+            total_weight = float(offset + 1)
+        case _:
+            raise ValueError(f"{method} is not an iterative method.")
+    for iteration in range(1, max_iterations + 1):
+        values = payoffs @ strategy  # 各構築の、現在の戦略に対する期待利得
+        match method:
+            case NashMethod.MULTIPLICATIVE_WEIGHTS:
+                # 前回の利得を次回の予測として加える(楽観的更新)
+                log_weights += learning_rate * (2 * values - previous_values)
+                previous_values = values
+                log_weights -= log_weights.max()
+                strategy = np.exp(log_weights)
+                strategy /= strategy.sum()
+                weight = 1.0
+            case NashMethod.REGRET_MATCHING:
+                regrets = np.maximum(regrets + values - strategy @ values, 0.0)
+                regret_sum = regrets.sum()
+                strategy = regrets / regret_sum if regret_sum > 0 else uniform
+                # 後の反復ほど重く平均する(線形平均)
+                weight = float(offset + iteration)
+            case NashMethod.FICTITIOUS_PLAY:
+                # 平均戦略への最適応答
+                strategy = np.zeros(n)
+                strategy[np.argmax(payoffs @ average)] = 1.0
+                weight = 1.0
+        total_weight += weight
+        average += (strategy - average) * (weight / total_weight)
+        if iteration % check_interval == 0:
+            if exploitability(payoffs, average) <= tolerance:
+                return average, iteration
+    return average, max_iterations
+
+
+def linear_program(payoffs: np.ndarray) -> np.ndarray:
+    """
+    線形計画法で均衡戦略を求める(scipyが必要)
+    max v s.t. payoffs.T @ x >= v, sum(x) = 1, x >= 0
+    """
+    try:
+        from scipy.optimize import linprog
+    except ImportError as e:
+        raise ImportError("linear_program requires scipy.") from e
+    n = payoffs.shape[0]
+    # 変数は[x_0, ..., x_{n-1}, v]
+    c = np.zeros(n + 1)
+    c[-1] = -1.0
+    a_ub = np.hstack([-payoffs.T, np.ones((n, 1))])
+    b_ub = np.zeros(n)
+    a_eq = np.zeros((1, n + 1))
+    a_eq[0, :n] = 1.0
+    bounds = [(0, None)] * n + [(None, None)]
+    res = linprog(c, A_ub=a_ub, b_ub=b_ub, A_eq=a_eq, b_eq=[1.0], bounds=bounds)
+    if not res.success:
+        raise RuntimeError(f"linear program failed: {res.message}")
+    strategy = np.maximum(res.x[:n], 0.0)
+    return strategy / strategy.sum()
+
+
+def solve_symmetric_zero_sum(
+    payoffs: np.ndarray,
+    method: NashMethod = NashMethod.REGRET_MATCHING,
+    tolerance: float = 1e-3,
+    max_iterations: int = 100000,
+    warm_start: np.ndarray | None = None,
+    lp_fallback: bool = False,
+    check_interval: int = 100,
+    learning_rate: float = 1.0,
+) -> NashResult:
+    """
+    対称ゼロ和ゲームの均衡戦略を求める
+    tolerance: 搾取可能性がこれ以下になったら反復を打ち切る
+    warm_start: 前回の均衡戦略。勝率表を更新した後の再計算では、これを初期値にすると速く収束する
+        すでにtolerance以下の均衡なら反復しない
+    lp_fallback: max_iterations回で収束しなかった場合に線形計画法で解き直す。
+        解き直さない場合は警告を出し、戻り値のconvergedをFalseにする
+    """
+    payoffs = np.asarray(payoffs, dtype=np.float64)
+    n = payoffs.shape[0]
+    if payoffs.shape != (n, n):
+        raise ValueError("payoffs must be a square matrix.")
+    if method == NashMethod.LINEAR_PROGRAM:
+        strategy = linear_program(payoffs)
+        return NashResult(strategy, exploitability(payoffs, strategy), 0, method, True)
+    if warm_start is not None:
+        warm_start = np.maximum(np.asarray(warm_start, dtype=np.float64), 0.0)
+        if warm_start.shape != (n,):
+            raise ValueError("warm_start must have the same size as payoffs.")
+        warm_start /= warm_start.sum()
+        gap = exploitability(payoffs, warm_start)
+        if gap <= tolerance:
+            return NashResult(warm_start, gap, 0, method, True)
+    strategy, n_iterations = _iterate(
+        payoffs,
+        method,
+        warm_start,
+        max_iterations,
+        tolerance,
+        check_interval,
+        learning_rate,
+    )
+    gap = exploitability(payoffs, strategy)
+    if gap > tolerance and lp_fallback:
+        strategy = linear_program(payoffs)
+        return NashResult(
+            strategy,
+            exploitability(payoffs, strategy),
+            n_iterations,
+            NashMethod.LINEAR_PROGRAM,
+            True,
+        )
+    if gap > tolerance:
+        warnings.warn(
+            f"{method.value} stopped after {n_iterations} iterations with"
+            f" exploitability {gap:.3g} above the tolerance {tolerance:.3g}."
+        )
+    return NashResult(strategy, gap, n_iterations, method, gap <= tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("win_table", help="勝率表(.iwt)")
+    parser.add_argument(
+        "--method",
+        choices=[method.value for method in NashMethod],
+        default=NashMethod.REGRET_MATCHING.value,
+    )
+    parser.add_argument("--tolerance", type=float, default=1e-3)
+    parser.add_argument("--max-iterations", type=int, default=100000)
+    parser.add_argument("--warm-start", help="前回の均衡戦略(.npy)")
+    parser.add_argument("--lp-fallback", action="store_true")
+    parser.add_argument("--output", help="均衡戦略の保存先(.npy)")
+    args = parser.parse_args()
+    win_table = load_win_table(args.win_table)
+    result = solve_symmetric_zero_sum(
+        win_table.payoff_matrix(),
+        method=NashMethod(args.method),
+        tolerance=args.tolerance,
+        max_iterations=args.max_iterations,
+        warm_start=np.load(args.warm_start) if args.warm_start else None,
+        lp_fallback=args.lp_fallback,
+    )
+    print(
+        f"method: {result.method.value}, iterations: {result.n_iterations},"
+        f" exploitability: {result.exploitability:.3g},"
+        f" converged: {result.converged}"
+    )
+    if args.output:
+        np.save(args.output, result.strategy)
+    breedings = win_table.breedings()
+    for idx in np.argsort(-result.strategy):
+        if result.strategy[idx] < 1e-3:
+            break
+        print(f"{result.strategy[idx] * 100:.2f}%, {breedings[idx]}")
+
+
+if __name__ == "__main__":
+    main()
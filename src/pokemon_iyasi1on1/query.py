@@ -0,0 +1,434 @@
+"""
+勝率表への問い合わせ
+勝率表を1回だけ読み込み、1組の勝率・1行(ある構築の全構築に対する勝率)・混合戦略への最適応答を返す。
+表にない構築(または表で未計算のマス)はその場で計算し、結果をLRUキャッシュに保持する。
+1行をまとめて計算する場合は、乱数によらず勝敗が決まる組をdecided_winners()で一括で求め、
+残りの組だけをワーカープロセスに分けて計算する。
+Python APIのMatchupQueryと、同じ問い合わせをJSONで受け付けるHTTPサーバからなる。
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import pool as mp_pool
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage import calc_status
+from pokemon_iyasi1on1.damage_table import load_damage_table
+from pokemon_iyasi1on1.db import get_species_by_name
+from pokemon_iyasi1on1.generate_win_table import SimulationMethod, match_pokes
+from pokemon_iyasi1on1.model import NatureTarget, Poke, PokeBreeding, PokeStrategy
+from pokemon_iyasi1on1.simulate_battle import decided_winners
+from pokemon_iyasi1on1.tables import POKE_COLUMNS, PokeTable
+from pokemon_iyasi1on1.win_table_file import WinTable, load_win_table
+
+CACHE_SIZE = 65536  # その場で計算した勝率を保持する組の数
+ROW_CACHE_SIZE = 256  # その場で計算した表にない構築の行を保持する数
+SIMULATE_CHUNK = 16  # ワーカープロセスに1回で渡す組の数
+N_TOP = 10  # 最適応答として返す構築の数(既定)
+
+
+def breeding_from_json(data: dict) -> PokeBreeding:
+    """
+    JSONの育成(PokeBreedingの各フィールド。noの代わりにnameも可、列挙型は名前)をPokeBreedingにする
+    """
+    data = dict(data)
+    if "name" in data:
+        data["no"] = get_species_by_name(data.pop("name")).no
+    data["nature_up"] = NatureTarget[data["nature_up"]]
+    data["nature_down"] = NatureTarget[data["nature_down"]]
+    data["strategy"] = PokeStrategy[data["strategy"]]
+    return PokeBreeding(**data)
+
+
+def breeding_to_json(breeding: PokeBreeding) -> dict:
+    return {
+        "no": breeding.no,
+        "level": breeding.level,
+        "ev_hp": breeding.ev_hp,
+        "ev_a": breeding.ev_a,
+        "ev_b": breeding.ev_b,
+        "ev_s": breeding.ev_s,
+        "iv_hp": breeding.iv_hp,
+        "iv_a": breeding.iv_a,
+        "iv_b": breeding.iv_b,
+        "iv_s": breeding.iv_s,
+        "nature_up": breeding.nature_up.name,
+        "nature_down": breeding.nature_down.name,
+        "strategy": breeding.strategy.name,
+    }
+
+
+def poke_from_key(key: tuple[int, ...]) -> Poke:
+    """
+    Poke.battle_key()からPokeを作る
+    """
+    return PokeTable.from_columns(
+        {name: np.array([value]) for name, value in zip(POKE_COLUMNS, key)}
+    )[0]
+
+
+def keys_table(keys: list[tuple[int, ...]]) -> PokeTable:
+    """
+    Poke.battle_key()の並びからPokeTableを作る
+    """
+    array = np.array(keys, dtype=np.int64).reshape(-1, len(POKE_COLUMNS))
+    return PokeTable.from_columns(
+        {name: array[:, idx] for idx, name in enumerate(POKE_COLUMNS)}
+    )
+
+
+def simulate_keys(
+    pairs: list[tuple[tuple[int, ...], tuple[int, ...]]], method: SimulationMethod
+) -> list[float]:
+    """
+    battle_key()の組(a, b)ごとにaの勝率を計算する(ワーカープロセスで実行)
+    """
+    return [
+        match_pokes((poke_from_key(key_a), poke_from_key(key_b)), method)[0]
+        for key_a, key_b in pairs
+    ]
+
+
+class MatchupQuery:
+    """
+    勝率表への問い合わせ
+    構築は勝率表のインデックス(int)かPokeBreedingで指定する
+    """
+
+    def __init__(
+        self,
+        win_table: WinTable,
+        method: SimulationMethod = SimulationMethod.MARKOV_CHAIN,
+        cache_size: int = CACHE_SIZE,
+        pool: mp_pool.Pool | None = None,
+    ):
+        """
+        method: 表にない組の勝率の計算方法
+        pool: 1行をまとめて計算するときに使うワーカープロセスのプール
+            (load_damage_tableで初期化したもの)。Noneならこのプロセスで順に計算する
+        """
+        self.win_table = win_table
+        self.method = method
+        self.pool = pool
+        self.n = win_table.n_breedings
+        self.breedings = win_table.breedings()
+        self.keys = [
+            tuple(key)
+            for key in PokeTable.from_breedings(self.breedings).battle_keys().tolist()
+        ]
+        self.index_by_key: dict[tuple[int, ...], int] = {}
+        for idx, key in enumerate(self.keys):
+            self.index_by_key.setdefault(key, idx)
+        self._simulate_cached = functools.lru_cache(maxsize=cache_size)(
+            self._simulate_canonical
+        )
+        self._row_cached = functools.lru_cache(maxsize=ROW_CACHE_SIZE)(
+            self._simulate_row
+        )
+
+    def _simulate_canonical(
+        self, key_a: tuple[int, ...], key_b: tuple[int, ...]
+    ) -> float:
+        return match_pokes((poke_from_key(key_a), poke_from_key(key_b)), self.method)[0]
+
+    def simulate(self, key_a: tuple[int, ...], key_b: tuple[int, ...]) -> float:
+        """
+        battle_key()がkey_aの構築の、key_bの構築に対する勝率をその場で計算する(LRUキャッシュ付き)
+        """
+        if key_a == key_b:
+            return 0.5
+        if key_b < key_a:
+            return 1.0 - self._simulate_cached(key_b, key_a)
+        return self._simulate_cached(key_a, key_b)
+
+    def simulate_many(
+        self, key_a: tuple[int, ...], keys_b: list[tuple[int, ...]]
+    ) -> np.ndarray:
+        """
+        battle_key()がkey_aの構築の、keys_bの各構築に対する勝率をまとめて計算する
+        乱数によらず勝敗が決まる組はdecided_winners()で一括で求め、残りの組だけをシミュレーションする
+        (poolがあればワーカープロセスに分ける)
+        """
+        winrates = np.full(len(keys_b), 0.5)
+        others = [k for k, key_b in enumerate(keys_b) if key_b != key_a]
+        if len(others) == 0:
+            return winrates
+        winners = decided_winners(
+            keys_table([key_a] * len(others)),
+            keys_table([keys_b[k] for k in others]),
+        )
+        remaining = []
+        for k, winner in zip(others, winners.tolist()):
+            if winner >= 0:
+                winrates[k] = 1.0 if winner == 0 else 0.0
+            else:
+                remaining.append(k)
+        pairs = [(key_a, keys_b[k]) for k in remaining]
+        if self.pool is None:
+            results = simulate_keys(pairs, self.method)
+        else:
+            chunks = [
+                pairs[start : start + SIMULATE_CHUNK]
+                for start in range(0, len(pairs), SIMULATE_CHUNK)
+            ]
+            simulate_chunk = functools.partial(simulate_keys, method=self.method)
+            results = [
+                winrate
+                for chunk in self.pool.map(simulate_chunk, chunks)
+                for winrate in chunk
+            ]
+        winrates[remaining] = results
+        return winrates
+
+    def _simulate_row(self, key_a: tuple[int, ...]) -> np.ndarray:
+        row = self.simulate_many(key_a, self.keys)
+        row.flags.writeable = False
+        return row
+
+    def cache_info(self):
+        return self._simulate_cached.cache_info()
+
+    def row_cache_info(self):
+        return self._row_cached.cache_info()
+
+    def resolve(self, breeding: int | PokeBreeding) -> tuple[int | None, tuple]:
+        """
+        構築の指定を(勝率表のインデックス(表になければNone), battle_key())にする
+        表にない育成でも、実数値・戦略型が同じ構築が表にあればそのインデックスを返す
+        """
+        if isinstance(breeding, (int, np.integer)):
+            if not 0 <= breeding < self.n:
+                raise IndexError(f"Breeding index {breeding} out of range.")
+            return int(breeding), self.keys[breeding]
+        key = calc_status(breeding).battle_key()
+        return self.index_by_key.get(key), key
+
+    def _table_winrate(self, i: int, j: int) -> float:
+        # 勝率表はメモリマップのまま、参照するマスだけを読む
+        return self.win_table.winrate(i, j)
+
+    def winrate(self, a: int | PokeBreeding, b: int | PokeBreeding) -> float:
+        """
+        aのbに対する勝率
+        """
+        i, key_a = self.resolve(a)
+        j, key_b = self.resolve(b)
+        if i is not None and j is not None:
+            winrate = self._table_winrate(i, j)
+            if not np.isnan(winrate):
+                return winrate
+        return self.simulate(key_a, key_b)
+
+    def _table_row(self, i: int) -> np.ndarray:
+        n = self.n
+        lower = np.arange(i)
+        # (j, i) (j < i)の上三角での位置
+        lower_idx = lower * (2 * n - lower - 1) // 2 + (i - lower - 1)
+        upper_start = i * (2 * n - i - 1) // 2
+        upper_idx = np.arange(upper_start, upper_start + n - i - 1)
+        return np.concatenate(
+            [
+                1.0 - self.win_table.packed_winrates_at(lower_idx),
+                [0.5],
+                self.win_table.packed_winrates_at(upper_idx),
+            ]
+        )
+
+    def row(self, a: int | PokeBreeding) -> np.ndarray:
+        """
+        aの、勝率表の全構築に対する勝率の配列
+        """
+        i, key_a = self.resolve(a)
+        if i is None:
+            return self._row_cached(key_a).copy()
+        row = self._table_row(i)
+        missing = np.flatnonzero(np.isnan(row))
+        if len(missing) > 0:
+            row[missing] = self.simulate_many(
+                key_a, [self.keys[j] for j in missing.tolist()]
+            )
+        return row
+
+    def strategy_vector(self, strategy: np.ndarray | dict[int, float]) -> np.ndarray:
+        """
+        混合戦略(全構築の選出確率の配列、または{インデックス: 確率})を正規化した配列にする
+        """
+        if isinstance(strategy, dict):
+            vector = np.zeros(self.n)
+            for idx, prob in strategy.items():
+                if not 0 <= int(idx) < self.n:
+                    raise IndexError(f"Breeding index {idx} out of range.")
+                vector[int(idx)] += prob
+        else:
+            vector = np.asarray(strategy, dtype=np.float64)
+        if vector.shape != (self.n,) or np.any(vector < 0) or vector.sum() <= 0:
+            raise ValueError(
+                "strategy must be non-negative probabilities of breedings."
+            )
+        return vector / vector.sum()
+
+    def expected_winrates(self, strategy: np.ndarray | dict[int, float]) -> np.ndarray:
+        """
+        各構築の、相手が混合戦略strategyで選出するときの期待勝率
+        選出確率が正の構築の列だけを使って行列×ベクトルの積を求める
+        """
+        vector = self.strategy_vector(strategy)
+        support = np.flatnonzero(vector)
+        # 列jはbreedings[j]の行の裏返し(1 - 勝率)
+        columns = 1.0 - np.stack([self.row(int(j)) for j in support], axis=1)
+        return columns @ vector[support]
+
+    def best_response(
+        self, strategy: np.ndarray | dict[int, float], n_top: int = N_TOP
+    ) -> list[tuple[int, float]]:
+        """
+        混合戦略strategyに対する最適応答(期待勝率の高い順のn_top個の構築)
+        戻り値: [(インデックス, 期待勝率)]
+        """
+        if n_top < 1:
+            raise ValueError(f"n_top must be at least 1, got {n_top}.")
+        values = self.expected_winrates(strategy)
+        n_top = min(n_top, len(values))
+        top = np.argpartition(-values, n_top - 1)[:n_top]
+        top = top[np.argsort(-values[top], kind="stable")]
+        return [(int(idx), float(values[idx])) for idx in top]
+
+
+def _parse_breeding(value) -> int | PokeBreeding:
+    return int(value) if isinstance(value, (int, str)) else breeding_from_json(value)
+
+
+def make_handler(query: MatchupQuery) -> type[BaseHTTPRequestHandler]:
+    """
+    HTTPの問い合わせを処理するハンドラ
+    GET  /info                               勝率表の情報
+    GET  /winrate?a=I&b=J                    勝率表のインデックスで1組の勝率
+    GET  /row?a=I                            1行の勝率
+    POST /winrate {"a": ..., "b": ...}       構築はインデックスかJSONの育成
+    POST /row {"a": ...}
+    POST /best_response {"strategy": [...]または{"インデックス": 確率}, "n_top": 10}
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _answer(self, path: str, params: dict):
+            match path:
+                case "/info":
+                    return {
+                        "n_breedings": query.n,
+                        "metadata": query.win_table.metadata,
+                        "cache": query.cache_info()._asdict(),
+                        "row_cache": query.row_cache_info()._asdict(),
+                    }
+                case "/winrate":
+                    return {
+                        "winrate": query.winrate(
+                            _parse_breeding(params["a"]), _parse_breeding(params["b"])
+                        )
+                    }
+                case "/row":
+                    return {
+                        "winrates": query.row(_parse_breeding(params["a"])).tolist()
+                    }
+                case "/best_response":
+                    strategy = params["strategy"]
+                    if isinstance(strategy, dict):
+                        strategy = {int(idx): prob for idx, prob in strategy.items()}
+                    results = query.best_response(
+                        strategy, int(params.get("n_top", N_TOP))
+                    )
+                    return {
+                        "results": [
+                            {
+                                "index": idx,
+                                "winrate": winrate,
+                                "breeding": breeding_to_json(query.breedings[idx]),
+                            }
+                            for idx, winrate in results
+                        ]
+                    }
+            raise FileNotFoundError(path)
+
+        def _handle(self, params: dict):
+            try:
+                self._reply(200, self._answer(urlparse(self.path).path, params))
+            except FileNotFoundError as e:
+                self._reply(404, {"error": f"unknown path {e}"})
+            except (KeyError, ValueError, IndexError, TypeError) as e:
+                self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_GET(self):
+            params = {
+                name: values[0]
+                for name, values in parse_qs(urlparse(self.path).query).items()
+            }
+            self._handle(params)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                params = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError as e:
+                self._reply(400, {"error": f"invalid JSON: {e}"})
+                return
+            self._handle(params)
+
+        def log_message(self, format, *args):
+            # 問い合わせごとのログは出さない
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("win_table", help="勝率表(.iwt)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--method",
+        choices=[method.value for method in SimulationMethod],
+        default=SimulationMethod.MARKOV_CHAIN.value,
+        help="表にない組の勝率の計算方法",
+    )
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="表にない構築の行を計算するワーカープロセスの数",
+    )
+    args = parser.parse_args()
+    # ワーカープロセスはサーバのスレッドを開始する前に作る
+    with multiprocessing.Pool(args.workers, initializer=load_damage_table) as pool:
+        query = MatchupQuery(
+            load_win_table(args.win_table),
+            SimulationMethod(args.method),
+            args.cache_size,
+            pool,
+        )
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(query))
+        print(f"serving {args.win_table} on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+バトルのルールのバージョン
+勝率に関わるルール(反動の計算式、たべのこしの端数処理など)ごとにバージョンを持ち、
+各ルールが勝率に影響しうる対戦組の条件(対戦組の特徴)を宣言する。
+保存する勝率のキーには、その組に影響しうるルールのバージョンだけを含めるため、
+ルールを変更してバージョンを上げると、影響しうる組だけが再計算される
+(例: 先攻の1発目で必ずひんしになる組は、反動の計算式を変えても再計算しない)。
+古いバージョンの勝率もキーが異なるだけで保存したままなので、新旧の勝率表を並べて参照できる。
+
+ルールの判定に使う特徴は、どのルールのバージョンにもよらない量(実数値・戦略型と、
+coreのダメージ計算式による急所なし・乱数最小のダメージ)から求めること。
+特徴がルールによって変わると、同じ組のキーがルールの変更前後でずれ、古い勝率を引けなくなる。
+このため、乱数によって勝敗が変わりうるか(decided_winners())は急所率・反動などのルールによるので使わない。
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass, replace
+from enum import Enum
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import damage_outcomes_array
+from pokemon_iyasi1on1.model import HEAL_PULSE_MAX_PP, PokeStrategy
+from pokemon_iyasi1on1.tables import PokeTable
+
+
+class MatchupFeature(Enum):
+    """
+    ルールが勝率に影響しうるかを判定するための、対戦組の特徴
+    """
+
+    # 最初のわるあがきでひんしにならないことがある(先攻の最小ダメージで確定1発でない)
+    STRUGGLE_CONTINUES = "struggle_continues"
+    # いやしのはどうがHPの減った相手に使われうる(PPが異なる)。PPが同じなら双方同じターンにPPが尽きるため、
+    # いやしのはどうは最初のわるあがきより前の、最大HPの相手にしか使われない
+    HEAL_PULSE_ON_DAMAGED = "heal_pulse_on_damaged"
+    LEFTOVER = "leftover"  # いずれかがたべのこしを持つ
+    SPEED_TIE = "speed_tie"  # 同速
+
+
+@dataclass(frozen=True)
+class Rule:
+    """
+    バトルのルール
+    depends_on: 勝率に影響しうる組の条件(すべて満たす組だけに影響する。空ならすべての組)
+    """
+
+    name: str
+    version: int
+    description: str
+    depends_on: tuple[MatchupFeature, ...] = ()
+
+    def tag(self) -> str:
+        return f"{self.name}:{self.version}"
+
+
+# 勝率が変わるルールの変更をしたら、該当するルールのバージョンを上げる
+RULES: tuple[Rule, ...] = (
+    Rule(
+        "core",
+        1,
+        "ターンの進行・わるあがきのダメージ計算式・いやしのはどうのPP",
+    ),
+    Rule(
+        "critical_rate",
+        1,
+        "急所率1/24、ダメージ乱数16段階",
+        (MatchupFeature.STRUGGLE_CONTINUES,),
+    ),
+    Rule("speed_tie", 1, "同速時の先攻はランダム", (MatchupFeature.SPEED_TIE,)),
+    # バージョン1は修正前の反動。その頃の結果(results/before_recoil_fix)は勝率のストアに含まれない
+    Rule(
+        "struggle_recoil",
+        2,
+        "わるあがきの反動は最大HPの1/4(四捨五入)",
+        (MatchupFeature.STRUGGLE_CONTINUES,),
+    ),
+    Rule(
+        "heal_pulse",
+        1,
+        "いやしのはどうの回復量は最大HPの1/2(切り上げ)",
+        (MatchupFeature.HEAL_PULSE_ON_DAMAGED, MatchupFeature.STRUGGLE_CONTINUES),
+    ),
+    Rule(
+        "leftover",
+        1,
+        "たべのこしの回復量は最大HPの1/16(切り捨て)",
+        (MatchupFeature.LEFTOVER, MatchupFeature.STRUGGLE_CONTINUES),
+    ),
+)
+
+
+def with_versions(
+    overrides: dict[str, int], rules: tuple[Rule, ...] = RULES
+) -> tuple[Rule, ...]:
+    """
+    一部のルールのバージョンを差し替えたルールの組(古いバージョンの勝率の参照用)
+    """
+    names = {rule.name for rule in rules}
+    unknown = sorted(set(overrides) - names)
+    if unknown:
+        raise ValueError(f"Unknown rules: {unknown}.")
+    return tuple(
+        replace(rule, version=overrides.get(rule.name, rule.version)) for rule in rules
+    )
+
+
+def parse_rule_version(spec: str) -> tuple[str, int]:
+    """
+    "NAME=VERSION"形式のルールのバージョン指定を(NAME, VERSION)にする
+    """
+    try:
+        name, version = spec.split("=")
+        return name, int(version)
+    except ValueError:
+        raise ValueError(
+            f"Rule version must be given as NAME=VERSION, got {spec!r}."
+        ) from None
+
+
+def rule_versions(rules: tuple[Rule, ...] = RULES) -> dict[str, int]:
+    """
+    勝率表のメタデータに記録する、ルール名→バージョン
+    """
+    return {rule.name: rule.version for rule in rules}
+
+
+def rules_id(rules: tuple[Rule, ...] = RULES) -> str:
+    """
+    ルールの組全体を表す短いハッシュ(古いルールの勝率表のファイル名に使う)
+    """
+    content = json.dumps(rule_versions(rules), sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def matchup_features(
+    pokes0: PokeTable, pokes1: PokeTable
+) -> dict[MatchupFeature, np.ndarray]:
+    """
+    pokes0[k]とpokes1[k]の組の特徴[組]
+    """
+    pps = tuple(
+        np.where(
+            table.column("strategy") == PokeStrategy.VEST.value, 0, HEAL_PULSE_MAX_PP
+        )
+        for table in (pokes0, pokes1)
+    )
+    speeds = (pokes0.column("s"), pokes1.column("s"))
+    # 最初のわるあがきまでは、いやしのはどう・たべのこしで最大HPを超えて回復しないため
+    # 双方とも最大HPのまま。最初にわるあがきをするのはPPが少ない方(同じなら速い方)
+    first_candidates = (
+        (pps[0] < pps[1]) | ((pps[0] == pps[1]) & (speeds[0] >= speeds[1])),
+        (pps[1] < pps[0]) | ((pps[0] == pps[1]) & (speeds[1] >= speeds[0])),
+    )
+    # 最小ダメージで相手の最大HP以上を与えるなら、最初のわるあがきで必ずひんしにする
+    one_hit_ko = (
+        damage_outcomes_array(
+            pokes0.column("level"), pokes0.column("a"), pokes1.column("b")
+        ).min(axis=-1)
+        >= pokes1.column("max_hp"),
+        damage_outcomes_array(
+            pokes1.column("level"), pokes1.column("a"), pokes0.column("b")
+        ).min(axis=-1)
+        >= pokes0.column("max_hp"),
+    )
+    ends_at_first_struggle = (~first_candidates[0] | one_hit_ko[0]) & (
+        ~first_candidates[1] | one_hit_ko[1]
+    )
+    leftover = PokeStrategy.LEFTOVER.value
+    return {
+        MatchupFeature.STRUGGLE_CONTINUES: ~ends_at_first_struggle,
+        MatchupFeature.HEAL_PULSE_ON_DAMAGED: pps[0] != pps[1],
+        MatchupFeature.LEFTOVER: (pokes0.column("strategy") == leftover)
+        | (pokes1.column("strategy") == leftover),
+        MatchupFeature.SPEED_TIE: speeds[0] == speeds[1],
+    }
+
+
+def dependent_rules(
+    pokes0: PokeTable,
+    pokes1: PokeTable,
+    rules: tuple[Rule, ...] = RULES,
+) -> list[str]:
+    """
+    pokes0[k]とpokes1[k]の組の勝率に影響しうるルールを、保存用のキーに含める文字列で表す[組]
+    例: "core:1,struggle_recoil:2"
+    """
+    features = matchup_features(pokes0, pokes1)
+    # 組ごとに、影響するルールをビットで表す(ルールの組み合わせは少ないので文字列は使い回す)
+    masks = np.zeros(len(pokes0), dtype=np.int64)
+    for bit, rule in enumerate(rules):
+        affected = np.ones(len(pokes0), dtype=bool)
+        for feature in rule.depends_on:
+            affected &= features[feature]
+        masks |= affected.astype(np.int64) << bit
+    tags = {
+        mask: ",".join(
+            rule.tag() for bit, rule in enumerate(rules) if (mask >> bit) & 1
+        )
+        for mask in np.unique(masks).tolist()
+    }
+    return [tags[mask] for mask in masks.tolist()]
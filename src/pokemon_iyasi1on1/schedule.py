@@ -0,0 +1,132 @@
+"""
+対戦組の計算量の予測と、ワーカーへの割り当て
+バトルのターン数は、いやしのはどうのPP・たべのこしの有無・火力と耐久で大きく変わり、
+1〜2ターンで終わる組もあれば数十ターン続く組もある。行優先の順にタイルを配ると、
+重い組が最後に残ってほかのコアが遊ぶため、ステータスから1バトルのターン数を予測し、
+重いタイルから順に、残りの計算量に応じて小さくなるタイルで配る(guided self-scheduling)。
+"""
+
+from enum import Enum
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import damage_outcomes_array
+from pokemon_iyasi1on1.keyed_random import MAX_TURNS
+from pokemon_iyasi1on1.model import HEAL_PULSE_MAX_PP, PokeStrategy
+from pokemon_iyasi1on1.simulate_battle import outcome_probabilities
+from pokemon_iyasi1on1.tables import PokeTable
+
+
+class Schedule(Enum):
+    """
+    対戦組のタイルへの分け方
+    """
+
+    COST = "cost"  # 予測した計算量の大きい順に、計算量を揃えたタイル
+    ROW = "row"  # 行優先の順に、同じ組数のタイル
+
+
+# 残りの計算量をワーカー数×GUIDED_FACTOR等分した量を、次のタイルの計算量の目安とする
+GUIDED_FACTOR = 4
+
+
+def predict_turns(pokes0: PokeTable, pokes1: PokeTable) -> np.ndarray:
+    """
+    pokes0[k]とpokes1[k]のバトルのターン数の予測[組]
+    わるあがきのダメージを期待値に固定し、simulate()と同じ順序でHPの推移を追う
+    (同速の場合はpokes0が先攻とする)。反動・いやしのはどう・たべのこしを含む
+    """
+    n_pairs = len(pokes0)
+    sides = []
+    for attacker, defender in [(pokes0, pokes1), (pokes1, pokes0)]:
+        damages = damage_outcomes_array(
+            attacker.column("level"), attacker.column("a"), defender.column("b")
+        )
+        max_hp = attacker.column("max_hp").astype(np.float64)
+        leftover = attacker.column("strategy") == PokeStrategy.LEFTOVER.value
+        sides.append(
+            {
+                "max_hp": max_hp,
+                "hp": max_hp.copy(),
+                "pp": np.where(
+                    attacker.column("strategy") == PokeStrategy.VEST.value,
+                    0,
+                    HEAL_PULSE_MAX_PP,
+                ),
+                "damage": damages @ outcome_probabilities(),  # 相手に与えるダメージ
+                "recoil": (max_hp + 2) // 4,
+                "heal": np.ceil(max_hp / 2),  # いやしのはどうを受けたときの回復量
+                "leftover": np.where(leftover, max_hp // 16, 0),
+            }
+        )
+    first = np.where(pokes0.column("s") >= pokes1.column("s"), 0, 1)
+    turns = np.full(n_pairs, MAX_TURNS)
+    ongoing = np.ones(n_pairs, dtype=bool)
+    for turn in range(1, MAX_TURNS + 1):
+        for order in [first, 1 - first]:
+            for idx in [0, 1]:
+                acting = ongoing & (order == idx)
+                attacker, defender = sides[idx], sides[1 - idx]
+                healing = acting & (attacker["pp"] > 0)
+                attacker["pp"][healing] -= 1
+                defender["hp"] = np.where(
+                    healing,
+                    np.minimum(defender["max_hp"], defender["hp"] + defender["heal"]),
+                    defender["hp"],
+                )
+                struggling = acting & ~healing
+                defender["hp"] -= np.where(struggling, attacker["damage"], 0)
+                attacker["hp"] -= np.where(
+                    struggling & (defender["hp"] > 0), attacker["recoil"], 0
+                )
+                ended = struggling & ((defender["hp"] <= 0) | (attacker["hp"] <= 0))
+                turns[ended] = turn
+                ongoing &= ~ended
+        for side in sides:
+            side["hp"] = np.minimum(side["max_hp"], side["hp"] + side["leftover"])
+        if not np.any(ongoing):
+            break
+    return turns
+
+
+def predict_costs(
+    pokes0: PokeTable, pokes1: PokeTable, markov_chain: bool
+) -> np.ndarray:
+    """
+    pokes0[k]とpokes1[k]の勝率の計算量の予測(相対値)[組]
+    モンテカルロはバトルのターン数に比例する。有限マルコフ連鎖は反復回数(ターン数)と
+    1回の反復の計算量(HPの組の数×防御側のHPの遷移)の積に比例する
+    """
+    turns = predict_turns(pokes0, pokes1).astype(np.float64)
+    if not markov_chain:
+        return turns
+    hp0 = pokes0.column("max_hp").astype(np.float64) + 1
+    hp1 = pokes1.column("max_hp").astype(np.float64) + 1
+    return turns * hp0 * hp1 * (hp0 + hp1)
+
+
+def schedule_tiles(
+    matches: np.ndarray, costs: np.ndarray, n_workers: int, max_tile_size: int
+) -> list[np.ndarray]:
+    """
+    対戦組matches[組, 2]を、予測した計算量costsの大きい順にタイルに分ける
+    各タイルの計算量は、残りの計算量をn_workers×GUIDED_FACTOR等分した量(最大max_tile_size組)。
+    最初は重い組の大きなタイル、最後は軽い組の小さなタイルになるので、最後の組まで全コアが埋まる
+    """
+    order = np.argsort(-costs, kind="stable")
+    matches = matches[order]
+    costs = costs[order]
+    # 後ろからの累積和(その組以降の残りの計算量)
+    remaining = np.cumsum(costs[::-1])[::-1]
+    cumulative = np.cumsum(costs)
+    tiles = []
+    start = 0
+    while start < len(matches):
+        target = remaining[start] / (n_workers * GUIDED_FACTOR)
+        # start以降の計算量の累積がtargetに達するまで(少なくとも1組)
+        base = cumulative[start] - costs[start]
+        stop = int(np.searchsorted(cumulative, base + target, side="left")) + 1
+        stop = min(max(stop, start + 1), start + max_tile_size, len(matches))
+        tiles.append(matches[start:stop])
+        start = stop
+    return tiles
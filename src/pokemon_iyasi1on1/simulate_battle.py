@@ -4,25 +4,56 @@
 
 import math
 import random
+from collections import defaultdict
 
-from pokemon_iyasi1on1.damage import calc_damage
-from pokemon_iyasi1on1.model import Poke, PokeStrategy
+import numpy as np
 
+from pokemon_iyasi1on1.damage_table import (
+    N_DAMAGE_OUTCOMES,
+    N_DAMAGE_RANDOM,
+    damage_outcomes,
+    damage_outcomes_array,
+    outcome_index,
+)
+from pokemon_iyasi1on1.instrumentation import BattleStats
+from pokemon_iyasi1on1.keyed_random import MAX_TURNS, N_DRAW_VALUES, KeyedDraws
+from pokemon_iyasi1on1.model import HEAL_PULSE_MAX_PP, Poke, PokeStrategy
+from pokemon_iyasi1on1.tables import PokeTable
 
-def simulate(pokes: tuple[Poke, Poke], rng: random.Random) -> int:
+# シミュレータのバージョン
+# 保存する勝率のキーの形式を変えたら上げる(保存済みの計算結果が再利用されなくなる)
+# 勝率が変わるルールの変更をしたら、代わりにrules.RULESの該当するルールのバージョンを上げる
+SIMULATOR_VERSION = 2
+CRITICAL_RATE = 1 / 24  # 急所率
+
+
+def simulate(
+    pokes: tuple[Poke, Poke],
+    rng: random.Random | KeyedDraws,
+    stats: BattleStats | None = None,
+) -> int:
     """
     バトルをシミュレートし、勝者(0 or 1)を返す
     PokeのHPは変化するため、事前にreset()を呼んでおくこと。
+    rng: 乱数はrandrange()だけで取り出す。KeyedDrawsなら、start_battle()で選んだバトルの乱数を使う
+    stats: 指定すると、バトルのターン数・いやしのはどう・たべのこしの発動回数を加算する
     """
+    # わるあがきのダメージはダメージ表から引く
+    damages = (
+        damage_outcomes(pokes[0].level, pokes[0].a, pokes[1].b),
+        damage_outcomes(pokes[1].level, pokes[1].a, pokes[0].b),
+    )
 
+    turns = 0
     while True:
+        turns += 1
         if pokes[0].s > pokes[1].s:
             move_order = [0, 1]
         elif pokes[1].s > pokes[0].s:
             move_order = [1, 0]
         else:
             # 同速なのでランダムに先攻を決める
-            move_first = rng.randint(0, 1)
+            move_first = rng.randrange(0, 2)
             move_order = [move_first, 1 - move_first]
         for attacker_idx in move_order:
             attacker = pokes[attacker_idx]
@@ -30,6 +61,8 @@ def simulate(pokes: tuple[Poke, Poke], rng: random.Random) -> int:
             if attacker.heal_pulse_pp > 0:
                 # いやしのはどうが発動
                 attacker.heal_pulse_pp -= 1
+                if stats is not None:
+                    stats.heal_pulses += 1
                 # 回復量は切り上げ
                 # メガランチャーは考慮していない
                 defender.current_hp = min(
@@ -38,16 +71,15 @@ def simulate(pokes: tuple[Poke, Poke], rng: random.Random) -> int:
                 )
             else:
                 # わるあがきが発動
-                damage = calc_damage(
-                    attacker.level,
-                    50,  # わるあがきの威力
-                    attacker.a,
-                    defender.b,
-                    rng.randrange(0, 24) == 0,  # 急所は1/24
-                    rng.randrange(0, 16),  # ダメージ乱数は16段階
-                )
+                # 急所は1/24、ダメージ乱数は16段階(1回の乱数から独立に取り出す)
+                draw = rng.randrange(0, N_DRAW_VALUES)
+                damage = damages[attacker_idx][
+                    outcome_index(draw % 24 == 0, draw // 24)
+                ]
                 defender.current_hp = max(0, defender.current_hp - damage)
                 if defender.current_hp == 0:
+                    if stats is not None:
+                        stats.add_battle(turns)
                     return attacker_idx
 
                 # 反動(四捨五入)
@@ -55,6 +87,8 @@ def simulate(pokes: tuple[Poke, Poke], rng: random.Random) -> int:
                 attacker.current_hp = max(0, attacker.current_hp - recoil)
 
                 if attacker.current_hp == 0:
+                    if stats is not None:
+                        stats.add_battle(turns)
                     return 1 - attacker_idx
 
         # ターン終了処理
@@ -62,8 +96,379 @@ def simulate(pokes: tuple[Poke, Poke], rng: random.Random) -> int:
             attacker = pokes[attacker_idx]
             if attacker.strategy == PokeStrategy.LEFTOVER:
                 # たべのこしが発動
+                if stats is not None:
+                    stats.leftovers += 1
                 # 回復量は切り捨て(切り捨てて0になるケースは1になるが、LV50戦では発生しないため未実装)
                 attacker.current_hp = min(
                     attacker.max_hp,
                     attacker.current_hp + math.floor(attacker.max_hp / 16),
                 )
+
+
+def decided_winner(pokes: tuple[Poke, Poke]) -> int | None:
+    """
+    乱数によらず勝者が決まる場合はその勝者(0 or 1)を、決まらない場合はNoneを返す
+    相手に与えるダメージが大きいほど有利なので、勝者とする側のダメージを最小、
+    相手のダメージを最大に固定し、同速時の先攻も不利な方を選んだ最悪の場合でも勝てるかを調べる。
+    Pokeの現在のHPとPPをバトル開始時の状態とするため、事前にreset()を呼んでおくこと。
+    Pokeの状態は変化しない。
+    """
+    damages = (
+        damage_outcomes(pokes[0].level, pokes[0].a, pokes[1].b),
+        damage_outcomes(pokes[1].level, pokes[1].a, pokes[0].b),
+    )
+    for winner in [0, 1]:
+        fixed_damages = (
+            (min(damages[0]), max(damages[1]))
+            if winner == 0
+            else (max(damages[0]), min(damages[1]))
+        )
+        if _always_wins(pokes, fixed_damages, winner):
+            return winner
+    return None
+
+
+def decided_winners(pokes0: PokeTable, pokes1: PokeTable) -> np.ndarray:
+    """
+    decided_winner()の配列版。pokes0[k]とpokes1[k]のバトル開始時(reset()後)の勝者
+    同速でない組は、ダメージを固定すると乱数によらずバトルが決まるので、全組を一括で進める。
+    同速の組は先攻の決まり方をすべて調べる必要があるため、decided_winner()で1組ずつ調べる
+    戻り値: 勝者(0 or 1)、決まらない場合は-1 [組]
+    """
+    n_pairs = len(pokes0)
+    damages = (
+        damage_outcomes_array(
+            pokes0.column("level"), pokes0.column("a"), pokes1.column("b")
+        ),
+        damage_outcomes_array(
+            pokes1.column("level"), pokes1.column("a"), pokes0.column("b")
+        ),
+    )
+    speeds = (pokes0.column("s"), pokes1.column("s"))
+    tie = speeds[0] == speeds[1]
+    result = np.full(n_pairs, -1, dtype=np.int8)
+    for winner in [0, 1]:
+        # 勝者とする側のダメージを最小、相手のダメージを最大に固定する
+        fixed_damages = tuple(
+            damages[idx].min(axis=-1) if idx == winner else damages[idx].max(axis=-1)
+            for idx in [0, 1]
+        )
+        winners = _fixed_damage_winners(
+            (pokes0, pokes1), fixed_damages, speeds[1] > speeds[0]
+        )
+        result[(winners == winner) & ~tie & (result < 0)] = winner
+    for k in np.flatnonzero(tie).tolist():
+        winner = decided_winner((pokes0[k], pokes1[k]))
+        if winner is not None:
+            result[k] = winner
+    return result
+
+
+def _fixed_damage_winners(
+    pokes: tuple[PokeTable, PokeTable],
+    damages: tuple[np.ndarray, np.ndarray],
+    second_first: np.ndarray,
+) -> np.ndarray:
+    """
+    わるあがきのダメージをdamages[組]に固定したときのバトルの勝者[組](決着しなければ-1)
+    second_first: pokes[1]が先攻する組
+    simulate()と同じ順序で、全組のHP・PPを一括で進める
+    """
+    max_hps = tuple(table.column("max_hp").astype(np.int64) for table in pokes)
+    hps = [max_hp.copy() for max_hp in max_hps]
+    pps = [
+        np.where(
+            table.column("strategy") == PokeStrategy.VEST.value, 0, HEAL_PULSE_MAX_PP
+        )
+        for table in pokes
+    ]
+    # 反動(四捨五入)、いやしのはどうを受けたときの回復量(切り上げ)、たべのこしの回復量(切り捨て)
+    recoils = tuple((max_hp + 2) // 4 for max_hp in max_hps)
+    heals = tuple(-(-max_hp // 2) for max_hp in max_hps)
+    leftovers = tuple(
+        np.where(
+            table.column("strategy") == PokeStrategy.LEFTOVER.value, max_hp // 16, 0
+        )
+        for table, max_hp in zip(pokes, max_hps)
+    )
+    first = np.where(second_first, 1, 0)
+    winners = np.full(len(first), -1, dtype=np.int8)
+    for _ in range(MAX_TURNS):
+        for order in [first, 1 - first]:
+            for attacker_idx in [0, 1]:
+                defender_idx = 1 - attacker_idx
+                acting = (winners < 0) & (order == attacker_idx)
+                healing = acting & (pps[attacker_idx] > 0)
+                pps[attacker_idx][healing] -= 1
+                hps[defender_idx] = np.where(
+                    healing,
+                    np.minimum(
+                        max_hps[defender_idx],
+                        hps[defender_idx] + heals[defender_idx],
+                    ),
+                    hps[defender_idx],
+                )
+                struggling = acting & ~healing
+                hps[defender_idx] = np.where(
+                    struggling,
+                    np.maximum(0, hps[defender_idx] - damages[attacker_idx]),
+                    hps[defender_idx],
+                )
+                knocked_out = struggling & (hps[defender_idx] == 0)
+                winners[knocked_out] = attacker_idx
+                recoiling = struggling & ~knocked_out
+                hps[attacker_idx] = np.where(
+                    recoiling,
+                    np.maximum(0, hps[attacker_idx] - recoils[attacker_idx]),
+                    hps[attacker_idx],
+                )
+                winners[recoiling & (hps[attacker_idx] == 0)] = defender_idx
+        # ターン終了処理
+        for idx in [0, 1]:
+            hps[idx] = np.minimum(max_hps[idx], hps[idx] + leftovers[idx])
+        if np.all(winners >= 0):
+            break
+    return winners
+
+
+def _always_wins(
+    pokes: tuple[Poke, Poke], damages: tuple[int, int], player: int
+) -> bool:
+    """
+    わるあがきのダメージをdamagesに固定したとき、同速時の先攻がどう決まってもplayerが勝つか
+    """
+    # 反動(四捨五入)
+    recoils = tuple((poke.max_hp + 2) // 4 for poke in pokes)
+    # いやしのはどうを受けたときの回復量(切り上げ)
+    heals = tuple(math.ceil(poke.max_hp / 2) for poke in pokes)
+    # たべのこしの回復量(切り捨て)
+    leftovers = tuple(
+        math.floor(poke.max_hp / 16) if poke.strategy == PokeStrategy.LEFTOVER else 0
+        for poke in pokes
+    )
+    if pokes[0].s > pokes[1].s:
+        move_orders = [(0, 1)]
+    elif pokes[1].s > pokes[0].s:
+        move_orders = [(1, 0)]
+    else:
+        move_orders = [(0, 1), (1, 0)]
+
+    memo: dict[tuple[int, int, int, int], bool] = {}
+
+    def play(state: tuple[int, int, int, int], move_order: tuple[int, int]) -> bool:
+        hp = list(state[:2])
+        pp = list(state[2:])
+        for attacker_idx in move_order:
+            defender_idx = 1 - attacker_idx
+            if pp[attacker_idx] > 0:
+                # いやしのはどうが発動
+                pp[attacker_idx] -= 1
+                hp[defender_idx] = min(
+                    pokes[defender_idx].max_hp, hp[defender_idx] + heals[defender_idx]
+                )
+            else:
+                # わるあがきが発動
+                hp[defender_idx] = max(0, hp[defender_idx] - damages[attacker_idx])
+                if hp[defender_idx] == 0:
+                    return attacker_idx == player
+                hp[attacker_idx] = max(0, hp[attacker_idx] - recoils[attacker_idx])
+                if hp[attacker_idx] == 0:
+                    return defender_idx == player
+        # ターン終了処理
+        return turn(
+            (
+                min(pokes[0].max_hp, hp[0] + leftovers[0]),
+                min(pokes[1].max_hp, hp[1] + leftovers[1]),
+                pp[0],
+                pp[1],
+            )
+        )
+
+    def turn(state: tuple[int, int, int, int]) -> bool:
+        if state not in memo:
+            memo[state] = all(play(state, move_order) for move_order in move_orders)
+        return memo[state]
+
+    return turn(
+        (
+            pokes[0].current_hp,
+            pokes[1].current_hp,
+            pokes[0].heal_pulse_pp,
+            pokes[1].heal_pulse_pp,
+        )
+    )
+
+
+def outcome_probabilities() -> np.ndarray:
+    """
+    outcome_indexごとの確率[N_DAMAGE_OUTCOMES]
+    """
+    probs = np.zeros(N_DAMAGE_OUTCOMES)
+    for critical, p_critical in [(False, 1 - CRITICAL_RATE), (True, CRITICAL_RATE)]:
+        for random_ in range(N_DAMAGE_RANDOM):
+            probs[outcome_index(critical, random_)] = p_critical / N_DAMAGE_RANDOM
+    return probs
+
+
+def damage_distribution(attacker: Poke, defender: Poke) -> list[tuple[int, float]]:
+    """
+    わるあがきのダメージの確率分布を返す
+    戻り値: (ダメージ, 確率)のリスト。ダメージ昇順。
+    """
+    damages = damage_outcomes(attacker.level, attacker.a, defender.b)
+    probs: dict[int, float] = defaultdict(float)
+    for critical, p_critical in [(False, 1 - CRITICAL_RATE), (True, CRITICAL_RATE)]:
+        for random_ in range(N_DAMAGE_RANDOM):
+            probs[damages[outcome_index(critical, random_)]] += (
+                p_critical / N_DAMAGE_RANDOM
+            )
+    return sorted(probs.items())
+
+
+def _heal_pulse_step(
+    values: np.ndarray, defender_idx: int, max_hp: int, heal: int
+) -> np.ndarray:
+    """
+    いやしのはどう直前の状態の価値を、直後の状態の価値valuesから求める
+    values: [HP0, HP1] -> pokes[0]の勝率
+    """
+    healed = np.minimum(np.arange(values.shape[defender_idx]) + heal, max_hp)
+    return np.take(values, healed, axis=defender_idx)
+
+
+def _damage_transition(
+    damages: list[tuple[int, float]], max_hp: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    わるあがきによる防御側のHPの遷移を行列で表す
+    戻り値: (遷移行列[被弾後HP, 被弾前HP], ひんしになる確率[被弾前HP])
+    """
+    transition = np.zeros((max_hp + 1, max_hp + 1))
+    faint = np.zeros(max_hp + 1)
+    hps = np.arange(1, max_hp + 1)
+    for damage, p in damages:
+        after = hps - damage
+        alive = after > 0
+        transition[after[alive], hps[alive]] += p
+        faint[hps[~alive]] += p
+    return transition, faint
+
+
+def _struggle_step(
+    values: np.ndarray,
+    attacker_idx: int,
+    transition: tuple[np.ndarray, np.ndarray],
+    recoil: int,
+) -> np.ndarray:
+    """
+    わるあがき直前の状態の価値を、直後の状態の価値valuesから求める
+    values: [HP0, HP1] -> pokes[0]の勝率
+    transition: _damage_transition()の戻り値
+    """
+    # 軸を(攻撃側HP, 防御側HP)に揃える
+    if attacker_idx == 1:
+        values = values.T
+    attacker_win = 1.0 if attacker_idx == 0 else 0.0
+    n_attacker_hp = values.shape[0]
+    # 反動でひんしになる場合は相手の勝ち
+    after_recoil = np.full_like(values, 1.0 - attacker_win)
+    if recoil + 1 < n_attacker_hp:
+        after_recoil[recoil + 1 :] = values[1 : n_attacker_hp - recoil]
+    # 防御側のHPがダメージ以下なら攻撃側の勝ち(反動より先に判定)
+    damage_matrix, faint = transition
+    before = after_recoil @ damage_matrix + attacker_win * faint
+    if attacker_idx == 1:
+        before = before.T
+    return before
+
+
+def win_probability(pokes: tuple[Poke, Poke]) -> float:
+    """
+    バトルを有限マルコフ連鎖として解き、pokes[0]の勝率を厳密に返す
+    状態は(HP0, HP1, いやしのはどうPP0, PP1)で、ダメージ乱数・急所・同速時の先攻を
+    すべて確率で展開する。
+    PPは行動順や乱数によらず毎ターン1ずつ減るため、ターン数からPPが決まる。
+    PPが残っている間はターンごとに後ろ向きに、PPが尽きた後は
+    状態価値が収束するまで、全HPの組に対する勝率をNumPyで一括計算する。
+    Pokeの現在のHPとPPをバトル開始時の状態とするため、事前にreset()を呼んでおくこと。
+    Pokeの状態は変化しない。
+    """
+    transitions = (
+        _damage_transition(damage_distribution(pokes[0], pokes[1]), pokes[1].max_hp),
+        _damage_transition(damage_distribution(pokes[1], pokes[0]), pokes[0].max_hp),
+    )
+    # 反動(四捨五入)
+    recoils = tuple((poke.max_hp + 2) // 4 for poke in pokes)
+    # いやしのはどうを受けたときの回復量(切り上げ)
+    heals = tuple(math.ceil(poke.max_hp / 2) for poke in pokes)
+    # たべのこしで回復した後のHP(切り捨て)
+    after_leftovers = tuple(
+        np.minimum(
+            np.arange(poke.max_hp + 1)
+            + (
+                math.floor(poke.max_hp / 16)
+                if poke.strategy == PokeStrategy.LEFTOVER
+                else 0
+            ),
+            poke.max_hp,
+        )
+        for poke in pokes
+    )
+    if pokes[0].s > pokes[1].s:
+        move_orders = [((0, 1), 1.0)]
+    elif pokes[1].s > pokes[0].s:
+        move_orders = [((1, 0), 1.0)]
+    else:
+        # 同速なのでランダムに先攻を決める
+        move_orders = [((0, 1), 0.5), ((1, 0), 0.5)]
+
+    def turn(next_values: np.ndarray, pps: tuple[int, int]) -> np.ndarray:
+        """
+        ターン開始時のPPがppsのとき、ターン終了後の価値からターン開始時の価値を求める
+        """
+        # ターン終了処理
+        values = next_values[np.ix_(after_leftovers[0], after_leftovers[1])]
+        result = np.zeros_like(values)
+        for move_order, p_order in move_orders:
+            order_values = values
+            for attacker_idx in reversed(move_order):
+                defender_idx = 1 - attacker_idx
+                if pps[attacker_idx] > 0:
+                    # いやしのはどうが発動
+                    order_values = _heal_pulse_step(
+                        order_values,
+                        defender_idx,
+                        pokes[defender_idx].max_hp,
+                        heals[defender_idx],
+                    )
+                else:
+                    # わるあがきが発動
+                    order_values = _struggle_step(
+                        order_values,
+                        attacker_idx,
+                        transitions[attacker_idx],
+                        recoils[attacker_idx],
+                    )
+            result += p_order * order_values
+        return result
+
+    # PPが尽きた状態では、毎ターン両者のHPが必ず減るため有限回の反復で収束する
+    values = np.zeros((pokes[0].max_hp + 1, pokes[1].max_hp + 1))
+    while True:
+        next_values = turn(values, (0, 0))
+        if np.array_equal(next_values, values):
+            break
+        values = next_values
+    # PPが残っているターンを後ろから計算
+    for turn_idx in reversed(
+        range(max(pokes[0].heal_pulse_pp, pokes[1].heal_pulse_pp))
+    ):
+        values = turn(
+            values,
+            (
+                max(pokes[0].heal_pulse_pp - turn_idx, 0),
+                max(pokes[1].heal_pulse_pp - turn_idx, 0),
+            ),
+        )
+    # 丸め誤差で[0, 1]をわずかに外れることがあるため切り詰める
+    return min(max(float(values[pokes[0].current_hp, pokes[1].current_hp]), 0.0), 1.0)
@@ -0,0 +1,211 @@
+"""
+わるあがきバトルをNumPyで一括シミュレートする
+ルールはsimulate_battle.simulate()と同一で、多数の試行(および多数の対戦組)を
+1ターンずつ並行して進める
+"""
+
+from typing import Sequence
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage_table import N_DAMAGE_RANDOM, damage_outcomes_array
+from pokemon_iyasi1on1.keyed_random import (
+    MAX_DRAWS,
+    N_DRAW_VALUES,
+    RNG_SEED,
+    battle_draws,
+    stream_key,
+)
+from pokemon_iyasi1on1.model import Poke, PokeStrategy
+
+
+def _poke_arrays(pokes: Sequence[Poke]) -> dict[str, np.ndarray]:
+    """
+    Pokeの列をパラメータごとの配列に変換する
+    """
+    return {
+        "level": np.array([poke.level for poke in pokes], dtype=np.int64),
+        "max_hp": np.array([poke.max_hp for poke in pokes], dtype=np.int64),
+        "a": np.array([poke.a for poke in pokes], dtype=np.int64),
+        "b": np.array([poke.b for poke in pokes], dtype=np.int64),
+        "s": np.array([poke.s for poke in pokes], dtype=np.int64),
+        "current_hp": np.array([poke.current_hp for poke in pokes], dtype=np.int64),
+        "heal_pulse_pp": np.array(
+            [poke.heal_pulse_pp for poke in pokes], dtype=np.int64
+        ),
+        "leftover": np.array(
+            [poke.strategy == PokeStrategy.LEFTOVER for poke in pokes], dtype=bool
+        ),
+    }
+
+
+def simulate_batch(
+    matches: Sequence[tuple[Poke, Poke]],
+    count: int,
+    rng: np.random.Generator | None,
+    draws: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    各対戦組についてcount回ずつバトルをシミュレートし、勝者(0 or 1)を返す
+    戻り値: 勝者の配列[対戦組, 試行]
+    PokeのHP・PPを初期状態として用いるため、事前にreset()を呼んでおくこと。
+    Pokeの状態は変化しない。
+    draws: 各バトルの乱数[対戦組, 試行, MAX_DRAWS](keyed_random.battle_draws())。
+        指定するとrngの代わりに使い、同じ乱数を渡したsimulate()と同じ結果になる
+    """
+    sides = [_poke_arrays([match[idx] for match in matches]) for idx in range(2)]
+    # 各配列は[ポケモン(0 or 1)][レーン]
+    # レーンは対戦組ごとにcount個ずつ並ぶ
+    max_hp = [np.repeat(side["max_hp"], count) for side in sides]
+    hp = [np.repeat(side["current_hp"], count) for side in sides]
+    pp = [np.repeat(side["heal_pulse_pp"], count) for side in sides]
+    s = [np.repeat(side["s"], count) for side in sides]
+    # わるあがきのダメージ[攻撃側(0 or 1), 対戦組, outcome_index]
+    damages = np.stack(
+        [
+            damage_outcomes_array(side["level"], side["a"], opponent["b"])
+            for side, opponent in [(sides[0], sides[1]), (sides[1], sides[0])]
+        ]
+    ).astype(np.int64)
+    # 各レーンの対戦組
+    match_idx = np.repeat(np.arange(len(matches)), count)
+    # 反動(四捨五入)
+    recoil = [(mh + 2) // 4 for mh in max_hp]
+    # いやしのはどうを受けたときの回復量(切り上げ)
+    heal = [(mh + 1) // 2 for mh in max_hp]
+    # たべのこしの回復量(切り捨て)
+    leftover = [
+        np.where(np.repeat(side["leftover"], count), mh // 16, 0)
+        for side, mh in zip(sides, max_hp)
+    ]
+
+    winners = np.full(len(matches) * count, -1, dtype=np.int8)
+    # 決着のついていないレーンの番号
+    lanes = np.arange(len(matches) * count)
+    if draws is not None:
+        draws = draws.reshape(len(matches) * count, MAX_DRAWS)
+        # 各レーンで次に使う乱数の位置
+        cursor = np.zeros(len(matches) * count, dtype=np.int64)
+
+    def next_draws(used: np.ndarray) -> np.ndarray:
+        """
+        決着のついていない各レーンの乱数。drawsを使う場合は、usedのレーンだけ位置を進める
+        """
+        if draws is None:
+            return rng.integers(0, N_DRAW_VALUES, len(lanes))
+        if np.any(cursor[lanes[used]] >= MAX_DRAWS):
+            raise RuntimeError("A battle used more than MAX_DRAWS random values.")
+        values = draws[lanes, np.minimum(cursor[lanes], MAX_DRAWS - 1)]
+        cursor[lanes[used]] += 1
+        return values
+
+    while len(lanes) > 0:
+        n_active = len(lanes)
+        # 同速ならランダムに先攻を決める
+        tie = s[0] == s[1]
+        first_is_0 = s[0] > s[1]
+        if np.any(tie):
+            first_is_0 |= tie & (next_draws(tie) % 2 == 0)
+        active = np.ones(n_active, dtype=bool)
+        for attacker_is_0 in [first_is_0, ~first_is_0]:
+            # 攻撃側・防御側の視点に並べ替える
+            hp_a = np.where(attacker_is_0, hp[0], hp[1])
+            hp_d = np.where(attacker_is_0, hp[1], hp[0])
+            pp_a = np.where(attacker_is_0, pp[0], pp[1])
+            # いやしのはどうが発動
+            heal_pulse = active & (pp_a > 0)
+            pp_a -= heal_pulse
+            hp_d = np.where(
+                heal_pulse,
+                np.minimum(
+                    np.where(attacker_is_0, max_hp[1], max_hp[0]),
+                    hp_d + np.where(attacker_is_0, heal[1], heal[0]),
+                ),
+                hp_d,
+            )
+            # わるあがきが発動
+            struggle = active & ~heal_pulse
+            # 急所は1/24、ダメージ乱数は16段階(1回の乱数から独立に取り出す)
+            draw = next_draws(struggle)
+            critical = draw % 24 == 0
+            random_ = draw // 24
+            damage = damages[
+                np.where(attacker_is_0, 0, 1),
+                match_idx,
+                critical * N_DAMAGE_RANDOM + random_,
+            ]
+            hp_d = np.where(struggle, np.maximum(0, hp_d - damage), hp_d)
+            knocked_out = struggle & (hp_d == 0)
+            # 反動(四捨五入)
+            recoiled = struggle & ~knocked_out
+            hp_a = np.where(
+                recoiled,
+                np.maximum(0, hp_a - np.where(attacker_is_0, recoil[0], recoil[1])),
+                hp_a,
+            )
+            fainted = recoiled & (hp_a == 0)
+            winners[lanes[knocked_out]] = np.where(attacker_is_0, 0, 1)[knocked_out]
+            winners[lanes[fainted]] = np.where(attacker_is_0, 1, 0)[fainted]
+            active &= ~(knocked_out | fainted)
+            # 元の並びに戻す
+            hp = [
+                np.where(attacker_is_0, hp_a, hp_d),
+                np.where(attacker_is_0, hp_d, hp_a),
+            ]
+            pp = [
+                np.where(attacker_is_0, pp_a, pp[0]),
+                np.where(attacker_is_0, pp[1], pp_a),
+            ]
+
+        # ターン終了処理
+        # たべのこしが発動
+        hp = [np.minimum(mh, h + lo) for mh, h, lo in zip(max_hp, hp, leftover)]
+        # 決着したレーンを取り除く
+        lanes = lanes[active]
+        max_hp = [array[active] for array in max_hp]
+        hp = [array[active] for array in hp]
+        pp = [array[active] for array in pp]
+        s = [array[active] for array in s]
+        match_idx = match_idx[active]
+        recoil = [array[active] for array in recoil]
+        heal = [array[active] for array in heal]
+        leftover = [array[active] for array in leftover]
+
+    return winners.reshape(len(matches), count)
+
+
+def monte_carlo_batch(
+    matches: Sequence[tuple[Poke, Poke]], rng: np.random.Generator, count: int
+) -> np.ndarray:
+    """
+    各対戦組についてモンテカルロシミュレーションを一括で行い、pokes[0]の勝率の配列を返す
+    """
+    for match in matches:
+        [poke.reset() for poke in match]
+    winners = simulate_batch(matches, count, rng)
+    return np.mean(winners == 0, axis=1)
+
+
+def keyed_monte_carlo_batch(
+    matches: Sequence[tuple[Poke, Poke]],
+    count: int,
+    start: int = 0,
+    seed: int = RNG_SEED,
+) -> np.ndarray:
+    """
+    monte_carlo_batch()の、対戦組ごとの乱数列(keyed_random)を使う版
+    各対戦組のstart番目からcount回のバトルを行い、pokes[0]の勝率の配列を返す
+    結果はgenerate_win_table.keyed_monte_carlo()と一致する
+    """
+    canonical = []
+    flips = np.zeros(len(matches), dtype=bool)
+    draws = np.zeros((len(matches), count, MAX_DRAWS), dtype=np.uint16)
+    for idx, match in enumerate(matches):
+        [poke.reset() for poke in match]
+        key, flips[idx] = stream_key(match)
+        # 乱数列はキーの順序の対戦組に対応するので、その順序でシミュレートする
+        canonical.append(match[::-1] if flips[idx] else match)
+        draws[idx] = battle_draws(key, start, count, seed)
+    winners = simulate_batch(canonical, count, None, draws)
+    winrates = np.mean(winners == 0, axis=1)
+    return np.where(flips, 1 - winrates, winrates)
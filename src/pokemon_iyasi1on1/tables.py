@@ -0,0 +1,204 @@
+"""
+育成・ステータスを列ごとのNumPy配列で保持する表
+多数の構築をdataclassのリストで持つと1件ごとのオーバーヘッドが大きいため、
+1行が1構築の構造化配列で持ち、必要なときだけ行オブジェクトに変換する。
+列の参照やスライスはコピーを伴わないビューで、保存はpickleを使わない.npy形式。
+"""
+
+from pathlib import Path
+from typing import Iterable, Iterator, Self
+
+import numpy as np
+
+from pokemon_iyasi1on1.damage import calc_status_array
+from pokemon_iyasi1on1.model import NatureTarget, Poke, PokeBreeding, PokeStrategy
+
+# 育成の表の列と型
+BREEDING_COLUMNS = {
+    "no": np.int32,
+    "level": np.uint8,
+    "ev_hp": np.uint16,
+    "ev_a": np.uint16,
+    "ev_b": np.uint16,
+    "ev_s": np.uint16,
+    "iv_hp": np.uint8,
+    "iv_a": np.uint8,
+    "iv_b": np.uint8,
+    "iv_s": np.uint8,
+    "nature_up": np.uint8,
+    "nature_down": np.uint8,
+    "strategy": np.uint8,
+}
+# ステータスの表の列と型。順序はPoke.battle_key()と同じ
+POKE_COLUMNS = {
+    "level": np.uint8,
+    "max_hp": np.int16,
+    "a": np.int16,
+    "b": np.int16,
+    "s": np.int16,
+    "strategy": np.uint8,
+}
+
+
+class RecordTable:
+    """
+    構造化配列を持つ表の共通部分
+    """
+
+    COLUMNS: dict[str, type]
+
+    def __init__(self, records: np.ndarray):
+        if records.dtype != self.dtype():
+            raise ValueError(f"records must have dtype {self.dtype()}.")
+        self.records = records
+
+    @classmethod
+    def dtype(cls) -> np.dtype:
+        return np.dtype(list(cls.COLUMNS.items()))
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray]) -> Self:
+        n = len(next(iter(columns.values()))) if columns else 0
+        records = np.zeros(n, dtype=cls.dtype())
+        for name in cls.COLUMNS:
+            records[name] = columns[name]
+        return cls(records)
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        列のビュー
+        """
+        return self.records[name]
+
+    def columns(self) -> dict[str, np.ndarray]:
+        return {name: self.records[name] for name in self.COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        """
+        整数なら行オブジェクト、スライス・配列なら部分表(スライスはビュー)を返す
+        """
+        if isinstance(idx, (int, np.integer)):
+            return self._make_row(self.records[idx].tolist())
+        return type(self)(self.records[idx])
+
+    def __iter__(self) -> Iterator:
+        for values in self.records.tolist():
+            yield self._make_row(values)
+
+    def _make_row(self, values: tuple):
+        raise NotImplementedError
+
+    def save(self, path: Path | str):
+        np.save(path, self.records, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path: Path | str, mmap: bool = True) -> Self:
+        return cls(np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False))
+
+
+class BreedingTable(RecordTable):
+    """
+    育成の表。行オブジェクトはPokeBreeding
+    """
+
+    COLUMNS = BREEDING_COLUMNS
+
+    @classmethod
+    def from_breedings(cls, breedings: Iterable[PokeBreeding]) -> "BreedingTable":
+        records = np.array(
+            [
+                (
+                    breeding.no,
+                    breeding.level,
+                    breeding.ev_hp,
+                    breeding.ev_a,
+                    breeding.ev_b,
+                    breeding.ev_s,
+                    breeding.iv_hp,
+                    breeding.iv_a,
+                    breeding.iv_b,
+                    breeding.iv_s,
+                    breeding.nature_up.value,
+                    breeding.nature_down.value,
+                    breeding.strategy.value,
+                )
+                for breeding in breedings
+            ],
+            dtype=cls.dtype(),
+        )
+        return cls(records)
+
+    def _make_row(self, values: tuple) -> PokeBreeding:
+        (no, level, ev_hp, ev_a, ev_b, ev_s, iv_hp, iv_a, iv_b, iv_s) = values[:10]
+        nature_up, nature_down, strategy = values[10:]
+        return PokeBreeding(
+            no=no,
+            level=level,
+            ev_hp=ev_hp,
+            ev_a=ev_a,
+            ev_b=ev_b,
+            ev_s=ev_s,
+            iv_hp=iv_hp,
+            iv_a=iv_a,
+            iv_b=iv_b,
+            iv_s=iv_s,
+            nature_up=NatureTarget(nature_up),
+            nature_down=NatureTarget(nature_down),
+            strategy=PokeStrategy(strategy),
+        )
+
+
+class PokeTable(RecordTable):
+    """
+    ステータスの表。行オブジェクトはreset()済みのPoke
+    """
+
+    COLUMNS = POKE_COLUMNS
+
+    @classmethod
+    def from_pokes(cls, pokes: Iterable[Poke]) -> "PokeTable":
+        records = np.array(
+            [poke.battle_key() for poke in pokes], dtype=np.int64
+        ).reshape(-1, len(cls.COLUMNS))
+        return cls.from_columns(
+            {name: records[:, idx] for idx, name in enumerate(cls.COLUMNS)}
+        )
+
+    @classmethod
+    def from_breedings(cls, breedings: BreedingTable) -> "PokeTable":
+        """
+        育成の表から各行のステータスを計算する
+        """
+        columns = breedings.columns()
+        stats = calc_status_array(
+            **{name: column for name, column in columns.items() if name != "strategy"}
+        )
+        return cls.from_columns(
+            {"level": columns["level"], "strategy": columns["strategy"], **stats}
+        )
+
+    def battle_keys(self) -> np.ndarray:
+        """
+        各行のPoke.battle_key()を並べた配列[行, 列]
+        """
+        return np.stack(
+            [self.records[name].astype(np.int64) for name in self.COLUMNS], axis=1
+        ).reshape(len(self), len(self.COLUMNS))
+
+    def _make_row(self, values: tuple) -> Poke:
+        level, max_hp, a, b, s, strategy = values
+        poke = Poke(
+            level=level,
+            max_hp=max_hp,
+            a=a,
+            b=b,
+            s=s,
+            current_hp=max_hp,
+            strategy=PokeStrategy(strategy),
+            heal_pulse_pp=0,
+        )
+        poke.reset()
+        return poke
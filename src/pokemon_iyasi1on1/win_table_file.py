@@ -0,0 +1,376 @@
+"""
+勝率表のバイナリ形式
+マジックナンバー、JSONヘッダ、列ごとの配列(育成の表と勝率の上三角)を並べた1ファイルで、
+メモリマップで読み込むため、全体の読み込みも1マスの参照も高速に行える
+
+レイアウト:
+    MAGIC (8バイト)
+    ヘッダ長 (uint64 little endian)
+    JSONヘッダ (UTF-8)
+    配列 (ALIGNMENTバイト境界に揃えて連続配置。位置・型・形状はヘッダに記録)
+"""
+
+import argparse
+import json
+import lzma
+import os
+import pickle
+import struct
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from pokemon_iyasi1on1.model import PokeBreeding
+from pokemon_iyasi1on1.tables import BREEDING_COLUMNS, BreedingTable
+
+MAGIC = b"IYWTBL01"
+ALIGNMENT = 64
+# 2: 勝利数の形式で、厳密値のマスの勝利数は勝率×EXACT_DENOMINATOR
+FORMAT_VERSION = 2
+EXACT_DENOMINATOR = 2
+
+
+def triangle_index(n: int, i: int, j: int) -> int:
+    """
+    n×n行列の上三角(対角を除く、行優先)を詰めた配列での(i, j)の位置(i < j)
+    np.triu_indices(n, k=1)の順序と一致する
+    """
+    return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+
+def write_win_table(
+    path: Path | str,
+    breedings: BreedingTable | list[PokeBreeding],
+    winrates: np.ndarray,
+    metadata: dict | None = None,
+    n_samples: np.ndarray | None = None,
+    effective_samples: np.ndarray | None = None,
+):
+    """
+    勝率表を書き出す
+    winrates: 上三角(対角を除く、np.triu_indices(n, k=1)の順)のbreedings[i]の勝率
+    metadata: ヘッダに記録する追加情報。"n_matches"があり、勝率がすべて
+        勝利数/n_matchesで表せるなら、勝率の代わりにuint16の勝利数を保存する
+    n_samples: winratesと同じ並びの各マスの試行回数(0は厳密値)
+        試行回数0以外のマスがすべて同じ値ならmetadataの"n_matches"として、
+        そうでなければ配列として保存する。前者で厳密値のマスがあれば、その位置をビット列で保存する
+    厳密値のマス(同一の構築同士の0.5、乱数によらず勝敗が決まる組の0か1)は、勝率が0.5刻みなら
+    勝利数の配列に勝率の2倍を入れる。これにより、厳密値が混ざっても勝利数の形式で保存できる
+    effective_samples: winratesと同じ並びの各マスの有効サンプルサイズ
+        試行回数と異なるマスがある場合(分散を減らしたモンテカルロ)だけ配列として保存する
+    """
+    if not isinstance(breedings, BreedingTable):
+        breedings = BreedingTable.from_breedings(breedings)
+    n = len(breedings)
+    winrates = np.asarray(winrates, dtype=np.float64)
+    if winrates.shape != (n * (n - 1) // 2,):
+        raise ValueError("winrates must be the packed upper triangle.")
+    metadata = dict(metadata or {})
+    arrays = {
+        f"breeding.{name}": column for name, column in breedings.columns().items()
+    }
+    counts = None
+    if n_samples is not None:
+        n_samples = np.asarray(n_samples, dtype=np.int64)
+        if n_samples.shape != winrates.shape:
+            raise ValueError("n_samples must have the same shape as winrates.")
+        sampled_counts = np.unique(n_samples[n_samples > 0])
+        if len(sampled_counts) <= 1:
+            metadata["n_matches"] = (
+                int(sampled_counts[0]) if len(sampled_counts) else None
+            )
+            if 0 < len(sampled_counts) and np.any(n_samples == 0):
+                arrays["exact"] = np.packbits(n_samples == 0)
+        else:
+            metadata.pop("n_matches", None)
+            arrays["n_samples"] = n_samples.astype(
+                np.uint16 if n_samples.max() <= np.iinfo(np.uint16).max else np.uint32
+            )
+        counts = n_samples
+    if effective_samples is not None:
+        effective_samples = np.asarray(effective_samples, dtype=np.float64)
+        if effective_samples.shape != winrates.shape:
+            raise ValueError("effective_samples must have the same shape as winrates.")
+        if n_samples is None or not np.array_equal(effective_samples, n_samples):
+            arrays["effective_samples"] = effective_samples.astype(np.float32)
+    n_matches = metadata.get("n_matches")
+    if counts is None and n_matches is not None:
+        counts = np.full(winrates.shape, n_matches)
+    wins = None
+    if (
+        counts is not None
+        and np.any(counts > 0)
+        and np.all(counts <= np.iinfo(np.uint16).max)
+    ):
+        counts = np.where(counts == 0, EXACT_DENOMINATOR, counts)
+        wins = np.round(winrates * counts)
+        if not np.allclose(wins / counts, winrates, rtol=0, atol=1e-9):
+            wins = None
+    if wins is not None:
+        arrays["wins"] = wins.astype(np.uint16)
+    else:
+        arrays["winrates"] = winrates.astype(np.float32)
+
+    header = {
+        "format_version": FORMAT_VERSION,
+        "n_breedings": n,
+        "metadata": metadata,
+    }
+    write_arrays(path, MAGIC, header, arrays)
+
+
+def write_arrays(
+    path: Path | str, magic: bytes, header: dict, arrays: dict[str, np.ndarray]
+):
+    """
+    マジックナンバー・JSONヘッダ・配列を並べたファイルを書き出す
+    各配列の位置・型・形状はヘッダの"arrays"に記録する
+    既存のファイルをメモリマップで読み込んでいるプロセスがあるため、上書きはせず、
+    同じディレクトリの一時ファイルに書いてから置き換える
+    """
+    header = {**header, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        header["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += array.nbytes
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    # 配列の先頭をALIGNMENTに揃える
+    data_start = -(-(len(magic) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    header_bytes += b" " * (data_start - len(magic) - 8 - len(header_bytes))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+    ) as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.write(b"\0" * (data_start + header["arrays"][name]["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(f.name, path)
+
+
+def read_arrays(path: Path | str, magic: bytes) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    write_arrays()で書き出したファイルを読み込む。配列はメモリマップ
+    戻り値: (ヘッダ, 配列の辞書)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a {magic.decode()} file.")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = len(magic) + 8 + header_len
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=spec["dtype"])
+            continue
+        arrays[name] = np.memmap(
+            path,
+            dtype=spec["dtype"],
+            mode="r",
+            offset=data_start + spec["offset"],
+            shape=shape,
+        )
+    return header, arrays
+
+
+class WinTable:
+    """
+    メモリマップで読み込んだ勝率表
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.header, self.arrays = read_arrays(self.path, MAGIC)
+        self.n_breedings: int = self.header["n_breedings"]
+        self.metadata: dict = self.header["metadata"]
+
+    def breeding_columns(self) -> dict[str, np.ndarray]:
+        return {name: self.arrays[f"breeding.{name}"] for name in BREEDING_COLUMNS}
+
+    def breedings(self) -> BreedingTable:
+        return BreedingTable.from_columns(self.breeding_columns())
+
+    def _denominator(self, n_samples):
+        """
+        勝利数の形式での、試行回数n_samplesのマスの勝率の分母
+        """
+        exact = 1 if self.header["format_version"] < 2 else EXACT_DENOMINATOR
+        return np.where(n_samples == 0, exact, n_samples)
+
+    def packed_winrates(self) -> np.ndarray:
+        """
+        上三角(対角を除く)を詰めた勝率の配列
+        """
+        if "wins" in self.arrays:
+            return self.arrays["wins"] / self._denominator(self.packed_n_samples())
+        return np.asarray(self.arrays["winrates"], dtype=np.float64)
+
+    def packed_winrates_at(self, idx: np.ndarray) -> np.ndarray:
+        """
+        上三角(対角を除く)を詰めた配列の位置idxの勝率。メモリマップからidxの位置だけを読む
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        if "wins" not in self.arrays:
+            return np.asarray(self.arrays["winrates"][idx], dtype=np.float64)
+        if "n_samples" in self.arrays:
+            n_samples = np.asarray(self.arrays["n_samples"][idx], dtype=np.int64)
+        else:
+            n_samples = np.full(idx.shape, self.metadata.get("n_matches") or 0)
+            if "exact" in self.arrays:
+                exact = (self.arrays["exact"][idx >> 3] >> (7 - (idx & 7))) & 1
+                n_samples[exact == 1] = 0
+        return self.arrays["wins"][idx] / self._denominator(n_samples)
+
+    def packed_n_samples(self) -> np.ndarray:
+        """
+        上三角(対角を除く)を詰めた各マスの試行回数の配列。0は厳密値
+        """
+        if "n_samples" in self.arrays:
+            return np.asarray(self.arrays["n_samples"], dtype=np.int64)
+        n_cells = self.n_breedings * (self.n_breedings - 1) // 2
+        n_matches = self.metadata.get("n_matches") or 0
+        n_samples = np.full(n_cells, n_matches)
+        if "exact" in self.arrays:
+            n_samples[np.unpackbits(self.arrays["exact"], count=n_cells) == 1] = 0
+        return n_samples
+
+    def packed_effective_samples(self) -> np.ndarray:
+        """
+        上三角(対角を除く)を詰めた各マスの有効サンプルサイズの配列
+        記録がなければ試行回数と同じ
+        """
+        if "effective_samples" in self.arrays:
+            return np.asarray(self.arrays["effective_samples"], dtype=np.float64)
+        return self.packed_n_samples().astype(np.float64)
+
+    def winrate(self, i: int, j: int) -> float:
+        """
+        breedings[i]のbreedings[j]に対する勝率
+        """
+        if i == j:
+            return 0.5
+        if i > j:
+            return 1.0 - self.winrate(j, i)
+        idx = triangle_index(self.n_breedings, i, j)
+        if "wins" in self.arrays:
+            return float(
+                self.arrays["wins"][idx] / self._denominator(self.sample_count(i, j))
+            )
+        return float(self.arrays["winrates"][idx])
+
+    def sample_count(self, i: int, j: int) -> int:
+        """
+        breedings[i]とbreedings[j]の勝率の計算に用いた試行回数。0は厳密値
+        """
+        if i == j:
+            return 0
+        if i > j:
+            i, j = j, i
+        idx = triangle_index(self.n_breedings, i, j)
+        if "n_samples" in self.arrays:
+            return int(self.arrays["n_samples"][idx])
+        if (
+            "exact" in self.arrays
+            and (self.arrays["exact"][idx >> 3] >> (7 - (idx & 7))) & 1
+        ):
+            return 0
+        return self.metadata.get("n_matches") or 0
+
+    def effective_sample_count(self, i: int, j: int) -> float:
+        """
+        breedings[i]とbreedings[j]の勝率と同じ分散を与える独立なバトルの数
+        記録がなければ試行回数と同じ
+        """
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        if "effective_samples" in self.arrays:
+            idx = triangle_index(self.n_breedings, i, j)
+            return float(self.arrays["effective_samples"][idx])
+        return float(self.sample_count(i, j))
+
+    def winrate_matrix(self) -> np.ndarray:
+        """
+        勝率の正方行列[自分, 相手]を返す。対角は0.5
+        """
+        n = self.n_breedings
+        winrates = np.full((n, n), 0.5)
+        rows, cols = np.triu_indices(n, k=1)
+        packed = self.packed_winrates()
+        winrates[rows, cols] = packed
+        winrates[cols, rows] = 1.0 - packed
+        return winrates
+
+    def payoff_matrix(self) -> np.ndarray:
+        """
+        利得行列(-1~1)を返す
+        """
+        return (self.winrate_matrix() - 0.5) * 2
+
+
+def load_win_table(path: Path | str) -> WinTable:
+    return WinTable(path)
+
+
+class _LegacyBreeding:
+    """
+    旧形式のpickle内のPokeBreeding(__slots__のない頃のもの)を読み込むための入れ物
+    """
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str):
+        if module == "pokemon_iyasi1on1.model" and name == "PokeBreeding":
+            return _LegacyBreeding
+        return super().find_class(module, name)
+
+
+def convert_pickle(src: Path | str, dst: Path | str):
+    """
+    旧形式(pickle、.xz圧縮も可)の勝率表を変換する
+    """
+    opener = lzma.open if str(src).endswith(".xz") else open
+    with opener(src, "rb") as f:
+        ds = _LegacyUnpickler(f).load()
+    ds["breedings"] = [PokeBreeding(**vars(breeding)) for breeding in ds["breedings"]]
+    n = len(ds["breedings"])
+    winrates = np.full((n, n), np.nan)
+    matches = np.array([match for match, _ in ds["results"]], dtype=np.int64)
+    values = np.array([winrate for _, winrate in ds["results"]])
+    winrates[matches[:, 0], matches[:, 1]] = values
+    packed = winrates[np.triu_indices(n, k=1)]
+    if np.any(np.isnan(packed)):
+        raise ValueError("The pickle does not cover all pairs.")
+    metadata = {
+        key: value for key, value in ds.items() if key not in ("breedings", "results")
+    }
+    write_win_table(dst, ds["breedings"], packed, metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="pickle形式の勝率表を変換する")
+    convert.add_argument("src")
+    convert.add_argument("dst")
+    args = parser.parse_args()
+    match args.command:
+        case "convert":
+            convert_pickle(args.src, args.dst)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+勝率表の作成を複数のマシンに分割する
+重複のないPoke同士の対戦組をN個のシャードに決定的に割り当て、各シャードは自分の組の結果だけを
+シャードファイル(.npz)に保存する。マージ時は、すべてのシャードが同じ構築・計算方法で作られ、
+全組をちょうど1回ずつ含むこと(欠け・重複がないこと)を確かめる。
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from pokemon_iyasi1on1.model import Poke
+from pokemon_iyasi1on1.tables import PokeTable
+from pokemon_iyasi1on1.win_table_file import triangle_index
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """
+    "k/N"形式(0 <= k < N)のシャード指定を(k, N)にする
+    """
+    try:
+        shard, n_shards = (int(value) for value in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be given as k/N, got {spec!r}.") from None
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"Shard index must satisfy 0 <= k < N, got {spec!r}.")
+    return shard, n_shards
+
+
+def shard_matches(
+    matches: list[tuple[int, int]], shard: int, n_shards: int
+) -> list[tuple[int, int]]:
+    """
+    シャードが担当する対戦組
+    行優先の順に1つおきに割り当てるため、各シャードの組は勝率表の全体に散らばり、計算量が揃う
+    """
+    return sorted(matches)[shard::n_shards]
+
+
+def pokes_fingerprint(unique_pokes: list[Poke]) -> str:
+    """
+    重複のないPokeの並びのハッシュ。シャード同士・マージ時の構築が同じことの確認に使う
+    """
+    records = PokeTable.from_pokes(unique_pokes).records
+    return hashlib.sha256(records.tobytes()).hexdigest()
+
+
+@dataclass
+class ShardResult:
+    shard: int
+    n_shards: int
+    n_unique: int  # 重複のないPokeの数
+    fingerprint: str  # pokes_fingerprint()
+    method: str
+    signature: str
+    pairs: np.ndarray  # 対戦組[組, 2](i < j)
+    winrates: np.ndarray  # pairs[:, 0]の勝率
+    n_samples: np.ndarray  # 試行回数(0は厳密値)
+    # ルール名→バージョン(rules.rule_versions())。記録のない古いシャードは空
+    rules: dict[str, int] = field(default_factory=dict)
+    # 有効サンプルサイズ。記録のない古いシャードはNone(試行回数と同じとみなす)
+    effective_samples: np.ndarray | None = None
+
+    def header(self) -> dict:
+        return {
+            "shard": self.shard,
+            "n_shards": self.n_shards,
+            "n_unique": self.n_unique,
+            "fingerprint": self.fingerprint,
+            "method": self.method,
+            "signature": self.signature,
+            "rules": self.rules,
+        }
+
+    def save(self, path: Path | str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                header=np.array(json.dumps(self.header())),
+                pairs=self.pairs.astype(np.int32),
+                winrates=self.winrates.astype(np.float64),
+                n_samples=self.n_samples.astype(np.int64),
+                effective_samples=self.effective_samples_or_counts(),
+            )
+
+    def effective_samples_or_counts(self) -> np.ndarray:
+        if self.effective_samples is None:
+            return self.n_samples.astype(np.float64)
+        return self.effective_samples.astype(np.float64)
+
+    @classmethod
+    def load(cls, path: Path | str) -> "ShardResult":
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            return cls(
+                **header,
+                pairs=data["pairs"],
+                winrates=data["winrates"],
+                n_samples=data["n_samples"],
+                effective_samples=data["effective_samples"]
+                if "effective_samples" in data.files
+                else None,
+            )
+
+
+def merge_shards(
+    shards: list[ShardResult], n_unique: int, fingerprint: str
+) -> list[tuple[tuple[int, int], float, int, float]]:
+    """
+    シャードの結果を結合する
+    すべてのシャードが揃っていて、重複のないPoke同士の全組をちょうど1回ずつ含むことを確かめ、
+    満たさない場合はValueErrorを送出する
+    n_unique, fingerprint: マージ先の構築から求めた値
+    戻り値: [((i, j), 勝率, 試行回数, 有効サンプルサイズ)]
+    """
+    if len(shards) == 0:
+        raise ValueError("No shard given.")
+    first = shards[0].header()
+    for shard in shards:
+        header = shard.header()
+        for name in [
+            "n_shards",
+            "n_unique",
+            "fingerprint",
+            "method",
+            "signature",
+            "rules",
+        ]:
+            if header[name] != first[name]:
+                raise ValueError(
+                    f"Shard {shard.shard} has {name}={header[name]!r},"
+                    f" but shard {shards[0].shard} has {first[name]!r}."
+                )
+    if first["n_unique"] != n_unique or first["fingerprint"] != fingerprint:
+        raise ValueError("Shards were computed for different breedings.")
+    indices = sorted(shard.shard for shard in shards)
+    duplicated_shards = sorted({k for k in indices if indices.count(k) > 1})
+    if duplicated_shards:
+        raise ValueError(f"Duplicate shards: {duplicated_shards}.")
+    missing_shards = sorted(set(range(first["n_shards"])) - set(indices))
+    if missing_shards:
+        raise ValueError(f"Missing shards: {missing_shards}.")
+
+    pairs = np.concatenate([shard.pairs for shard in shards]).astype(np.int64)
+    if (
+        np.any(pairs[:, 0] >= pairs[:, 1])
+        or np.any(pairs < 0)
+        or np.any(pairs >= n_unique)
+    ):
+        raise ValueError("Shards contain invalid pairs.")
+    cell_indices = triangle_index(n_unique, pairs[:, 0], pairs[:, 1])
+    cells, counts = np.unique(cell_indices, return_counts=True)
+    if np.any(counts > 1):
+        duplicated = pairs[np.isin(cell_indices, cells[counts > 1])]
+        raise ValueError(
+            f"{int(np.sum(counts > 1))} cells are computed more than once,"
+            f" e.g. {tuple(duplicated[0].tolist())}."
+        )
+    n_total = n_unique * (n_unique - 1) // 2
+    if len(cells) != n_total:
+        raise ValueError(f"{n_total - len(cells)} of {n_total} cells are missing.")
+    return [
+        ((i, j), winrate, count, effective)
+        for shard in shards
+        for (i, j), winrate, count, effective in zip(
+            shard.pairs.tolist(),
+            shard.winrates.tolist(),
+            shard.n_samples.tolist(),
+            shard.effective_samples_or_counts().tolist(),
+        )
+    ]
@@ -0,0 +1,155 @@
+"""
+勝率の計算結果を追記型のファイルに逐次保存する
+キーは対戦組の内容(バトルに関わるパラメータ)・計算方法・その組に影響しうるルールのバージョン
+(rules.dependent_rules())から作るため、中断後の再実行や構築の追加時には計算済みの組を読み飛ばせ、
+ルールの変更時には影響しうる組だけが再計算される。古いルールの勝率も残るため、新旧を並べて参照できる
+"""
+
+import hashlib
+import json
+import warnings
+from pathlib import Path
+from typing import Iterable
+
+from pokemon_iyasi1on1.model import Poke
+from pokemon_iyasi1on1.simulate_battle import SIMULATOR_VERSION
+
+
+def pair_key(pokes: tuple[Poke, Poke], method: str, rules: str) -> tuple[str, bool]:
+    """
+    対戦組の内容から保存用のキーを求める
+    method: 計算方法とそのパラメータを表す文字列
+    rules: 対戦組に影響しうるルールとそのバージョン(rules.dependent_rules())
+    戻り値: (キー, 反転したか)
+    キーは2体の順序によらないよう正規化する。反転した場合、保存する勝率はpokes[1]のもの。
+    """
+    keys = [list(poke.battle_key()) for poke in pokes]
+    flipped = keys[1] < keys[0]
+    if flipped:
+        keys.reverse()
+    content = json.dumps([SIMULATOR_VERSION, method, rules, keys])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest(), flipped
+
+
+class WinTableStore:
+    """
+    キー→(勝率, 試行回数, 有効サンプルサイズ)を1行ずつ追記するファイル
+    有効サンプルサイズは試行回数と異なる場合(分散を減らしたモンテカルロ)だけ4列目に書く。
+    書き込み途中で中断された最終行(改行で終わらない行)は、開くときにファイルから切り詰める。
+    形式の壊れた行は読み飛ばし、その数を警告する。
+    試行回数のない2列の行(試行回数を記録する前の形式)は、試行回数Noneとして読み込む
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.results: dict[str, tuple[float, int | None, float | None]] = {}
+        if self.path.exists():
+            with open(self.path, "r+b") as f:
+                data = f.read()
+                # 切り詰めないと、次の追記が中断された行の続きに書かれてしまう
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    f.truncate(end)
+            n_malformed = 0
+            for line in data[:end].decode("utf-8", errors="replace").splitlines():
+                fields = line.split("\t")
+                try:
+                    match fields:
+                        case [key, winrate, n_samples, effective_samples]:
+                            self.results[key] = (
+                                float(winrate),
+                                int(n_samples),
+                                float(effective_samples),
+                            )
+                        case [key, winrate, n_samples]:
+                            self.results[key] = (
+                                float(winrate),
+                                int(n_samples),
+                                float(n_samples),
+                            )
+                        case [key, winrate]:
+                            self.results[key] = (float(winrate), None, None)
+                        case _:
+                            raise ValueError(line)
+                except ValueError:
+                    n_malformed += 1
+            if n_malformed > 0:
+                warnings.warn(f"Skipped {n_malformed} malformed lines in {self.path}.")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def __enter__(self) -> "WinTableStore":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.results
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def get(
+        self, pokes: tuple[Poke, Poke], method: str, rules: str
+    ) -> tuple[float, int | None, float | None] | None:
+        """
+        保存済みの(pokes[0]の勝率, 試行回数, 有効サンプルサイズ)を返す。未計算ならNone
+        (試行回数の記録のない古い行の試行回数はNoneだが、キーの形式が異なるため現在のキーでは引かれない)
+        """
+        key, flipped = pair_key(pokes, method, rules)
+        if key not in self.results:
+            return None
+        winrate, n_samples, effective_samples = self.results[key]
+        return (1.0 - winrate if flipped else winrate, n_samples, effective_samples)
+
+    def put(
+        self,
+        pokes: tuple[Poke, Poke],
+        method: str,
+        rules: str,
+        winrate: float,
+        n_samples: int,
+        effective_samples: float | None = None,
+    ):
+        """
+        pokes[0]の勝率と、その計算に用いた試行回数(0は厳密値)を追記する
+        effective_samples: 有効サンプルサイズ(省略時は試行回数と同じ)
+        """
+        self._write(pokes, method, rules, winrate, n_samples, effective_samples)
+        self._file.flush()
+
+    def put_many(
+        self,
+        items: Iterable[tuple[tuple[Poke, Poke], str, str, float, int, float | None]],
+    ):
+        """
+        (pokes, method, rules, winrate, n_samples, effective_samples)の列をまとめて追記する
+        """
+        for pokes, method, rules, winrate, n_samples, effective_samples in items:
+            self._write(pokes, method, rules, winrate, n_samples, effective_samples)
+        self._file.flush()
+
+    def _write(
+        self,
+        pokes: tuple[Poke, Poke],
+        method: str,
+        rules: str,
+        winrate: float,
+        n_samples: int,
+        effective_samples: float | None,
+    ):
+        key, flipped = pair_key(pokes, method, rules)
+        if flipped:
+            winrate = 1.0 - winrate
+        if effective_samples is None or effective_samples == n_samples:
+            self.results[key] = (winrate, n_samples, float(n_samples))
+            self._file.write(f"{key}\t{winrate!r}\t{n_samples}\n")
+        else:
+            self.results[key] = (winrate, n_samples, effective_samples)
+            self._file.write(
+                f"{key}\t{winrate!r}\t{n_samples}\t{effective_samples!r}\n"
+            )